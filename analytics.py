@@ -0,0 +1,162 @@
+# Copyright 2022 Rohit Sood
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import datetime
+import os
+from dataclasses import dataclass
+from typing import Any, Dict, List
+import numpy as np
+from chain_parser import Contract, chain_columns
+from columnar_store import parse_quote_timestamp
+
+
+# Per-symbol metrics series, one record per expiry per snapshot
+analytics_file_name = "analytics.bin"
+
+METRICS_DTYPE = np.dtype([
+    ("quote_timestamp", "<i8"),
+    ("expiry", "<i4"),
+    ("underlyingValue", "<f8"),
+    ("pcr_oi", "<f4"),
+    ("pcr_volume", "<f4"),
+    ("max_pain", "<f4"),
+    ("atm_strike", "<f4"),
+    ("atm_straddle", "<f4"),
+    ("total_call_oi", "<i8"),
+    ("total_put_oi", "<i8"),
+])
+
+# OI buildup per strike and side
+NO_CHANGE, LONG_BUILDUP, SHORT_BUILDUP, SHORT_COVERING, LONG_UNWINDING = range(5)
+buildup_names = ("none", "long_buildup", "short_buildup", "short_covering", "long_unwinding")
+
+_epoch = datetime.date(1970, 1, 1)
+
+
+@dataclass
+class ChainMetrics:
+    expiryDate: str
+    quote_timestamp: str
+    underlyingValue: float
+    pcr_oi: float
+    pcr_volume: float
+    max_pain: float
+    atm_strike: float
+    atm_straddle: float
+    total_call_oi: int
+    total_put_oi: int
+    strikes: np.ndarray
+    call_buildup: np.ndarray
+    put_buildup: np.ndarray
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "expiryDate": self.expiryDate,
+            "quote_timestamp": self.quote_timestamp,
+            "underlyingValue": self.underlyingValue,
+            "pcr_oi": self.pcr_oi,
+            "pcr_volume": self.pcr_volume,
+            "max_pain": self.max_pain,
+            "atm_strike": self.atm_strike,
+            "atm_straddle": self.atm_straddle,
+            "total_call_oi": self.total_call_oi,
+            "total_put_oi": self.total_put_oi,
+            "buildup": [{"strikePrice": strike, "call": buildup_names[call], "put": buildup_names[put]}
+                        for strike, call, put in zip(self.strikes.tolist(), self.call_buildup.tolist(),
+                                                     self.put_buildup.tolist())],
+        }
+
+
+def _side(contracts: List[Contract], strikes: np.ndarray) -> Dict[str, np.ndarray]:
+    # columns of one side laid out on the shared strike axis, missing strikes are 0
+    columns = chain_columns(contracts, ("strikePrice", "lastPrice", "change", "openInterest",
+                                        "changeinOpenInterest", "numberOfContractsTraded"))
+    positions = np.searchsorted(strikes, columns.pop("strikePrice"))
+    aligned = {}
+    for name, column in columns.items():
+        aligned[name] = np.zeros(len(strikes))
+        aligned[name][positions] = column
+    return aligned
+
+
+def _buildup(price_change: np.ndarray, oi_change: np.ndarray) -> np.ndarray:
+    return np.select([(price_change > 0) & (oi_change > 0),
+                      (price_change < 0) & (oi_change > 0),
+                      (price_change > 0) & (oi_change < 0),
+                      (price_change < 0) & (oi_change < 0)],
+                     [LONG_BUILDUP, SHORT_BUILDUP, SHORT_COVERING, LONG_UNWINDING], NO_CHANGE).astype(np.int8)
+
+
+def compute_chain_metrics(expiryDate: str, calls: List[Contract], puts: List[Contract],
+                          underlyingValue: float, quote_timestamp: str) -> ChainMetrics:
+    strikes = np.unique(np.fromiter((x.strikePrice for x in calls + puts), dtype=np.float64))
+    call = _side(calls, strikes)
+    put = _side(puts, strikes)
+    total_call_oi = call["openInterest"].sum()
+    total_put_oi = put["openInterest"].sum()
+    total_call_volume = call["numberOfContractsTraded"].sum()
+    total_put_volume = put["numberOfContractsTraded"].sum()
+    # payout to option buyers if the underlying settles at each strike,
+    # the strike where it is smallest is max pain
+    settle = strikes[:, np.newaxis]
+    payout = (np.maximum(settle - strikes, 0) * call["openInterest"]).sum(axis=1) \
+        + (np.maximum(strikes - settle, 0) * put["openInterest"]).sum(axis=1)
+    atm = int(np.abs(strikes - underlyingValue).argmin()) if len(strikes) else 0
+    return ChainMetrics(
+        expiryDate=expiryDate,
+        quote_timestamp=quote_timestamp,
+        underlyingValue=underlyingValue,
+        pcr_oi=float(total_put_oi / total_call_oi) if total_call_oi else 0.0,
+        pcr_volume=float(total_put_volume / total_call_volume) if total_call_volume else 0.0,
+        max_pain=float(strikes[payout.argmin()]) if len(strikes) else 0.0,
+        atm_strike=float(strikes[atm]) if len(strikes) else 0.0,
+        atm_straddle=float(call["lastPrice"][atm] + put["lastPrice"][atm]) if len(strikes) else 0.0,
+        total_call_oi=int(total_call_oi),
+        total_put_oi=int(total_put_oi),
+        strikes=strikes,
+        call_buildup=_buildup(call["change"], call["changeinOpenInterest"]),
+        put_buildup=_buildup(put["change"], put["changeinOpenInterest"]),
+    )
+
+
+def encode_metrics(metrics: List[ChainMetrics]) -> bytes:
+    records = np.empty(len(metrics), dtype=METRICS_DTYPE)
+    for record, item in zip(records, metrics):
+        expiry = datetime.datetime.strptime(item.expiryDate, "%d-%b-%Y").date()
+        record["quote_timestamp"] = parse_quote_timestamp(item.quote_timestamp)
+        record["expiry"] = (expiry - _epoch).days
+        record["underlyingValue"] = item.underlyingValue
+        record["pcr_oi"] = item.pcr_oi
+        record["pcr_volume"] = item.pcr_volume
+        record["max_pain"] = item.max_pain
+        record["atm_strike"] = item.atm_strike
+        record["atm_straddle"] = item.atm_straddle
+        record["total_call_oi"] = item.total_call_oi
+        record["total_put_oi"] = item.total_put_oi
+    return records.tobytes()
+
+
+def read_metrics(path: str) -> np.ndarray:
+    if not os.path.exists(path) or os.path.getsize(path) < METRICS_DTYPE.itemsize:
+        return np.empty(0, dtype=METRICS_DTYPE)
+    count = os.path.getsize(path) // METRICS_DTYPE.itemsize
+    return np.memmap(path, dtype=METRICS_DTYPE, mode="r", shape=(count,))
+
+
+def expiry_label(days: int) -> str:
+    return (_epoch + datetime.timedelta(days=int(days))).strftime("%d-%b-%Y")
+
+
+# Latest metrics per symbol and expiry, filled by data_management.save_data
+latest_metrics: Dict[str, Dict[str, ChainMetrics]] = {}
@@ -13,28 +13,285 @@
 #    limitations under the License.
 
 import urllib.parse
-from utility import getstaticheader, getfreshcookie, getstocklist, get_stock_data, start_collector
+from typing import Optional
+from utility import getstocklist, fetch_snapshot, start_collector
+from sharding import Coordinator, host_symbols, shard_workers
+from snapshot_cache import snapshot_cache
+from snapshot_archive import latest_raw_snapshot
+from fetch_engine import get_engine
+from pipeline import pipeline
+from data_management import close_strike_data
 from sanic.request import Request
 from sanic.response import HTTPResponse
 from sanic.response import json as json_response
+from sanic.response import text as text_response
+from sanic.response import stream
+import history_store
+from ring_buffer import intraday_store
+from stream_hub import RESYNC, keepalive_in_seconds, parse_topics, stream_hub
+from metrics import render_metrics
+from structured_log import configure_logging, get_logger, fields
+import analytics
+from data_management import get_analytics_path, data_directory
+import bars
+import json
+import os
+import numpy as np
+import datetime
 import asyncio
 from sanic import Sanic
 
+configure_logging()
+log = get_logger("api")
 app = Sanic("Quote_Collector", configure_logging=False)
-app.add_task(start_collector)
+# with SHARD_WORKERS > 1 the collector runs in worker processes, the API reads what they store
+coordinator = Coordinator(host_symbols(getstocklist()), shard_workers) if shard_workers > 1 else None
+app.add_task(coordinator.run if coordinator else start_collector)
+
+
+@app.listener('after_server_stop')
+async def close_fetch_engine(app, loop):
+    if coordinator:
+        coordinator.stop()
+    await get_engine().close()
+    # snapshots already fetched are stored before the files are closed
+    await pipeline.close()
+    close_strike_data()
+
+
+@app.route('/metrics', methods=['GET'])
+async def metrics(request: Request) -> HTTPResponse:
+    # Prometheus scrape endpoint: stage latencies, write times, fetch status counts
+    return text_response(render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.route('/stream', methods=['GET'])
+async def chainstream(request: Request) -> HTTPResponse:
+    # server-sent events: a snapshot of every subscribed expiry, then the
+    # contracts that changed in each collector cycle.
+    # ?symbols=NIFTY,BANKNIFTY:25-Aug-2022 subscribes to every NIFTY expiry and one BANKNIFTY expiry
+    if coordinator:
+        return collector_elsewhere("/stream")
+    try:
+        topics = parse_topics(request.args.get("symbols"))
+    except ValueError as e:
+        return json_response({"error": str(e)}, status=400)
+
+    async def streaming_fn(response):
+        subscriber = stream_hub.subscribe(topics)
+        try:
+            for frame in stream_hub.snapshot(subscriber):
+                await response.write(frame)
+            while not response.protocol.transport.is_closing():
+                try:
+                    frame = await asyncio.wait_for(subscriber.queue.get(), keepalive_in_seconds)
+                except asyncio.TimeoutError:
+                    await response.write(b": keepalive\n\n")
+                    continue
+                if frame is RESYNC:
+                    # the client fell behind, its backlog was dropped
+                    await response.write(b"event: resync\ndata: {}\n\n")
+                    for snapshot_frame in stream_hub.snapshot(subscriber):
+                        await response.write(snapshot_frame)
+                else:
+                    await response.write(frame)
+        finally:
+            stream_hub.unsubscribe(subscriber)
+    return stream(streaming_fn, content_type="text/event-stream",
+                  headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 @app.route('/nse/<symbol>', methods=['GET'])
-def nsedata(request: Request, symbol) -> HTTPResponse:
+async def nsedata(request: Request, symbol) -> HTTPResponse:
+    # served from the collector's latest snapshot, max_age (seconds) forces
+    # an upstream fetch when the cached one is older
     symbol = str.upper(urllib.parse.unquote(symbol))
-    headers = getstaticheader(urllib.parse.quote(symbol))
-    cookies = getfreshcookie()
     try:
-        return json_response(get_stock_data(symbol, headers, cookies))
+        max_age = request.args.get("max_age")
+        max_age = float(max_age) if max_age is not None else None
+    except ValueError:
+        return json_response({"error": "max_age must be a number of seconds"}, status=400)
+    if coordinator:
+        # the workers' latest snapshot is read back from disk, it replaces an older one cached here
+        stored = await asyncio.get_running_loop().run_in_executor(
+            None, latest_raw_snapshot, os.path.abspath(data_directory), symbol, bars.trading_day())
+        cached = snapshot_cache.get(symbol)
+        if stored is not None and (cached is None or stored[0] / 1e6 > cached.fetched_at):
+            snapshot_cache.put(symbol, stored[1], None, stored[0] / 1e6)
+    try:
+        snapshot, cached = await snapshot_cache.get_or_fetch(symbol, fetch_snapshot, max_age)
     except Exception as e:
-        print("Oops!", e.__class__, "occurred.")
-        print("Next entry.")
-        print()
+        log.warning("snapshot not available", extra=fields(symbol=symbol, error=e.__class__.__name__))
+        return json_response({"error": f"quote for {symbol} is not available"}, status=502)
+    headers = {
+        "X-Snapshot-Source": "cache" if cached else "upstream",
+        "X-Snapshot-Fetched-At": datetime.datetime.fromtimestamp(snapshot.fetched_at, datetime.timezone.utc).isoformat(),
+        "X-Snapshot-Age": str(round(snapshot.age(), 3)),
+    }
+    return text_response(snapshot.raw, headers=headers, content_type="application/json")
+
+
+@app.route('/nse/<symbol>/chain', methods=['GET'])
+async def nsechain(request: Request, symbol) -> HTTPResponse:
+    # last stored row of every contract at or before ?at=, optionally for one ?expiry=
+    symbol = str.upper(urllib.parse.unquote(symbol))
+    try:
+        at = history_store.parse_time_param(request.args.get("at"))
+        fields = history_store.parse_fields(request.args.get("fields"))
+    except ValueError as e:
+        return json_response({"error": str(e)}, status=400)
+    expiry = request.args.get("expiry")
+    return stream_rows(history_store.query_chain(symbol, at, expiry, fields))
+
+
+@app.route('/nse/<symbol>/analytics', methods=['GET'])
+async def nseanalytics(request: Request, symbol) -> HTTPResponse:
+    # latest per-expiry metrics with per-strike OI buildup, or the stored
+    # series when ?from= or ?to= is given
+    symbol = str.upper(urllib.parse.unquote(symbol))
+    expiry = request.args.get("expiry")
+    if "from" not in request.args and "to" not in request.args:
+        if coordinator:
+            return collector_elsewhere("the latest analytics")
+        latest = analytics.latest_metrics.get(symbol, {})
+        return json_response([x.to_dict() for x in latest.values() if expiry is None or x.expiryDate == expiry])
+    try:
+        start = history_store.parse_time_param(request.args.get("from"))
+        end = history_store.parse_time_param(request.args.get("to"))
+    except ValueError as e:
+        return json_response({"error": str(e)}, status=400)
+
+    def read():
+        series = analytics.read_metrics(get_analytics_path(symbol))
+        selected = np.ones(len(series), dtype=bool)
+        if start is not None:
+            selected &= series["quote_timestamp"] >= start
+        if end is not None:
+            selected &= series["quote_timestamp"] <= end
+        return series[selected]
+    # the whole metrics file is read and filtered off the event loop
+    series = await asyncio.get_running_loop().run_in_executor(None, read)
+
+    def chunks():
+        for first in range(0, len(series), history_store.rows_per_chunk):
+            rows = []
+            for record in series[first:first + history_store.rows_per_chunk].tolist():
+                row = {name: round(value, 4) if isinstance(value, float) else value
+                       for name, value in zip(analytics.METRICS_DTYPE.names, record)}
+                row["quote_timestamp"] = history_store.format_timestamp(row["quote_timestamp"])
+                row["expiryDate"] = analytics.expiry_label(row.pop("expiry"))
+                if expiry is None or row["expiryDate"] == expiry:
+                    rows.append(row)
+            yield rows
+    return stream_rows(chunks())
+
+
+@app.route('/nse/<symbol>/bars', methods=['GET'])
+async def nsebars(request: Request, symbol) -> HTTPResponse:
+    # closed ?resolution= bars of one ?day= (today by default) for one
+    # contract ?identifier=, the underlying when omitted
+    symbol = str.upper(urllib.parse.unquote(symbol))
+    resolution = request.args.get("resolution", bars.bar_resolutions[0])
+    if resolution not in bars.bar_resolutions:
+        return json_response({"error": f"resolution must be one of {','.join(bars.bar_resolutions)}"}, status=400)
+    day = request.args.get("day") or bars.trading_day()
+    try:
+        datetime.date.fromisoformat(day)
+    except ValueError:
+        return json_response({"error": "day must be YYYY-MM-DD"}, status=400)
+    identifier = request.args.get("identifier") or symbol
+    # the day's bars are read, filtered and merged off the event loop
+    series, _ = await asyncio.get_running_loop().run_in_executor(
+        None, bars.read_bars, os.path.abspath(data_directory), symbol, day, resolution, identifier)
+
+    def chunks():
+        for first in range(0, len(series), history_store.rows_per_chunk):
+            rows = []
+            for record in series[first:first + history_store.rows_per_chunk].tolist():
+                row = dict(zip(bars.BAR_DTYPE.names, record))
+                del row["contract"]
+                row["bar_start"] = history_store.format_timestamp(row["bar_start"])
+                rows.append(row)
+            yield rows
+    return stream_rows(chunks())
+
+
+@app.route('/nse/<symbol>/<expiry>/<identifier>', methods=['GET'])
+async def nsehistory(request: Request, symbol, expiry, identifier) -> HTTPResponse:
+    # stored rows of one contract between ?from= and ?to=, restricted to ?fields=,
+    # forward-filled to one row every ?fill= seconds when given
+    symbol = str.upper(urllib.parse.unquote(symbol))
+    try:
+        start = history_store.parse_time_param(request.args.get("from"))
+        end = history_store.parse_time_param(request.args.get("to"))
+        fields = history_store.parse_fields(request.args.get("fields"))
+        every = int(request.args.get("fill")) if request.args.get("fill") else None
+    except ValueError as e:
+        return json_response({"error": str(e)}, status=400)
+    if every is not None and every <= 0:
+        return json_response({"error": "fill must be a positive number of seconds"}, status=400)
+    try:
+        # the byte offset index of a CSV series may be built on first use
+        chunks = await asyncio.get_running_loop().run_in_executor(
+            None, history_store.query_series, symbol, urllib.parse.unquote(expiry),
+            urllib.parse.unquote(identifier), start, end, fields, every)
+    except FileNotFoundError:
+        return json_response({"error": f"no series for {symbol} {expiry} {identifier}"}, status=404)
+    return stream_rows(chunks)
+
+
+@app.route('/nse/<symbol>/<expiry>/<identifier>/live', methods=['GET'])
+async def nselive(request: Request, symbol, expiry, identifier) -> HTTPResponse:
+    # every snapshot of one contract in the current session, from memory: the
+    # last ?minutes= or between ?from= and ?to=, restricted to ?fields=
+    if coordinator:
+        return collector_elsewhere("the intraday series")
+    symbol = str.upper(urllib.parse.unquote(symbol))
+    identifier = urllib.parse.unquote(identifier)
+    try:
+        start = history_store.parse_time_param(request.args.get("from"))
+        end = history_store.parse_time_param(request.args.get("to"))
+        fields = history_store.parse_fields(request.args.get("fields"))
+        minutes = float(request.args.get("minutes")) if request.args.get("minutes") else None
+    except ValueError as e:
+        return json_response({"error": str(e)}, status=400)
+    if minutes is not None:
+        series, oldest = intraday_store.latest(identifier, int(minutes * 60))
+    else:
+        series, oldest = intraday_store.window(identifier, start, end)
+    if series is None:
+        return json_response({"error": f"no intraday series for {symbol} {expiry} {identifier}"}, status=404)
+    headers = None
+    if oldest is not None:
+        # the start of the window was overwritten, the stored history has it
+        headers = {"X-Window-Truncated": "true", "X-Window-Oldest": history_store.format_timestamp(oldest)}
+    return stream_rows(history_store.columnar_rows(series, fields), headers)
+
+
+def collector_elsewhere(what: str) -> HTTPResponse:
+    # what is only kept in the memory of the process running the collector
+    return json_response({"error": f"{what} is not served while the collector runs in worker processes "
+                                   f"(SHARD_WORKERS > 1)"}, status=503)
+
+
+def stream_rows(chunks, headers: Optional[dict] = None) -> HTTPResponse:
+    # newline delimited JSON, one chunk of rows in memory at a time. Chunks are
+    # read and serialized on the default executor, off the loop the collector runs on.
+    chunks = iter(chunks)
+
+    async def streaming_fn(response):
+        loop = asyncio.get_running_loop()
+        while True:
+            text = await loop.run_in_executor(None, _next_chunk, chunks)
+            if text is None:
+                break
+            await response.write(text)
+    return stream(streaming_fn, content_type="application/x-ndjson", headers=headers)
+
+
+def _next_chunk(chunks) -> Optional[str]:
+    chunk = next(chunks, None)
+    return None if chunk is None else ''.join(json.dumps(row) + "\n" for row in chunk)
 
 
 if __name__ == "__main__":
@@ -50,8 +307,6 @@ if __name__ == "__main__":
         asyncio.ensure_future(server, loop=loop)
         loop.run_forever()
     except Exception as e:
-        print("Oops!", e.__class__, "occurred.")
-        print("Next entry.")
-        print()
+        log.exception("server failed to start")
 
 
@@ -0,0 +1,228 @@
+# Copyright 2022 Rohit Sood
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Rebuilds the per-contract series from the raw snapshots on disk, e.g. after
+# the row layout changed or writes failed. Run it while the collector is
+# stopped, from the repository root:
+#   DEBUG=False python backfill.py [--symbols NIFTY BANKNIFTY] [--from 2022-08-01] [--to 2022-08-31] [--workers 8]
+#
+# Two passes, both on a process pool:
+#   1. one task per (symbol, day) re-parses that day's snapshots and stages the
+#      rows of every contract, deduplicated by quote timestamp, under .backfill/
+#   2. one task per (symbol, expiry) merges the staged days with the rows
+#      already in each contract file, in timestamp order, and swaps the new
+#      file in with os.replace.
+# A row is identified by its quote timestamp, so running it again over the
+# same snapshots leaves the files unchanged.
+
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import shutil
+import time
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from chain_parser import parse_chain
+from change_detection import ChangeDetector, skip_unchanged_rows
+from columnar_store import RECORD_DTYPE, build_records, columnar_suffix, parse_quote_timestamp, read_series
+from data_management import data_directory, option_instrument_types, storage_format, strike_data_header
+from snapshot_archive import iter_raw_snapshots, raw_snapshot_days
+from structured_log import configure_logging, fields, get_logger
+
+
+staging_directory_name = ".backfill"
+csv_suffix = ".csv"
+
+log = get_logger("backfill")
+
+
+def stage_day(data_dir: str, staging_dir: str, symbol: str, day: str, store_csv: bool,
+              store_columnar: bool) -> Tuple[int, int]:
+    # returns (snapshots parsed, snapshots skipped)
+    rows: Dict[Tuple[str, str], Dict[int, str]] = {}
+    records: Dict[Tuple[str, str], Dict[int, bytes]] = {}
+    parsed = skipped = 0
+    # same rows as the collector stores: unchanged contracts are skipped, state starts fresh every session
+    detector = ChangeDetector() if skip_unchanged_rows else None
+    for _, raw in iter_raw_snapshots(data_dir, symbol, day):
+        try:
+            chain = parse_chain(json.loads(raw))
+            quote_timestamp = parse_quote_timestamp(chain.opt_timestamp)
+        except Exception:
+            # error pages and empty responses that were saved as snapshots
+            skipped += 1
+            continue
+        parsed += 1
+        contracts = [x for x in chain.contracts if x.instrumentType in option_instrument_types
+                     and (detector is None or detector.changed(x, quote_timestamp))]
+        if store_csv:
+            for contract in contracts:
+                rows.setdefault((contract.expiryDate, contract.identifier), {})[quote_timestamp] = \
+                    contract.csv_row(chain.opt_timestamp)
+        if store_columnar and contracts:
+            encoded = build_records(contracts, chain.opt_timestamp).tobytes()
+            size = RECORD_DTYPE.itemsize
+            for i, contract in enumerate(contracts):
+                records.setdefault((contract.expiryDate, contract.identifier), {})[quote_timestamp] = \
+                    encoded[i * size:(i + 1) * size]
+    # a later snapshot with the same quote timestamp replaces the earlier row
+    for (expiry, identifier), by_time in rows.items():
+        _write_staged(staging_dir, symbol, expiry, day, identifier + csv_suffix,
+                      ''.join(by_time[x] for x in sorted(by_time)).encode())
+    for (expiry, identifier), by_time in records.items():
+        _write_staged(staging_dir, symbol, expiry, day, identifier + columnar_suffix,
+                      b''.join(by_time[x] for x in sorted(by_time)))
+    return parsed, skipped
+
+
+def _write_staged(staging_dir: str, symbol: str, expiry: str, day: str, name: str, data: bytes) -> None:
+    directory = os.path.join(staging_dir, symbol, expiry, day)
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, name), mode="wb") as f:
+        f.write(data)
+
+
+def merge_expiry(data_dir: str, staging_dir: str, symbol: str, expiry: str) -> int:
+    # returns the number of contract files that changed
+    expiry_staging = os.path.join(staging_dir, symbol, expiry)
+    staged: Dict[str, List[str]] = {}
+    for day in sorted(os.listdir(expiry_staging)):
+        for name in os.listdir(os.path.join(expiry_staging, day)):
+            staged.setdefault(name, []).append(os.path.join(expiry_staging, day, name))
+    target_dir = os.path.join(data_dir, symbol, expiry)
+    os.makedirs(target_dir, exist_ok=True)
+    changed = 0
+    for name, day_paths in staged.items():
+        if name.endswith(csv_suffix):
+            target = os.path.join(target_dir, name[:-len(csv_suffix)])
+            changed += _replace(target, _merge_csv(target, day_paths))
+        else:
+            target = os.path.join(target_dir, name)
+            changed += _replace(target, _merge_records(target, day_paths).tobytes())
+    return changed
+
+
+def _merge_csv(target: str, day_paths: List[str]) -> bytes:
+    by_time: Dict[int, str] = {}
+    if os.path.exists(target):
+        with open(target) as f:
+            # rows written with another header are dropped and rebuilt
+            if f.readline() == strike_data_header:
+                _collect_rows(f, by_time)
+    for day_path in day_paths:
+        with open(day_path) as f:
+            _collect_rows(f, by_time)
+    return (strike_data_header + ''.join(by_time[x] for x in sorted(by_time))).encode()
+
+
+def _collect_rows(lines, by_time: Dict[int, str]) -> None:
+    for line in lines:
+        if not line.endswith("\n"):
+            # partially written last row
+            continue
+        try:
+            by_time[parse_quote_timestamp(line[:line.index(",")])] = line
+        except ValueError:
+            continue
+
+
+def _merge_records(target: str, day_paths: List[str]) -> np.ndarray:
+    parts = [np.array(read_series(target))]
+    for day_path in day_paths:
+        parts.append(np.fromfile(day_path, dtype=RECORD_DTYPE))
+    combined = np.concatenate(parts)
+    # last record per quote timestamp, in timestamp order
+    _, last = np.unique(combined["quote_timestamp"][::-1], return_index=True)
+    return combined[len(combined) - 1 - last]
+
+
+def _replace(target: str, data: bytes) -> bool:
+    if os.path.exists(target) and os.path.getsize(target) == len(data):
+        with open(target, mode="rb") as f:
+            if f.read() == data:
+                return False
+    temporary = target + ".backfill"
+    # readers see either the old or the new file, never a partial one
+    with open(temporary, mode="wb") as f:
+        f.write(data)
+    os.replace(temporary, target)
+    return True
+
+
+def find_shards(data_dir: str, symbols: Optional[List[str]], first_day: Optional[str],
+                last_day: Optional[str]) -> List[Tuple[str, str]]:
+    if not symbols:
+        symbols = sorted(x for x in os.listdir(data_dir)
+                         if not x.startswith(".") and os.path.isdir(os.path.join(data_dir, x)))
+    return [(symbol, day) for symbol in symbols for day in raw_snapshot_days(data_dir, symbol)
+            if (first_day is None or day >= first_day) and (last_day is None or day <= last_day)]
+
+
+def backfill(data_dir: str, shards: List[Tuple[str, str]], workers: int, store_csv: bool,
+             store_columnar: bool) -> None:
+    staging_dir = os.path.join(data_dir, staging_directory_name)
+    # leftovers of an interrupted run are not trusted
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    started = time.time()
+    # spawned: forking a process that runs threads isn't safe
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                mp_context=multiprocessing.get_context("spawn")) as pool:
+        parsed = skipped = 0
+        futures = {pool.submit(stage_day, data_dir, staging_dir, symbol, day, store_csv, store_columnar): (symbol, day)
+                   for symbol, day in shards}
+        for future in concurrent.futures.as_completed(futures):
+            symbol, day = futures[future]
+            day_parsed, day_skipped = future.result()
+            parsed += day_parsed
+            skipped += day_skipped
+            log.info("staged day", extra=fields(symbol=symbol, day=day, snapshots=day_parsed, skipped=day_skipped))
+        staged_at = time.time()
+        expiries = [(symbol, expiry) for symbol in sorted({x[0] for x in shards})
+                    if os.path.isdir(os.path.join(staging_dir, symbol))
+                    for expiry in sorted(os.listdir(os.path.join(staging_dir, symbol)))]
+        files = 0
+        futures = {pool.submit(merge_expiry, data_dir, staging_dir, symbol, expiry): (symbol, expiry)
+                   for symbol, expiry in expiries}
+        for future in concurrent.futures.as_completed(futures):
+            symbol, expiry = futures[future]
+            count = future.result()
+            files += count
+            log.info("merged expiry", extra=fields(symbol=symbol, expiry=expiry, files=count))
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    log.info("backfill done", extra=fields(days=len(shards), snapshots=parsed, skipped=skipped, files=files,
+                                           stage_s=round(staged_at - started, 1),
+                                           merge_s=round(time.time() - staged_at, 1)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild per-contract series from raw snapshots")
+    parser.add_argument("--data-dir", default=data_directory)
+    parser.add_argument("--symbols", nargs="*", help="defaults to every symbol under the data directory")
+    parser.add_argument("--from", dest="first_day", help="first day, YYYY-MM-DD")
+    parser.add_argument("--to", dest="last_day", help="last day, YYYY-MM-DD")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--format", default=storage_format, choices=("csv", "columnar", "both"))
+    args = parser.parse_args()
+    configure_logging()
+    data_dir = os.path.abspath(args.data_dir)
+    shards = find_shards(data_dir, args.symbols, args.first_day, args.last_day)
+    log.info("backfill starting", extra=fields(data_dir=data_dir, days=len(shards), workers=args.workers,
+                                               format=args.format))
+    backfill(data_dir, shards, args.workers, args.format in ("csv", "both"), args.format in ("columnar", "both"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,411 @@
+# Copyright 2022 Rohit Sood
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# OHLC bars of every option contract and of the underlying, built
+# incrementally from the snapshots save_data sees. Per symbol, day and
+# resolution data/<symbol>/bars/<date>.<resolution>.bin holds one fixed-width
+# record per closed bar; <date>.ids is the identifier table the records point
+# at by position, shared by the resolutions. The underlying's identifier is
+# the symbol. Bars start at the session open, 09:15, and multiples of the
+# resolution after it.
+#
+# A bar is written when the first snapshot of the next bar arrives or the
+# market closes. Rebuilding them from the raw snapshots, e.g. for days from
+# before bars were kept, runs one task per symbol-day on a process pool:
+#   DEBUG=False python bars.py [--symbols NIFTY] [--from 2022-08-01] [--to 2022-08-31] [--workers 8]
+
+import argparse
+import concurrent.futures
+import datetime
+import json
+import multiprocessing
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+from zoneinfo import ZoneInfo
+import numpy as np
+from chain_parser import Chain, Contract, parse_chain
+from columnar_store import parse_quote_timestamp
+from depth_store import read_identifiers
+from snapshot_archive import iter_raw_snapshots, raw_snapshot_days
+from structured_log import configure_logging, fields, get_logger
+
+
+# Bars are kept at every resolution listed, e.g. 5m,15m,1h
+keep_bars = os.environ.get("BARS", "True") == "True"
+bar_resolutions = [x.strip() for x in os.environ.get("BAR_RESOLUTIONS", "5m,15m,1h").split(",") if x.strip()]
+
+bars_directory_name = "bars"
+records_suffix = ".bin"
+identifiers_suffix = ".ids"
+
+# open, high, low and close of lastPrice (underlyingValue for the underlying),
+# contracts traded during the bar, open interest at its close (total option
+# OI for the underlying) and the number of snapshots it was built from
+BAR_DTYPE = np.dtype([
+    ("bar_start", "<i8"),
+    ("contract", "<i4"),
+    ("open", "<f8"),
+    ("high", "<f8"),
+    ("low", "<f8"),
+    ("close", "<f8"),
+    ("volume", "<i8"),
+    ("openInterest", "<i8"),
+    ("snapshots", "<i4"),
+])
+
+_IST = ZoneInfo("Asia/Kolkata")
+_session_open = datetime.time(9, 15)
+_units = {"s": 1, "m": 60, "h": 3600}
+
+log = get_logger("bars")
+
+
+def resolution_seconds(resolution: str) -> int:
+    # 5m -> 300
+    try:
+        seconds = int(resolution[:-1]) * _units[resolution[-1]]
+    except (KeyError, ValueError):
+        raise ValueError(f"unknown bar resolution {resolution!r}, e.g. 5m, 15m or 1h")
+    if seconds <= 0:
+        raise ValueError(f"unknown bar resolution {resolution!r}, e.g. 5m, 15m or 1h")
+    return seconds
+
+
+def trading_day(timestamp: Optional[float] = None) -> str:
+    # IST date of an epoch time, today by default
+    return datetime.datetime.fromtimestamp(time.time() if timestamp is None else timestamp, _IST).date().isoformat()
+
+
+def bar_paths(data_directory: str, symbol: str, day: str, resolution: str) -> Tuple[str, str]:
+    directory = os.path.join(data_directory, symbol, bars_directory_name)
+    return (os.path.join(directory, f"{day}.{resolution}{records_suffix}"),
+            os.path.join(directory, day + identifiers_suffix))
+
+
+class BarDay:
+    # Identifier table of one symbol-day, loaded from disk if the collector
+    # restarts during the day
+
+    def __init__(self, data_directory: str, symbol: str, day: datetime.date, load: bool = True):
+        self.day = day
+        self.session_open = int(datetime.datetime.combine(day, _session_open, tzinfo=_IST).timestamp())
+        self.data_directory = data_directory
+        self.symbol = symbol
+        self.identifiers_path = bar_paths(data_directory, symbol, day.isoformat(), "")[1]
+        identifiers = read_identifiers(self.identifiers_path) if load else []
+        self.positions: Dict[str, int] = {x: i for i, x in enumerate(identifiers)}
+        # contracts with bars on disk from before a restart
+        self.restarted = len(self.positions)
+        self.last_timestamp = 0
+
+    def records_path(self, resolution: str) -> str:
+        return bar_paths(self.data_directory, self.symbol, self.day.isoformat(), resolution)[0]
+
+    def written_volume(self, resolution: str) -> np.ndarray:
+        # contracts traded per identifier table position in the bars already on disk
+        records_path = self.records_path(resolution)
+        if not self.restarted or not os.path.exists(records_path):
+            return np.zeros(self.restarted, dtype=np.int64)
+        bars = np.fromfile(records_path, dtype=BAR_DTYPE, count=os.path.getsize(records_path) // BAR_DTYPE.itemsize)
+        bars = bars[bars["contract"] < self.restarted]
+        return np.bincount(bars["contract"], weights=bars["volume"], minlength=self.restarted).astype(np.int64)
+
+    def positions_for(self, identifiers: List[str]) -> Tuple[np.ndarray, List[str]]:
+        added = []
+        for identifier in identifiers:
+            if identifier not in self.positions:
+                self.positions[identifier] = len(self.positions)
+                added.append(identifier)
+        return np.fromiter((self.positions[x] for x in identifiers), dtype=np.int32, count=len(identifiers)), added
+
+
+class _OpenBars:
+    # The bar in progress of every contract at one resolution, in flat arrays
+    # indexed by identifier table position
+
+    def __init__(self, seconds: int, written_volume: np.ndarray = None):
+        self.seconds = seconds
+        # contracts traded in the bars written before a restart, by position
+        self.written_volume = np.zeros(0, dtype=np.int64) if written_volume is None else written_volume
+        self.start = np.zeros(0, dtype=np.int64)
+        self.open = np.zeros(0)
+        self.high = np.zeros(0)
+        self.low = np.zeros(0)
+        self.close = np.zeros(0)
+        self.open_interest = np.zeros(0, dtype=np.int64)
+        self.snapshots = np.zeros(0, dtype=np.int32)
+        # contracts traded as of the previous bar's close and as of the last snapshot
+        self.traded_before = np.zeros(0, dtype=np.int64)
+        self.traded = np.zeros(0, dtype=np.int64)
+        self.seen = np.zeros(0, dtype=bool)
+
+    def _grow(self, size: int) -> None:
+        if size <= len(self.start):
+            return
+        size = max(size, 2 * len(self.start), 64)
+        for name in ("start", "open", "high", "low", "close", "open_interest", "snapshots", "traded_before",
+                     "traded", "seen"):
+            old = getattr(self, name)
+            new = np.zeros(size, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def update(self, session_open: int, quote_timestamp: int, positions: np.ndarray, price: np.ndarray,
+               traded: np.ndarray, open_interest: np.ndarray) -> np.ndarray:
+        # adds one snapshot, returns the bars it closed
+        self._grow(int(positions.max()) + 1)
+        bar_start = session_open + (quote_timestamp - session_open) // self.seconds * self.seconds
+        first = ~self.seen[positions]
+        if first.any():
+            # volume counts from the session open, after a restart from what the
+            # bars already written counted up to
+            new = positions[first]
+            self.traded_before[new] = 0
+            written = new[new < len(self.written_volume)]
+            self.traded_before[written] = self.written_volume[written]
+            self.traded[new] = self.traded_before[new]
+            self.seen[new] = True
+        rolled = positions[(self.snapshots[positions] > 0) & (self.start[positions] != bar_start)]
+        closed = self._take(rolled)
+        fresh = self.snapshots[positions] == 0
+        targets = positions[fresh]
+        self.start[targets] = bar_start
+        self.open[targets] = price[fresh]
+        self.high[targets] = price[fresh]
+        self.low[targets] = price[fresh]
+        self.high[positions] = np.maximum(self.high[positions], price)
+        self.low[positions] = np.minimum(self.low[positions], price)
+        self.close[positions] = price
+        self.open_interest[positions] = open_interest
+        self.traded[positions] = traded
+        self.snapshots[positions] += 1
+        return closed
+
+    def close_all(self) -> np.ndarray:
+        return self._take(np.flatnonzero(self.snapshots > 0).astype(np.int32))
+
+    def _take(self, positions: np.ndarray) -> np.ndarray:
+        bars = np.empty(len(positions), dtype=BAR_DTYPE)
+        if not len(positions):
+            return bars
+        bars["bar_start"] = self.start[positions]
+        bars["contract"] = positions
+        bars["open"] = self.open[positions]
+        bars["high"] = self.high[positions]
+        bars["low"] = self.low[positions]
+        bars["close"] = self.close[positions]
+        # the daily count never goes down, a correction is not negative volume
+        bars["volume"] = np.maximum(self.traded[positions] - self.traded_before[positions], 0)
+        bars["openInterest"] = self.open_interest[positions]
+        bars["snapshots"] = self.snapshots[positions]
+        self.traded_before[positions] = self.traded[positions]
+        self.snapshots[positions] = 0
+        return bars[np.argsort(bars["bar_start"], kind="stable")]
+
+
+# identifier table rows added and closed bars per resolution, to be appended to one day's files
+BarBatch = Tuple[BarDay, List[str], Dict[str, np.ndarray]]
+
+
+class BarAggregator:
+    # Bars in progress of every symbol. Each snapshot updates them in place,
+    # nothing already written is read again.
+
+    def __init__(self, data_directory: str, resolutions: List[str] = None, load: bool = True):
+        self.data_directory = data_directory
+        self.resolutions = {x: resolution_seconds(x) for x in (resolutions or bar_resolutions)}
+        self.load = load
+        self._days: Dict[str, BarDay] = {}
+        self._bars: Dict[str, Dict[str, _OpenBars]] = {}
+        self._lock = threading.Lock()
+
+    def update(self, symbol: str, chain: Chain, contracts: List[Contract]) -> List[BarBatch]:
+        # batches to append, the previous day's last bars first when the day changed
+        if not contracts:
+            return []
+        quote_timestamp = parse_quote_timestamp(chain.opt_timestamp)
+        day = datetime.datetime.fromtimestamp(quote_timestamp, _IST).date()
+        identifiers = [x.identifier for x in contracts] + [symbol]
+        count = len(contracts)
+        price = np.fromiter((x.lastPrice for x in contracts), dtype=np.float64, count=count)
+        traded = np.fromiter((x.numberOfContractsTraded for x in contracts), dtype=np.int64, count=count)
+        open_interest = np.fromiter((x.openInterest for x in contracts), dtype=np.int64, count=count)
+        price = np.append(price, chain.underlyingValue)
+        traded = np.append(traded, traded.sum())
+        open_interest = np.append(open_interest, open_interest.sum())
+        batches = []
+        with self._lock:
+            bar_day = self._days.get(symbol)
+            if bar_day is not None and bar_day.day != day:
+                batches.append(self._close(symbol))
+                bar_day = None
+            if bar_day is None:
+                bar_day = self._days[symbol] = BarDay(self.data_directory, symbol, day, self.load)
+                self._bars[symbol] = {x: _OpenBars(seconds, bar_day.written_volume(x))
+                                      for x, seconds in self.resolutions.items()}
+            if quote_timestamp <= bar_day.last_timestamp:
+                return batches
+            bar_day.last_timestamp = quote_timestamp
+            positions, added = bar_day.positions_for(identifiers)
+            closed = {resolution: bars.update(bar_day.session_open, quote_timestamp, positions, price, traded,
+                                              open_interest)
+                      for resolution, bars in self._bars[symbol].items()}
+        batches.append((bar_day, added, closed))
+        return batches
+
+    def close(self, symbol: Optional[str] = None) -> List[BarBatch]:
+        # every bar in progress, of one symbol or all of them, e.g. once the market closed
+        with self._lock:
+            return [self._close(x) for x in ([symbol] if symbol else list(self._days)) if x in self._days]
+
+    def _close(self, symbol: str) -> BarBatch:
+        bar_day = self._days.pop(symbol)
+        bars = self._bars.pop(symbol)
+        return bar_day, [], {resolution: x.close_all() for resolution, x in bars.items()}
+
+
+def read_bars(data_directory: str, symbol: str, day: str, resolution: str,
+              identifier: Optional[str] = None) -> Tuple[np.ndarray, List[str]]:
+    # closed bars of the day, optionally of one contract, with the identifier table
+    records_path, identifiers_path = bar_paths(data_directory, symbol, day, resolution)
+    identifiers = read_identifiers(identifiers_path)
+    if not os.path.exists(records_path) or os.path.getsize(records_path) < BAR_DTYPE.itemsize:
+        return np.empty(0, dtype=BAR_DTYPE), identifiers
+    count = os.path.getsize(records_path) // BAR_DTYPE.itemsize
+    bars = np.memmap(records_path, dtype=BAR_DTYPE, mode="r", shape=(count,))
+    # bars written before their identifier reached the table are left out
+    bars = bars[bars["contract"] < len(identifiers)]
+    if identifier is not None:
+        position = identifiers.index(identifier) if identifier in identifiers else -1
+        bars = bars[bars["contract"] == position]
+    return merge_bar_parts(bars), identifiers
+
+
+def merge_bar_parts(bars: np.ndarray) -> np.ndarray:
+    # A bar in progress is written as it is when the collector stops or hands
+    # the symbol to another process, and the rest of it once it closes. The
+    # parts of a (contract, bar_start) are merged in the order they were
+    # written: first open, last close and open interest, summed volume.
+    if len(bars) < 2:
+        return bars
+    order = np.lexsort((bars["bar_start"], bars["contract"]))
+    ordered = bars[order]
+    first = np.ones(len(ordered), dtype=bool)
+    first[1:] = (ordered["contract"][1:] != ordered["contract"][:-1]) | \
+                (ordered["bar_start"][1:] != ordered["bar_start"][:-1])
+    if first.all():
+        return bars
+    starts = np.flatnonzero(first)
+    ends = np.append(starts[1:], len(ordered)) - 1
+    merged = ordered[starts]
+    merged["high"] = np.maximum.reduceat(ordered["high"], starts)
+    merged["low"] = np.minimum.reduceat(ordered["low"], starts)
+    merged["close"] = ordered["close"][ends]
+    merged["openInterest"] = ordered["openInterest"][ends]
+    merged["volume"] = np.add.reduceat(ordered["volume"], starts)
+    merged["snapshots"] = np.add.reduceat(ordered["snapshots"], starts)
+    return merged[np.argsort(merged["bar_start"], kind="stable")]
+
+
+def rebuild_day(data_dir: str, symbol: str, day: str, resolutions: List[str],
+                option_types: frozenset) -> Tuple[int, int]:
+    # replaces the day's bar files with bars built from its raw snapshots,
+    # returns (snapshots parsed, bars written)
+    aggregator = BarAggregator(data_dir, resolutions, load=False)
+    identifiers: List[str] = []
+    bars: Dict[str, List[np.ndarray]] = {x: [] for x in aggregator.resolutions}
+    parsed = 0
+
+    def collect(batches: List[BarBatch]) -> None:
+        for _, added, closed in batches:
+            identifiers.extend(added)
+            for resolution, records in closed.items():
+                bars[resolution].append(records)
+
+    for _, raw in iter_raw_snapshots(data_dir, symbol, day):
+        try:
+            chain = parse_chain(json.loads(raw))
+            parse_quote_timestamp(chain.opt_timestamp)
+        except Exception:
+            # error pages and empty responses that were saved as snapshots
+            continue
+        parsed += 1
+        collect(aggregator.update(symbol, chain, [x for x in chain.contracts if x.instrumentType in option_types]))
+    collect(aggregator.close(symbol))
+    if not identifiers:
+        return parsed, 0
+    written = 0
+    for resolution, chunks in bars.items():
+        records = np.concatenate(chunks) if chunks else np.empty(0, dtype=BAR_DTYPE)
+        _replace(bar_paths(data_dir, symbol, day, resolution)[0], records.tobytes())
+        written += len(records)
+    _replace(bar_paths(data_dir, symbol, day, "")[1], ''.join(x + "\n" for x in identifiers).encode())
+    return parsed, written
+
+
+def _replace(target: str, data: bytes) -> None:
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    temporary = target + ".tmp"
+    with open(temporary, mode="wb") as f:
+        f.write(data)
+    os.replace(temporary, target)
+
+
+def rebuild(data_dir: str, shards: List[Tuple[str, str]], resolutions: List[str], workers: int) -> None:
+    # imported here, data_management picks its data directory at import
+    from data_management import option_instrument_types
+    started = time.time()
+    parsed = written = 0
+    # spawned: forking a process that runs threads isn't safe
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = {pool.submit(rebuild_day, data_dir, symbol, day, resolutions, option_instrument_types): (symbol, day)
+                   for symbol, day in shards}
+        for future in concurrent.futures.as_completed(futures):
+            symbol, day = futures[future]
+            day_parsed, day_written = future.result()
+            parsed += day_parsed
+            written += day_written
+            log.info("rebuilt bars", extra=fields(symbol=symbol, day=day, snapshots=day_parsed, bars=day_written))
+    log.info("bar rebuild done", extra=fields(days=len(shards), snapshots=parsed, bars=written,
+                                              seconds=round(time.time() - started, 1)))
+
+
+def main():
+    from data_management import data_directory
+    parser = argparse.ArgumentParser(description="Rebuild OHLC bars from raw snapshots")
+    parser.add_argument("--data-dir", default=data_directory)
+    parser.add_argument("--symbols", nargs="*", help="defaults to every symbol under the data directory")
+    parser.add_argument("--from", dest="first_day", help="first day, YYYY-MM-DD")
+    parser.add_argument("--to", dest="last_day", help="last day, YYYY-MM-DD")
+    parser.add_argument("--resolutions", nargs="*", default=bar_resolutions)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+    configure_logging()
+    for resolution in args.resolutions:
+        resolution_seconds(resolution)
+    data_dir = os.path.abspath(args.data_dir)
+    symbols = args.symbols or sorted(x for x in os.listdir(data_dir)
+                                     if not x.startswith(".") and os.path.isdir(os.path.join(data_dir, x)))
+    shards = [(symbol, day) for symbol in symbols for day in raw_snapshot_days(data_dir, symbol)
+              if (args.first_day is None or day >= args.first_day) and (args.last_day is None or day <= args.last_day)]
+    log.info("bar rebuild starting", extra=fields(data_dir=data_dir, days=len(shards), workers=args.workers,
+                                                  resolutions=",".join(args.resolutions)))
+    rebuild(data_dir, shards, args.resolutions, args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+# Copyright 2022 Rohit Sood
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Runs full collector cycles against the stub NSE server, no network needed.
+# Every scenario runs in a fresh process and scratch directory, so peak RSS and
+# file handles are per scenario. Run from the repository root:
+#   python -m benchmarks.collector_benchmark [--symbols 30 200 1000] [--cycles 3] [--latency 150]
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import socket
+import sys
+import time
+from typing import Any, Dict, List
+from benchmarks.report import peak_rss_mb, scratch_directory, timing_line
+from benchmarks.stub_server import StubConfig, load_fixtures, serve
+
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def scenario_symbols(count: int) -> List[str]:
+    # the configured stock list first, padded with made up stock symbols
+    with open(os.path.join(repo_root, "stock_list.txt")) as f:
+        symbols = [str.strip(line) for line in f if str.strip(line)]
+    symbols = list(dict.fromkeys(symbols))[:count]
+    return symbols + [f"STOCK{i:04d}" for i in range(count - len(symbols))]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def _run_cycles(symbols: List[str], cycles: int, warmup: int) -> Dict[str, Any]:
+    # imported here: the collector modules read their configuration at import
+    import metrics
+    import utility
+    from fetch_engine import get_engine
+
+    latencies: List[float] = []
+    failures = 0
+    fetch_quote = utility.fetch_quote
+
+    async def timed_fetch_quote(symbol, engine=None, deadline=None):
+        nonlocal failures
+        started = time.perf_counter()
+        try:
+            if await fetch_quote(symbol, engine, deadline) is None:
+                failures += 1
+        except Exception:
+            failures += 1
+            raise
+        finally:
+            latencies.append(time.perf_counter() - started)
+
+    utility.fetch_quote = timed_fetch_quote
+    engine = get_engine()
+    cycle_times: List[float] = []
+    rows_before = 0.0
+    try:
+        for cycle in range(warmup + cycles):
+            if cycle == warmup:
+                latencies.clear()
+                failures = 0
+                rows_before = metrics.rows_written_total.total()
+            started = time.perf_counter()
+            await utility.run_collector_cycle(symbols, engine)
+            if cycle >= warmup:
+                cycle_times.append(time.perf_counter() - started)
+    finally:
+        utility.fetch_quote = fetch_quote
+        await engine.close()
+        await utility.pipeline.close()
+    return {"cycle_times": cycle_times, "latencies": latencies, "failures": failures,
+            "rows": metrics.rows_written_total.total() - rows_before}
+
+
+def run_scenario(symbols: List[str], cycles: int, warmup: int, environ: Dict[str, str], results) -> None:
+    sys.path.insert(0, repo_root)
+    with scratch_directory(environ):
+        import logging
+        # failed quotes are counted, not printed
+        logging.getLogger("datapi").setLevel(logging.CRITICAL)
+        result = asyncio.run(_run_cycles(symbols, cycles, warmup))
+        result["peak_rss_mb"] = peak_rss_mb()
+    results.put(result)
+
+
+def report(count: int, result: Dict[str, Any]) -> None:
+    cycle_times, latencies = result["cycle_times"], result["latencies"]
+    elapsed = sum(cycle_times)
+    print(f"--- {count} symbols, {len(cycle_times)} cycles")
+    print(timing_line("cycle", cycle_times))
+    print(timing_line("quote (fetch + save)", latencies))
+    print(f"{'throughput':<22} {len(latencies) / elapsed:9.1f} symbols/s  {result['rows'] / elapsed:11.0f} rows/s")
+    print(f"{'failed quotes':<22} {result['failures']}")
+    print(f"{'peak RSS':<22} {result['peak_rss_mb']:9.1f}MB")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--symbols", type=int, nargs="+", default=[30, 200, 1000])
+    parser.add_argument("--cycles", type=int, default=3)
+    parser.add_argument("--warmup", type=int, default=1, help="cycles run first and left out of the numbers")
+    parser.add_argument("--fixtures", help="directory of <SYMBOL>.json files or a collector data directory")
+    parser.add_argument("--latency", type=float, default=150.0, help="mean stub response latency in ms")
+    parser.add_argument("--jitter", type=float, default=50.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--forbidden-rate", type=float, default=0.0)
+    parser.add_argument("--max-in-flight", type=int, default=0, help="stub answers 429 beyond this many requests")
+    parser.add_argument("--storage-format", default="csv", choices=("csv", "columnar", "both"))
+    parser.add_argument("--snapshot-format", default="files", choices=("files", "archive"))
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    port = free_port()
+    config = StubConfig(args.latency, args.jitter, args.error_rate, args.forbidden_rate, args.max_in_flight)
+    fixtures = load_fixtures(args.fixtures) if args.fixtures else {}
+    stub = context.Process(target=serve, args=(config, fixtures, "127.0.0.1", port), daemon=True)
+    stub.start()
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+    # the stub serves the same payload every cycle, with change detection
+    # on nothing after the warmup would reach the contract files
+    environ = {"DEBUG": "False", "NSE_BASE_URL": f"http://127.0.0.1:{port}",
+               "STORAGE_FORMAT": args.storage_format, "SNAPSHOT_FORMAT": args.snapshot_format,
+               "CHANGE_DETECTION": "False"}
+    print(f"stub latency {args.latency}±{args.jitter}ms, error rate {args.error_rate}, "
+          f"{len(fixtures)} recorded symbols, storage {args.storage_format}, snapshots {args.snapshot_format}")
+    try:
+        for count in args.symbols:
+            results = context.Queue()
+            scenario = context.Process(target=run_scenario,
+                                       args=(scenario_symbols(count), args.cycles, args.warmup, environ, results))
+            scenario.start()
+            result = results.get()
+            scenario.join()
+            report(count, result)
+    finally:
+        stub.terminate()
+
+
+if __name__ == "__main__":
+    main()
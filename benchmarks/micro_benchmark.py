@@ -0,0 +1,88 @@
+# Copyright 2022 Rohit Sood
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Times the per-snapshot hot spots in isolation on one payload: Root.from_dict,
+# save_data (parse and buffer every row) and write_strike_data per contract,
+# each followed by the flush that puts the rows on disk. Run from the
+# repository root:
+#   python -m benchmarks.micro_benchmark [--symbol NIFTY] [--fixture data/NIFTY.json] [--repeat 50]
+
+import argparse
+import json
+import time
+from typing import Callable, List
+from benchmarks.report import peak_rss_mb, scratch_directory, timing_line
+from benchmarks.stub_server import synthetic_payload
+
+
+def measure(run: Callable[[], None], repeat: int) -> List[float]:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--symbol", default="NIFTY")
+    parser.add_argument("--fixture", help="recorded quote-derivative payload, synthetic when omitted")
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+    if args.fixture:
+        with open(args.fixture) as f:
+            raw = f.read()
+    else:
+        raw = synthetic_payload(args.symbol)
+    payload = json.loads(raw)
+
+    with scratch_directory({"DEBUG": "False"}):
+        # imported here: data_management resolves its data directory at import
+        import data_management
+        from option_class import Root
+        root = Root.from_dict(payload)
+        options = [x for x in root.stocks if x.metadata.instrumentType in data_management.option_instrument_types]
+        print(f"{args.symbol}: payload {round(len(raw) / 1e6, 2)}MB, {len(root.stocks)} contracts, "
+              f"{len(options)} options")
+
+        results = [timing_line("Root.from_dict", measure(lambda: Root.from_dict(payload), args.repeat))]
+
+        data_management.save_data(args.symbol, raw)
+        data_management.flush_strike_data()
+
+        def save_snapshot():
+            # the same payload again would be skipped as unchanged
+            data_management.change_detector.reset()
+            data_management.save_data(args.symbol, raw)
+        results.append(timing_line("save_data", measure(save_snapshot, args.repeat)))
+        results.append(timing_line("  flush", measure(data_management.flush_strike_data, 1)))
+
+        paths = [data_management.get_expiry_path(args.symbol, x.metadata.expiryDate, x.metadata.identifier)
+                 for x in options]
+
+        def write_chain():
+            for strike_path, x in zip(paths, options):
+                data_management.write_strike_data(strike_path, x.metadata, x.marketDeptOrderBook,
+                                                  x.underlyingValue, root.opt_timestamp)
+        results.append(timing_line("write_strike_data x" + str(len(options)), measure(write_chain, args.repeat)))
+        results.append(timing_line("  flush", measure(data_management.flush_strike_data, 1)))
+        data_management.close_strike_data()
+    for line in results:
+        print(line)
+    print(f"{'peak RSS':<22} {peak_rss_mb():9.1f}MB")
+
+
+if __name__ == "__main__":
+    main()
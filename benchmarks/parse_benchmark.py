@@ -0,0 +1,61 @@
+# Copyright 2022 Rohit Sood
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Compares Root.from_dict with chain_parser.parse_chain on one NIFTY sized
+# snapshot. Run from the repository root:
+#   python -m benchmarks.parse_benchmark [--expiries 4] [--strikes 100] [--repeat 20]
+
+import argparse
+import json
+import time
+import tracemalloc
+from chain_parser import parse_chain
+from option_class import Root
+from benchmarks.synthetic_chain import synthetic_chain
+
+
+def measure(parse, payload, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        parse(payload)
+        timings.append(time.perf_counter() - start)
+    tracemalloc.start()
+    result = parse(payload)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    timings.sort()
+    return timings[len(timings) // 2], peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--expiries", type=int, default=4)
+    parser.add_argument("--strikes", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    raw = json.dumps(synthetic_chain(expiries=args.expiries, strikes=args.strikes))
+    payload = json.loads(raw)
+    print(f"payload {round(len(raw) / 1e6, 2)}MB, {len(payload['stocks'])} contracts")
+    full_time, full_peak = measure(Root.from_dict, payload, args.repeat)
+    fast_time, fast_peak = measure(parse_chain, payload, args.repeat)
+    print(f"Root.from_dict  {round(full_time * 1000, 2)}ms  peak {round(full_peak / 1e6, 2)}MB")
+    print(f"parse_chain     {round(fast_time * 1000, 2)}ms  peak {round(fast_peak / 1e6, 2)}MB")
+    print(f"saved           {round((full_time - fast_time) * 1000, 2)}ms ({round(full_time / fast_time, 1)}x)  "
+          f"{round((full_peak - fast_peak) / 1e6, 2)}MB per snapshot")
+
+
+if __name__ == "__main__":
+    main()
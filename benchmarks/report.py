@@ -0,0 +1,55 @@
+# Copyright 2022 Rohit Sood
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import contextlib
+import os
+import resource
+import shutil
+import sys
+import tempfile
+from typing import Dict, Iterator, List
+
+
+def percentile(timings: List[float], q: float) -> float:
+    # nearest rank on a sorted copy, q in [0, 100]
+    if not timings:
+        return float("nan")
+    ordered = sorted(timings)
+    return ordered[min(len(ordered) - 1, max(0, int(round(q / 100 * len(ordered))) - 1))]
+
+
+def peak_rss_mb() -> float:
+    # high water mark of this process, ru_maxrss is KB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def timing_line(name: str, timings: List[float]) -> str:
+    return (f"{name:<22} n={len(timings):<6} p50 {percentile(timings, 50) * 1000:9.3f}ms  "
+            f"p99 {percentile(timings, 99) * 1000:9.3f}ms  max {max(timings, default=0) * 1000:9.3f}ms")
+
+
+@contextlib.contextmanager
+def scratch_directory(environ: Dict[str, str]) -> Iterator[str]:
+    # the collector writes relative to the working directory, so every run
+    # gets an empty one that is removed afterwards
+    previous = os.getcwd()
+    directory = tempfile.mkdtemp(prefix="datapi-bench-")
+    os.environ.update(environ)
+    os.chdir(directory)
+    try:
+        yield directory
+    finally:
+        os.chdir(previous)
+        shutil.rmtree(directory, ignore_errors=True)
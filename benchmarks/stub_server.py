@@ -0,0 +1,161 @@
+# Copyright 2022 Rohit Sood
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Local stand-in for www.nseindia.com: the homepage hands out cookies and
+# /api/quote-derivative replays recorded payloads, or synthetic ones of the same
+# size for symbols without a recording. Point the collector at it with
+# NSE_BASE_URL=http://127.0.0.1:8099. Run from the repository root:
+#   python -m benchmarks.stub_server [--port 8099] [--fixtures data] [--latency 150] [--error-rate 0.01]
+
+import argparse
+import asyncio
+import glob
+import json
+import os
+import random
+from dataclasses import dataclass
+from typing import Dict, Optional
+from aiohttp import web
+from benchmarks.synthetic_chain import synthetic_chain
+from snapshot_archive import iter_raw_snapshots, raw_snapshot_days
+
+
+# Index chains carry many more strikes than stock chains
+index_symbols = frozenset(("NIFTY", "BANKNIFTY", "FINNIFTY", "MIDCPNIFTY"))
+
+
+@dataclass
+class StubConfig:
+    # latency is drawn uniformly from latency_ms +- jitter_ms per request
+    latency_ms: float = 150.0
+    jitter_ms: float = 50.0
+    # share of quote requests answered with a 503 HTML error page
+    error_rate: float = 0.0
+    # share of quote requests rejected with a 401, as NSE does for stale cookies
+    forbidden_rate: float = 0.0
+    # quote requests beyond this many in flight get a 429, 0 for no limit
+    max_in_flight: int = 0
+    seed: int = 0
+
+
+def load_fixtures(directory: str) -> Dict[str, str]:
+    # <SYMBOL>.json files, or a collector data directory: the latest raw
+    # snapshot of every symbol, from per-fetch files, day archives or packs
+    fixtures: Dict[str, str] = {}
+    for file_path in sorted(glob.glob(os.path.join(directory, "*.json"))):
+        with open(file_path) as f:
+            fixtures[os.path.basename(file_path)[:-len(".json")].upper()] = f.read()
+    if fixtures:
+        return fixtures
+    for symbol_path in sorted(glob.glob(os.path.join(directory, "*", ""))):
+        symbol = os.path.basename(os.path.dirname(symbol_path))
+        days = raw_snapshot_days(directory, symbol)
+        if days:
+            for _, raw in iter_raw_snapshots(directory, symbol, days[-1]):
+                fixtures[symbol] = raw
+    return fixtures
+
+
+def synthetic_payload(symbol: str, seed: int = 0) -> str:
+    if symbol in index_symbols:
+        return json.dumps(synthetic_chain(symbol, expiries=4, strikes=100, seed=seed))
+    return json.dumps(synthetic_chain(symbol, expiries=3, strikes=40, underlying=2450.0, step=20, seed=seed))
+
+
+class StubNse:
+
+    def __init__(self, config: StubConfig = None, fixtures: Optional[Dict[str, str]] = None):
+        self.config = config or StubConfig()
+        self.fixtures = dict(fixtures or {})
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+        self._in_flight = 0
+        self._rng = random.Random(self.config.seed)
+
+    def payload(self, symbol: str) -> str:
+        raw = self.fixtures.get(symbol)
+        if raw is None:
+            raw = self.fixtures[symbol] = synthetic_payload(symbol, self.config.seed)
+        return raw
+
+    async def _delay(self) -> None:
+        latency = self.config.latency_ms + self._rng.uniform(-self.config.jitter_ms, self.config.jitter_ms)
+        await asyncio.sleep(max(0.0, latency) / 1000)
+
+    async def homepage(self, request: web.Request) -> web.Response:
+        await self._delay()
+        response = web.Response(text="<html></html>", content_type="text/html")
+        response.set_cookie("nsit", "stub")
+        response.set_cookie("nseappid", "stub")
+        return response
+
+    async def quote_derivative(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        symbol = request.query.get("symbol", "").upper()
+        if self.config.max_in_flight and self._in_flight >= self.config.max_in_flight:
+            self.throttled += 1
+            return web.Response(status=429, text="<html>Too Many Requests</html>", content_type="text/html")
+        self._in_flight += 1
+        try:
+            await self._delay()
+        finally:
+            self._in_flight -= 1
+        roll = self._rng.random()
+        if roll < self.config.error_rate:
+            self.errors += 1
+            return web.Response(status=503, text="<html>Resource not available</html>", content_type="text/html")
+        if roll < self.config.error_rate + self.config.forbidden_rate:
+            self.errors += 1
+            return web.Response(status=401, text="{}", content_type="application/json")
+        return web.Response(text=self.payload(symbol), content_type="application/json")
+
+    def application(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/", self.homepage)
+        app.router.add_get("/api/quote-derivative", self.quote_derivative)
+        return app
+
+
+async def start_stub_server(stub: StubNse, host: str = "127.0.0.1", port: int = 8099) -> web.AppRunner:
+    runner = web.AppRunner(stub.application(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+def serve(config: StubConfig, fixtures: Dict[str, str], host: str, port: int) -> None:
+    # blocking, for running the stub in its own process next to the collector
+    web.run_app(StubNse(config, fixtures).application(), host=host, port=port, access_log=None, print=None)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--fixtures", help="directory of <SYMBOL>.json files or a collector data directory")
+    parser.add_argument("--latency", type=float, default=150.0, help="mean response latency in ms")
+    parser.add_argument("--jitter", type=float, default=50.0, help="latency spread in ms")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--forbidden-rate", type=float, default=0.0)
+    parser.add_argument("--max-in-flight", type=int, default=0, help="answer 429 beyond this many requests")
+    args = parser.parse_args()
+    fixtures = load_fixtures(args.fixtures) if args.fixtures else {}
+    print(f"stub NSE on http://{args.host}:{args.port} with {len(fixtures)} recorded symbols")
+    serve(StubConfig(args.latency, args.jitter, args.error_rate, args.forbidden_rate, args.max_in_flight), fixtures,
+          args.host, args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+# Copyright 2022 Rohit Sood
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import datetime
+import random
+from typing import Any, Dict
+
+
+# Generates quote-derivative payloads with the same shape as the NSE response,
+# sized like a real chain: an index chain is ~4 expiries x ~100 strikes x 2 sides.
+
+def _contract(symbol: str, instrument_type: str, expiry: str, option_type: str, strike: int,
+              underlying: float, rng: random.Random) -> Dict[str, Any]:
+    intrinsic = max(0.0, underlying - strike) if option_type == "Call" else max(0.0, strike - underlying)
+    last_price = round(intrinsic + rng.uniform(0.05, 150.0), 2)
+    side = "CE" if option_type == "Call" else "PE"
+    prefix = "OPTIDX" if instrument_type == "Index Options" else "OPTSTK"
+    return {
+        "metadata": {
+            "instrumentType": instrument_type, "expiryDate": expiry, "optionType": option_type,
+            "strikePrice": strike, "identifier": f"{prefix}{symbol}{expiry}{side}{strike}.00",
+            "openPrice": last_price, "highPrice": round(last_price * 1.1, 2), "lowPrice": round(last_price * 0.9, 2),
+            "closePrice": 0, "prevClose": last_price, "lastPrice": last_price,
+            "change": round(rng.uniform(-20, 20), 2), "pChange": round(rng.uniform(-30, 30), 2),
+            "numberOfContractsTraded": rng.randint(0, 500000), "totalTurnover": rng.uniform(0, 1e9),
+        },
+        "underlyingValue": underlying,
+        "volumeFreezeQuantity": 2801,
+        "marketDeptOrderBook": {
+            "totalBuyQuantity": rng.randint(0, 5000000), "totalSellQuantity": rng.randint(0, 5000000),
+            "bid": [{"price": round(max(0.05, last_price - 0.05 * i), 2), "quantity": 50 * rng.randint(1, 200)}
+                    for i in range(5)],
+            "ask": [{"price": round(last_price + 0.05 * (i + 1), 2), "quantity": 50 * rng.randint(1, 200)}
+                    for i in range(5)],
+            "carryOfCost": {"price": {"bestBuy": last_price, "bestSell": last_price, "lastPrice": last_price},
+                            "carry": {"bestBuy": 0, "bestSell": 0, "lastPrice": 0}},
+            "tradeInfo": {"tradedVolume": rng.randint(0, 500000), "value": rng.uniform(0, 1e5), "vmap": last_price,
+                          "premiumTurnover": rng.uniform(0, 1e9), "openInterest": rng.randint(0, 2000000),
+                          "changeinOpenInterest": rng.randint(-100000, 100000),
+                          "pchangeinOpenInterest": round(rng.uniform(-50, 50), 2), "marketLot": 50},
+            "otherInfo": {"settlementPrice": 0, "dailyvolatility": 1.05, "annualisedVolatility": 20.06,
+                          "impliedVolatility": round(rng.uniform(0, 40), 2), "clientWisePositionLimits": 0,
+                          "marketWidePositionLimits": 0},
+        },
+    }
+
+
+def synthetic_chain(symbol: str = "NIFTY", expiries: int = 4, strikes: int = 100, underlying: float = 17850.55,
+                    step: int = 50, when: datetime.datetime = None, seed: int = 0) -> Dict[str, Any]:
+    rng = random.Random(seed)
+    when = when or datetime.datetime(2022, 8, 18, 15, 30)
+    index = symbol in ("NIFTY", "BANKNIFTY", "FINNIFTY", "MIDCPNIFTY")
+    instrument_type = "Index Options" if index else "Stock Options"
+    expiry_dates = [(when.date() + datetime.timedelta(days=7 * (i + 1))).strftime("%d-%b-%Y") for i in range(expiries)]
+    atm = int(underlying // step * step)
+    strike_prices = [atm + (i - strikes // 2) * step for i in range(strikes)]
+    stocks = [_contract(symbol, "Index Futures" if index else "Stock Futures", expiry, "-", 0, underlying, rng)
+              for expiry in expiry_dates[:3]]
+    for expiry in expiry_dates:
+        for strike in strike_prices:
+            for option_type in ("Call", "Put"):
+                stocks.append(_contract(symbol, instrument_type, expiry, option_type, strike, underlying, rng))
+    timestamp = when.strftime("%d-%b-%Y %H:%M:%S")
+    return {
+        "info": {"symbol": symbol, "companyName": symbol, "industry": "-", "activeSeries": [], "debtSeries": [],
+                 "tempSuspendedSeries": [], "isFNOSec": True, "isCASec": False, "isSLBSec": False,
+                 "isDebtSec": False, "isSuspended": False, "isETFSec": False, "isDelisted": False, "isin": "-"},
+        "underlyingValue": underlying,
+        "vfq": 2801,
+        "fut_timestamp": timestamp,
+        "opt_timestamp": timestamp,
+        "stocks": stocks,
+        # NSE repeats strikes and expiries once per contract, 0 for futures
+        "strikePrices": [0] + [x["metadata"]["strikePrice"] for x in stocks],
+        "expiryDates": [x["metadata"]["expiryDate"] for x in stocks],
+    }
@@ -0,0 +1,128 @@
+# Copyright 2022 Rohit Sood
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import json
+from operator import attrgetter
+from typing import Any, Dict, Iterable, List, Tuple
+import numpy as np
+
+
+# Fast path for the quote-derivative payload: only the fields that are stored
+# are read, straight into flat __slots__ objects. option_class.Root is still
+# the full model for callers that need everything.
+
+# Numeric fields of a contract row, in CSV order after quote_timestamp
+SERIES_FIELDS = ("underlyingValue", "openPrice", "highPrice", "lowPrice", "closePrice", "lastPrice",
+                 "change", "pChange", "numberOfContractsTraded", "totalBuyQuantity", "totalSellQuantity",
+                 "vmap", "openInterest", "changeinOpenInterest", "pchangeinOpenInterest",
+                 "dailyvolatility", "impliedVolatility")
+# Order book levels per side in the payload
+depth_levels = 5
+_no_levels = [{"price": 0.0, "quantity": 0}] * depth_levels
+
+
+class Contract:
+    __slots__ = ("instrumentType", "expiryDate", "optionType", "strikePrice", "identifier") + SERIES_FIELDS
+
+    def csv_row(self, quote_timestamp: str) -> str:
+        # same text as data_management.write_strike_data
+        return ','.join([quote_timestamp, str(self.underlyingValue), str(self.openPrice), str(self.highPrice),
+                         str(self.lowPrice), str(self.closePrice), str(self.lastPrice), str(self.change),
+                         str(self.pChange), str(self.numberOfContractsTraded), str(self.totalBuyQuantity),
+                         str(self.totalSellQuantity), str(self.vmap), str(self.openInterest),
+                         str(self.changeinOpenInterest), str(self.pchangeinOpenInterest),
+                         str(self.dailyvolatility), str(self.impliedVolatility), "\n"])
+
+
+class Chain:
+    # depth_prices and depth_quantities are (contracts, 2 sides, 5 levels)
+    # arrays aligned with contracts, bid side first, or None
+    __slots__ = ("symbol", "underlyingValue", "fut_timestamp", "opt_timestamp",
+                 "contracts", "strikePrices", "expiryDates", "depth_prices", "depth_quantities")
+
+
+def parse_contract(obj: Dict[str, Any]) -> Contract:
+    metadata = obj["metadata"]
+    order_book = obj["marketDeptOrderBook"]
+    trade_info = order_book["tradeInfo"]
+    other_info = order_book["otherInfo"]
+    contract = Contract()
+    contract.instrumentType = str(metadata["instrumentType"])
+    contract.expiryDate = str(metadata["expiryDate"])
+    contract.optionType = str(metadata["optionType"])
+    contract.strikePrice = int(metadata["strikePrice"])
+    contract.identifier = str(metadata["identifier"])
+    contract.underlyingValue = float(obj["underlyingValue"])
+    contract.openPrice = float(metadata["openPrice"])
+    contract.highPrice = float(metadata["highPrice"])
+    contract.lowPrice = float(metadata["lowPrice"])
+    contract.closePrice = int(metadata["closePrice"])
+    contract.lastPrice = float(metadata["lastPrice"])
+    contract.change = float(metadata["change"])
+    contract.pChange = float(metadata["pChange"])
+    contract.numberOfContractsTraded = int(metadata["numberOfContractsTraded"])
+    contract.totalBuyQuantity = int(order_book["totalBuyQuantity"])
+    contract.totalSellQuantity = int(order_book["totalSellQuantity"])
+    contract.vmap = float(trade_info["vmap"])
+    contract.openInterest = int(trade_info["openInterest"])
+    contract.changeinOpenInterest = int(trade_info["changeinOpenInterest"])
+    contract.pchangeinOpenInterest = float(trade_info["pchangeinOpenInterest"])
+    contract.dailyvolatility = float(other_info["dailyvolatility"])
+    contract.impliedVolatility = float(other_info["impliedVolatility"])
+    return contract
+
+
+def parse_chain(obj: Dict[str, Any], depth: bool = False) -> Chain:
+    chain = Chain()
+    chain.symbol = str(obj["info"]["symbol"])
+    chain.underlyingValue = float(obj["underlyingValue"])
+    chain.fut_timestamp = str(obj.get("fut_timestamp"))
+    chain.opt_timestamp = str(obj.get("opt_timestamp"))
+    chain.contracts = [parse_contract(y) for y in obj["stocks"]]
+    # order preserving dedupe, 0 is the futures placeholder
+    chain.strikePrices = [x for x in dict.fromkeys(obj["strikePrices"]) if x != 0]
+    chain.expiryDates = list(dict.fromkeys(obj["expiryDates"]))
+    chain.depth_prices = chain.depth_quantities = None
+    if depth:
+        chain.depth_prices, chain.depth_quantities = parse_depth(obj["stocks"])
+    return chain
+
+
+def parse_payload(raw: str, depth: bool = False) -> Chain:
+    # the whole step from response text, e.g. in a worker process
+    return parse_chain(json.loads(raw), depth)
+
+
+def parse_depth(stocks: List[Dict[str, Any]]) -> Tuple[np.ndarray, np.ndarray]:
+    # bid and ask levels of every contract straight into two flat arrays,
+    # missing levels are zero
+    prices: List[float] = []
+    quantities: List[int] = []
+    for y in stocks:
+        order_book = y["marketDeptOrderBook"]
+        for side in (order_book.get("bid") or _no_levels, order_book.get("ask") or _no_levels):
+            levels = side[:depth_levels]
+            if len(levels) < depth_levels:
+                levels = levels + _no_levels[len(levels):]
+            prices.extend([level["price"] for level in levels])
+            quantities.extend([level["quantity"] for level in levels])
+    shape = (len(stocks), 2, depth_levels)
+    return (np.array(prices, dtype=np.float32).reshape(shape),
+            np.array(quantities, dtype=np.int32).reshape(shape))
+
+
+def chain_columns(contracts: List[Contract], fields: Iterable[str] = SERIES_FIELDS) -> Dict[str, np.ndarray]:
+    # one float64 array per field, aligned with contracts
+    return {name: np.fromiter(map(attrgetter(name), contracts), dtype=np.float64, count=len(contracts))
+            for name in fields}
@@ -0,0 +1,91 @@
+# Copyright 2022 Rohit Sood
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import os
+import threading
+from array import array
+from operator import attrgetter
+from typing import Dict, List
+from chain_parser import SERIES_FIELDS, Contract
+
+
+# Only rows whose contract changed are stored, readers forward-fill the gaps
+skip_unchanged_rows = os.environ.get("CHANGE_DETECTION", "True") == "True"
+# A row is stored at least this often even if nothing changed, 0 never forces one
+heartbeat_in_seconds = int(os.environ.get("CHANGE_HEARTBEAT_MINUTES", "15")) * 60
+
+# Fields that decide whether a contract changed. underlyingValue and the
+# underlying's daily volatility move on every snapshot for every contract,
+# they are stored with the rows that are written but don't trigger one.
+tracked_fields = tuple(name for name in SERIES_FIELDS if name not in ("underlyingValue", "dailyvolatility"))
+
+
+class ChangeDetector:
+    # Per contract identifier: a 64 bit hash of the tracked fields and the
+    # quote timestamp of the last stored row, kept in flat arrays.
+
+    def __init__(self, heartbeat: int = heartbeat_in_seconds):
+        self.heartbeat = heartbeat
+        self._slots: Dict[str, int] = {}
+        # identifiers per symbol, for forget
+        self._symbols: Dict[str, List[str]] = {}
+        self._fingerprints = array('q')
+        self._written_at = array('q')
+        self._state = attrgetter(*tracked_fields)
+        self._lock = threading.Lock()
+
+    def changed(self, contract: Contract, quote_timestamp: int, symbol: str = '') -> bool:
+        # True when the row has to be stored, the contract is then remembered as written
+        fingerprint = hash(self._state(contract))
+        with self._lock:
+            slot = self._slots.get(contract.identifier)
+            if slot is None:
+                self._slots[contract.identifier] = len(self._fingerprints)
+                self._symbols.setdefault(symbol, []).append(contract.identifier)
+                self._fingerprints.append(fingerprint)
+                self._written_at.append(quote_timestamp)
+                return True
+            if quote_timestamp <= self._written_at[slot]:
+                # same snapshot time as the stored row
+                return False
+            if self._fingerprints[slot] == fingerprint and \
+                    (self.heartbeat <= 0 or quote_timestamp - self._written_at[slot] < self.heartbeat):
+                return False
+            self._fingerprints[slot] = fingerprint
+            self._written_at[slot] = quote_timestamp
+            return True
+
+    def reset(self) -> None:
+        # forget every contract, the next snapshot is stored in full
+        with self._lock:
+            self._slots = {}
+            self._symbols = {}
+            self._fingerprints = array('q')
+            self._written_at = array('q')
+
+    def forget(self, symbol: str) -> None:
+        # forget the symbol's contracts, e.g. once another process writes its rows
+        with self._lock:
+            identifiers = self._symbols.pop(symbol, [])
+            for identifier in identifiers:
+                self._slots.pop(identifier, None)
+            if not identifiers:
+                return
+            kept = sorted(self._slots.items(), key=lambda x: x[1])
+            self._fingerprints = array('q', (self._fingerprints[slot] for _, slot in kept))
+            self._written_at = array('q', (self._written_at[slot] for _, slot in kept))
+            self._slots = {identifier: i for i, (identifier, _) in enumerate(kept)}
+
+    def __len__(self) -> int:
+        return len(self._slots)
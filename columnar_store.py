@@ -0,0 +1,87 @@
+# Copyright 2022 Rohit Sood
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import datetime
+import os
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional
+from zoneinfo import ZoneInfo
+import numpy as np
+from chain_parser import Contract, chain_columns
+
+
+# File suffix of the binary series next to the CSV of the same contract
+columnar_suffix = ".bin"
+
+# One fixed-width record per contract per snapshot, same fields and order as
+# the CSV layout. quote_timestamp is epoch seconds.
+RECORD_DTYPE = np.dtype([
+    ("quote_timestamp", "<i8"),
+    ("underlyingValue", "<f8"),
+    ("openPrice", "<f4"),
+    ("highPrice", "<f4"),
+    ("lowPrice", "<f4"),
+    ("closePrice", "<f4"),
+    ("lastPrice", "<f4"),
+    ("change", "<f4"),
+    ("pChange", "<f4"),
+    ("numberOfContractsTraded", "<i8"),
+    ("totalBuyQuantity", "<i8"),
+    ("totalSellQuantity", "<i8"),
+    ("vmap", "<f4"),
+    ("openInterest", "<i8"),
+    ("changeinOpenInterest", "<i8"),
+    ("pchangeinOpenInterest", "<f4"),
+    ("dailyvolatility", "<f4"),
+    ("impliedVolatility", "<f4"),
+])
+
+_IST = ZoneInfo("Asia/Kolkata")
+
+
+@lru_cache(maxsize=4096)
+def parse_quote_timestamp(quote_timestamp: str) -> int:
+    # NSE timestamps look like 18-Aug-2022 15:30:00 and are in IST
+    parsed = datetime.datetime.strptime(quote_timestamp, "%d-%b-%Y %H:%M:%S")
+    return int(parsed.replace(tzinfo=_IST).timestamp())
+
+
+def build_records(contracts: List[Contract], quote_timestamp: str) -> np.ndarray:
+    records = np.empty(len(contracts), dtype=RECORD_DTYPE)
+    records["quote_timestamp"] = parse_quote_timestamp(quote_timestamp)
+    for name, column in chain_columns(contracts).items():
+        records[name] = column
+    return records
+
+
+def split_records(records: np.ndarray) -> List[bytes]:
+    # encoded bytes of every record, ready to be appended to its contract file
+    buffer = records.tobytes()
+    size = RECORD_DTYPE.itemsize
+    return [buffer[i:i + size] for i in range(0, len(buffer), size)]
+
+
+def read_series(path: str) -> np.ndarray:
+    # memory mapped, nothing is copied until a field is actually used
+    if not os.path.exists(path) or os.path.getsize(path) < RECORD_DTYPE.itemsize:
+        return np.empty(0, dtype=RECORD_DTYPE)
+    # a record that is still being appended is left out
+    count = os.path.getsize(path) // RECORD_DTYPE.itemsize
+    return np.memmap(path, dtype=RECORD_DTYPE, mode="r", shape=(count,))
+
+
+def read_columns(path: str, fields: Optional[Iterable[str]] = None) -> Dict[str, np.ndarray]:
+    # field views into the mapped file, zero-copy
+    series = read_series(path)
+    return {name: series[name] for name in (fields or RECORD_DTYPE.names)}
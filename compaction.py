@@ -0,0 +1,209 @@
+# Copyright 2022 Rohit Sood
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Folds the per-fetch snapshot files of a finished day, data/<symbol>/<date>/<HHMMSSffffff>,
+# into one data/<symbol>/<date>.pack: the compressed snapshots in time order,
+# their index and a footer pointing at the index (see snapshot_archive). The
+# collector runs it after the market closes; it can also be run by hand:
+#   DEBUG=False python compaction.py [--symbols NIFTY BANKNIFTY] [--workers 8]
+#
+# A day is compacted by one task on a process pool, per symbol:
+#   1. the pack is written next to the day as <date>.pack.tmp and synced
+#   2. every snapshot is read back from it and checked against its file
+#   3. os.replace puts the pack in place, readers prefer it from then on
+#   4. the day directory is renamed away in one step, then deleted
+# A failure before 3 leaves the day as it was.
+
+import argparse
+import concurrent.futures
+import datetime
+import hashlib
+import multiprocessing
+import os
+import shutil
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+from zoneinfo import ZoneInfo
+from data_management import data_directory
+from snapshot_archive import pack_path, read_frame, read_pack_index, snapshot_files, write_pack
+from structured_log import configure_logging, fields, get_logger
+
+
+# Compact the day's snapshot files once the market has closed
+compact_after_close = os.environ.get("COMPACTION", "True") == "True"
+compaction_workers = int(os.environ.get("COMPACTION_WORKERS", str(os.cpu_count() or 1)))
+
+temporary_suffix = ".tmp"
+removed_prefix = ".compacted-"
+
+_IST = ZoneInfo("Asia/Kolkata")
+
+log = get_logger("compaction")
+
+
+def compact_day(data_dir: str, symbol: str, day: str) -> Tuple[int, int, int]:
+    # returns (snapshots, bytes before, bytes after), all 0 when there was nothing to do
+    day_path = os.path.join(data_dir, symbol, day)
+    target = pack_path(data_dir, symbol, day)
+    if os.path.exists(target):
+        # the pack was put in place but the directory not yet removed
+        _remove_directory(day_path)
+        return 0, 0, 0
+    files = snapshot_files(day_path, day)
+    if not files:
+        return 0, 0, 0
+    digests: List[bytes] = []
+    size = 0
+
+    def snapshots():
+        nonlocal size
+        for timestamp, file_path in files:
+            with open(file_path, mode="rb") as f:
+                payload = f.read()
+            size += len(payload)
+            digests.append(hashlib.sha1(payload).digest())
+            yield timestamp, payload
+
+    temporary = target + temporary_suffix
+    try:
+        write_pack(temporary, snapshots())
+        verify_pack(temporary, [(timestamp, digest) for (timestamp, _), digest in zip(files, digests)])
+    except Exception:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+    os.replace(temporary, target)
+    _sync_directory(os.path.dirname(target))
+    _remove_directory(day_path)
+    return len(files), size, os.path.getsize(target)
+
+
+def verify_pack(path: str, expected: List[Tuple[int, bytes]]) -> None:
+    # every snapshot is in the pack, in order, and decompresses to the bytes it was made from
+    entries = read_pack_index(path)
+    if len(entries) != len(expected):
+        raise ValueError(f"{path} holds {len(entries)} snapshots, expected {len(expected)}")
+    checked: Dict[int, bytes] = {}
+    with open(path, mode="rb") as f:
+        for entry, (timestamp, digest) in zip(entries, expected):
+            if entry.timestamp != timestamp or entry.digest != digest:
+                raise ValueError(f"{path} index does not match the snapshot at {timestamp}")
+            if entry.offset not in checked:
+                checked[entry.offset] = hashlib.sha1(read_frame(f, entry).encode()).digest()
+            if checked[entry.offset] != digest:
+                raise ValueError(f"{path} frame of the snapshot at {timestamp} is corrupt")
+
+
+def _remove_directory(day_path: str) -> None:
+    if not os.path.isdir(day_path):
+        return
+    # readers never see a half deleted day
+    removed = os.path.join(os.path.dirname(day_path), removed_prefix + os.path.basename(day_path))
+    os.replace(day_path, removed)
+    shutil.rmtree(removed)
+
+
+def _sync_directory(directory: str) -> None:
+    # the originals are only deleted once the rename of the pack is durable
+    descriptor = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+def compact_symbol(data_dir: str, symbol: str, last_day: str) -> Tuple[int, int, int, int]:
+    # returns (days, snapshots, bytes before, bytes after)
+    symbol_path = os.path.join(data_dir, symbol)
+    days = snapshots = before = after = 0
+    for name in sorted(os.listdir(symbol_path)):
+        if name.startswith(removed_prefix):
+            # left behind by an interrupted delete, its pack is in place
+            shutil.rmtree(os.path.join(symbol_path, name), ignore_errors=True)
+            continue
+        try:
+            datetime.date.fromisoformat(name)
+        except ValueError:
+            continue
+        if name > last_day or not os.path.isdir(os.path.join(symbol_path, name)):
+            continue
+        day_snapshots, day_before, day_after = compact_day(data_dir, symbol, name)
+        if day_snapshots:
+            days += 1
+            snapshots += day_snapshots
+            before += day_before
+            after += day_after
+    return days, snapshots, before, after
+
+
+def find_symbols(data_dir: str, symbols: Optional[List[str]] = None) -> List[str]:
+    if not symbols:
+        symbols = [x for x in os.listdir(data_dir) if not x.startswith(".")]
+    return sorted(x for x in symbols if os.path.isdir(os.path.join(data_dir, x)))
+
+
+def compact(data_dir: str, symbols: List[str], last_day: str, workers: int = compaction_workers) -> int:
+    # compacts every day up to and including last_day, returns the number of days compacted
+    started = time.time()
+    days = snapshots = before = after = failed = 0
+    # spawned: the collector calls this from a thread of a process running an event loop
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(workers, 1),
+                                                mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = {pool.submit(compact_symbol, data_dir, symbol, last_day): symbol for symbol in symbols}
+        for future in concurrent.futures.as_completed(futures):
+            symbol = futures[future]
+            try:
+                symbol_days, symbol_snapshots, symbol_before, symbol_after = future.result()
+            except Exception:
+                # the symbol's remaining days are tried again next time
+                failed += 1
+                log.exception("compaction failed", extra=fields(symbol=symbol))
+                continue
+            days += symbol_days
+            snapshots += symbol_snapshots
+            before += symbol_before
+            after += symbol_after
+            if symbol_days:
+                log.info("compacted symbol", extra=fields(symbol=symbol, days=symbol_days, snapshots=symbol_snapshots,
+                                                          mb_before=round(symbol_before / 1e6, 1),
+                                                          mb_after=round(symbol_after / 1e6, 1)))
+    log.info("compaction done", extra=fields(symbols=len(symbols), failed=failed, days=days, snapshots=snapshots,
+                                             mb_before=round(before / 1e6, 1), mb_after=round(after / 1e6, 1),
+                                             seconds=round(time.time() - started, 1)))
+    return days
+
+
+def compact_after_market_close(data_dir: str, owns: Callable[[str], bool]) -> int:
+    # the collector's hook: every day up to today of the symbols this process
+    # polls, no snapshot files are written until the next session
+    today = datetime.datetime.now(_IST).date().isoformat()
+    return compact(data_dir, [x for x in find_symbols(data_dir) if owns(x)], today)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack per-fetch snapshot files into one file per symbol-day")
+    parser.add_argument("--data-dir", default=data_directory)
+    parser.add_argument("--symbols", nargs="*", help="defaults to every symbol under the data directory")
+    parser.add_argument("--to", dest="last_day", help="last day, YYYY-MM-DD, defaults to yesterday")
+    parser.add_argument("--workers", type=int, default=compaction_workers)
+    args = parser.parse_args()
+    configure_logging()
+    data_dir = os.path.abspath(args.data_dir)
+    # today may still be written to unless the collector is stopped
+    last_day = args.last_day or (datetime.datetime.now(_IST).date() - datetime.timedelta(days=1)).isoformat()
+    compact(data_dir, find_symbols(data_dir, args.symbols), last_day, args.workers)
+
+
+if __name__ == "__main__":
+    main()
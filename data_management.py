@@ -23,7 +23,20 @@ from zoneinfo import ZoneInfo
 from numpy import double
 import pytz
 import json
+from typing import Dict, Iterable, List, Tuple, Union
 from option_class import *
+from chain_parser import Chain, Contract, parse_chain
+from strike_writer import StrikeWriter
+import columnar_store
+from snapshot_archive import SnapshotArchive
+import analytics
+import greeks
+from depth_store import DepthRecorder
+from ring_buffer import intraday_store, keep_intraday
+from bars import BarAggregator, BarBatch, keep_bars
+from metrics import rows_skipped_total, stage_seconds
+from change_detection import ChangeDetector, skip_unchanged_rows
+from structured_log import get_logger, fields
 
 
 # Current time in IST
@@ -33,31 +46,135 @@ data_directory = "data"
 # Test Data Store Path
 if os.environ["DEBUG"]=="True":
     data_directory = "data/test"
+# Per-contract series layout: csv, columnar or both
+storage_format = os.environ.get("STORAGE_FORMAT", "csv")
+store_csv = storage_format in ("csv", "both")
+store_columnar = storage_format in ("columnar", "both")
+# Per-expiry chain metrics computed on every snapshot
+compute_analytics = os.environ.get("ANALYTICS", "True") == "True"
+# Implied volatility and Greeks for every contract, stored per expiry
+compute_greeks = os.environ.get("GREEKS", "True") == "True"
+# Bid/ask depth of every contract, one record per snapshot in a per-day file
+capture_depth = os.environ.get("DEPTH", "True") == "True"
+# Raw responses: one file per fetch (files) or a compressed per-day segment (archive)
+snapshot_format = os.environ.get("SNAPSHOT_FORMAT", "files")
+# Per-contract CSV header
+strike_data_header = ','.join([ "quote_timestamp", 
+                                "underlyingValue",
+                                "openPrice",
+                                "highPrice",
+                                "lowPrice",
+                                "closePrice",
+                                "lastPrice",
+                                "change",
+                                "pChange",
+                                "numberOfContractsTraded",
+                                "totalBuyQuantity",
+                                "totalSellQuantity",
+                                "tradeInfo.vmap",
+                                "openInterest",
+                                "changeinOpenInterest",
+                                "pchangeinOpenInterest",
+                                "dailyvolatility",
+                                "impliedVolatility",
+                                str("\n")
+                                ]
+                            )
+# Instrument types that are stored per contract
+option_instrument_types = frozenset(("Stock Options", "Index Options"))
+# Rows are buffered here and written once per collector cycle
+strike_writer = StrikeWriter()
+_expiry_paths: dict = {}
+# Last stored state of every contract, rows of contracts that didn't change are skipped
+change_detector = ChangeDetector()
+snapshot_archive = SnapshotArchive(os.path.abspath(path.join(os.curdir, data_directory)))
+depth_recorder = DepthRecorder(os.path.abspath(path.join(os.curdir, data_directory)))
+bar_aggregator = BarAggregator(os.path.abspath(path.join(os.curdir, data_directory)))
+log = get_logger("storage")
 
 
 def save_data(symbol, stock_quote_data):
-    save_file_path = get_data_folder(symbol)
-    stock_data_json = json.loads(stock_quote_data)
-    root = Root.from_dict(stock_data_json)
+    with stage_seconds.time(stage="json_decode", symbol=symbol):
+        stock_data_json = json.loads(stock_quote_data)
+    with stage_seconds.time(stage="parse", symbol=symbol):
+        root = parse_chain(stock_data_json, depth=capture_depth)
+    return store_chain(symbol, stock_quote_data, root)
+
+
+def store_chain(symbol: str, stock_quote_data: str, root: Chain) -> Chain:
+    # everything stored for one snapshot once it is parsed
     # Group by expiry, calls and puts
-    for optionExpiryDate in root.expiryDates:
-        all_calls = filter(lambda x : x.metadata.expiryDate==optionExpiryDate 
-                                and x.metadata.optionType=="Call"
-                                and (x.metadata.instrumentType=="Stock Options" 
-                                        or x.metadata.instrumentType=="Index Options"), root.stocks)
-        all_puts = filter(lambda x : x.metadata.expiryDate==optionExpiryDate 
-                                and x.metadata.optionType=="Put"
-                                and (x.metadata.instrumentType=="Stock Options" 
-                                        or x.metadata.instrumentType=="Index Options"), root.stocks)
+    with stage_seconds.time(stage="grouping", symbol=symbol):
+        chain = group_chain(root)
+    with stage_seconds.time(stage="buffer_rows", symbol=symbol):
+        quote_timestamp = columnar_store.parse_quote_timestamp(root.opt_timestamp) if skip_unchanged_rows else 0
+        for optionExpiryDate in root.expiryDates:
+            all_calls = chain.get((optionExpiryDate, "Call"), [])
+            all_puts = chain.get((optionExpiryDate, "Put"), [])
+            if skip_unchanged_rows:
+                all_calls = changed_contracts(all_calls, quote_timestamp, symbol)
+                all_puts = changed_contracts(all_puts, quote_timestamp, symbol)
+            try:
+                if store_csv:
+                    write_all_data(all_calls, all_puts, symbol, root.opt_timestamp)
+                if store_columnar:
+                    write_columnar_data(all_calls + all_puts, symbol, root.opt_timestamp)
+            except:
+                log.exception("expiry not stored", extra=fields(symbol=symbol, expiry=optionExpiryDate))
+            finally:
+                continue
+    options = [x for x in root.contracts if x.instrumentType in option_instrument_types]
+    if keep_intraday:
         try:
-            write_all_data(all_calls, all_puts, symbol, root.opt_timestamp)
+            with stage_seconds.time(stage="intraday", symbol=symbol):
+                intraday_store.add(symbol, root, options)
         except:
-            traceback.print_exception(*sys.exc_info())
-        finally:
-            continue
+            log.exception("intraday rows not kept", extra=fields(symbol=symbol))
+    if keep_bars:
+        try:
+            with stage_seconds.time(stage="bars", symbol=symbol):
+                write_bar_data(bar_aggregator.update(symbol, root, options))
+        except:
+            log.exception("bars not stored", extra=fields(symbol=symbol))
+    if compute_analytics:
+        try:
+            with stage_seconds.time(stage="analytics", symbol=symbol):
+                write_analytics_data(symbol, root, chain)
+        except:
+            log.exception("analytics not stored", extra=fields(symbol=symbol))
+    if compute_greeks:
+        try:
+            with stage_seconds.time(stage="greeks", symbol=symbol):
+                write_greeks_data(symbol, root, chain)
+        except:
+            log.exception("greeks not stored", extra=fields(symbol=symbol))
+    if capture_depth:
+        try:
+            with stage_seconds.time(stage="depth", symbol=symbol):
+                write_depth_data(symbol, root)
+        except:
+            log.exception("depth not stored", extra=fields(symbol=symbol))
+    with stage_seconds.time(stage="raw_snapshot", symbol=symbol):
+        save_raw_data(symbol, stock_quote_data)
+    return root
+
+
+def changed_contracts(contracts: List[Contract], quote_timestamp: int, symbol: str) -> List[Contract]:
+    changed = [x for x in contracts if change_detector.changed(x, quote_timestamp, symbol)]
+    if len(changed) < len(contracts):
+        rows_skipped_total.inc(len(contracts) - len(changed), symbol=symbol)
+    return changed
+
+
+def save_raw_data(symbol, stock_quote_data):
+    if snapshot_format == "archive":
+        stored = snapshot_archive.append(symbol, stock_quote_data, datetime.datetime.now(IST))
+        log.debug("archived quote", extra=fields(symbol=symbol, unchanged=not stored))
+        return
+    save_file_path = get_data_folder(symbol)
     with open(save_file_path, mode="w") as f:
         f.write(stock_quote_data)
-    print(f"Saved quote for {symbol} at {save_file_path}")
+    log.debug("saved quote", extra=fields(symbol=symbol, path=save_file_path))
         # for optionStrikePrice in root.strikePrices:
         #     try:
         #         calls = filter(lambda x : x.metadata.expiryDate==optionExpiryDate 
@@ -89,36 +206,50 @@ def save_data(symbol, stock_quote_data):
         #         continue
 
 
-def write_all_data(all_calls: filter, all_puts: filter, symbol: str, opt_timestamp: str) -> None:
+def group_chain(root: Union[Chain, Root]) -> Dict[Tuple[str, str], List[Union[Contract, Stock]]]:
+    # single pass over the chain, option contracts bucketed by (expiryDate, optionType)
+    if isinstance(root, Chain):
+        contracts = ((x, x) for x in root.contracts)
+    else:
+        contracts = ((x.metadata, x) for x in root.stocks)
+    chain: Dict[Tuple[str, str], List[Union[Contract, Stock]]] = {}
+    for metadata, contract in contracts:
+        if metadata.instrumentType not in option_instrument_types:
+            continue
+        key = (metadata.expiryDate, metadata.optionType)
+        bucket = chain.get(key)
+        if bucket is None:
+            bucket = chain[key] = []
+        bucket.append(contract)
+    return chain
+
+
+def write_all_data(all_calls: Iterable[Contract], all_puts: Iterable[Contract], symbol: str, opt_timestamp: str) -> None:
     for call_strike in all_calls:
         try:
-            call_expiry_path = get_expiry_path(symbol, call_strike.metadata.expiryDate, call_strike.metadata.identifier)
-            write_strike_data(call_expiry_path, call_strike.metadata, 
-                                call_strike.marketDeptOrderBook, call_strike.underlyingValue, opt_timestamp)
+            call_expiry_path = get_expiry_path(symbol, call_strike.expiryDate, call_strike.identifier)
+            strike_writer.append(call_expiry_path, call_strike.csv_row(opt_timestamp))
         except:
-                traceback.print_exception(*sys.exc_info())
-                msg = f'Error with CE {call_strike.metadata.expiryDate} {call_strike.metadata.strikePrice} \n'
-                print(msg)
+                log.exception("contract not stored", extra=fields(symbol=symbol, expiry=call_strike.expiryDate,
+                                                                 strike=call_strike.strikePrice, type="CE"))
         finally:
             continue
     for put_strike in all_puts:
         try:
-            put_expiry_path = get_expiry_path(symbol, put_strike.metadata.expiryDate, put_strike.metadata.identifier)
-            write_strike_data(put_expiry_path, put_strike.metadata, 
-                                put_strike.marketDeptOrderBook, put_strike.underlyingValue, opt_timestamp)
+            put_expiry_path = get_expiry_path(symbol, put_strike.expiryDate, put_strike.identifier)
+            strike_writer.append(put_expiry_path, put_strike.csv_row(opt_timestamp))
         except:
-                traceback.print_exception(*sys.exc_info())
-                msg = f'Error with PE {put_strike.metadata.expiryDate} {put_strike.metadata.strikePrice} \n'
-                print(msg)
+                log.exception("contract not stored", extra=fields(symbol=symbol, expiry=put_strike.expiryDate,
+                                                                 strike=put_strike.strikePrice, type="PE"))
         finally:
             continue
 
 
 def write_strike_data(path: str, metadata: Metadata, marketDeptOrderBook: MarketDeptOrderBook, 
                         underlyingValue: float, quote_timestamp: str) -> None:
-     with open(path, mode="a") as f:
-        try:
-            f.write(','.join([  quote_timestamp, 
+    # buffered, the row reaches the file on the next flush_strike_data()
+    try:
+        strike_writer.append(path, ','.join([  quote_timestamp, 
                                 str(underlyingValue),
                                 str(metadata.openPrice),
                                 str(metadata.highPrice),
@@ -140,57 +271,147 @@ def write_strike_data(path: str, metadata: Metadata, marketDeptOrderBook: Market
                                 ]
                             )
                     )
+    except:
+        log.exception("strike row not buffered", extra=fields(path=path))
+
+
+def write_columnar_data(strikes: List[Contract], symbol: str, opt_timestamp: str) -> None:
+    # the whole expiry is encoded in one go, then split into per-contract records
+    records = columnar_store.split_records(columnar_store.build_records(strikes, opt_timestamp))
+    for strike, record in zip(strikes, records):
+        try:
+            columnar_path = get_columnar_path(symbol, strike.expiryDate, strike.identifier)
+            strike_writer.append(columnar_path, record)
         except:
-            traceback.print_exception(*sys.exc_info())
+                log.exception("contract not stored", extra=fields(symbol=symbol, identifier=strike.identifier))
+
+
+def write_analytics_data(symbol: str, root: Chain, chain: Dict[Tuple[str, str], List[Contract]]) -> None:
+    metrics = [analytics.compute_chain_metrics(optionExpiryDate,
+                                               chain.get((optionExpiryDate, "Call"), []),
+                                               chain.get((optionExpiryDate, "Put"), []),
+                                               root.underlyingValue, root.opt_timestamp)
+               for optionExpiryDate in root.expiryDates
+               if (optionExpiryDate, "Call") in chain or (optionExpiryDate, "Put") in chain]
+    analytics.latest_metrics[symbol] = {x.expiryDate: x for x in metrics}
+    if metrics:
+        analytics_path = strike_writer.register(get_analytics_path(symbol), label=symbol)
+        strike_writer.append(analytics_path, analytics.encode_metrics(metrics))
+
+
+def write_greeks_data(symbol: str, root: Chain, chain: Dict[Tuple[str, str], List[Contract]]) -> None:
+    # solved for the whole chain at once, then split into one file per expiry
+    contracts = [x for optionExpiryDate in root.expiryDates for optionType in ("Call", "Put")
+                 for x in chain.get((optionExpiryDate, optionType), [])]
+    if not contracts:
+        return
+    records = greeks.build_greeks_records(contracts, greeks.chain_greeks(contracts, root.opt_timestamp),
+                                          root.opt_timestamp)
+    start = 0
+    for optionExpiryDate in root.expiryDates:
+        count = len(chain.get((optionExpiryDate, "Call"), [])) + len(chain.get((optionExpiryDate, "Put"), []))
+        if count:
+            greeks_path = strike_writer.register(get_greeks_path(symbol, optionExpiryDate), label=symbol)
+            strike_writer.append(greeks_path, records[start:start + count].tobytes())
+        start += count
+
+
+def write_depth_data(symbol: str, root: Chain) -> None:
+    recorded = depth_recorder.records(symbol, root)
+    if recorded is None:
+        return
+    depth_day, records, added = recorded
+    if added:
+        # the identifier table is appended before the records that point into it
+        identifiers_path = strike_writer.register(depth_day.identifiers_path, label=symbol)
+        strike_writer.append(identifiers_path, ''.join(x + "\n" for x in added))
+    records_path = strike_writer.register(depth_day.records_path, label=symbol)
+    strike_writer.append(records_path, records.tobytes())
+
+
+def get_greeks_path(symbol, optionExpiryDate):
+    return os.path.abspath(path.join(os.curdir, data_directory, symbol, optionExpiryDate, greeks.greeks_file_name))
+
+
+def get_analytics_path(symbol):
+    return os.path.abspath(path.join(os.curdir, data_directory, symbol, analytics.analytics_file_name))
+
+
+def load_contract_series(symbol, optionExpiryDate, expiryIdentifier, fields=None):
+    # columns of the binary series as zero-copy NumPy views
+    columnar_path = os.path.abspath(path.join(os.curdir, data_directory, symbol, optionExpiryDate,
+                                              expiryIdentifier + columnar_store.columnar_suffix))
+    return columnar_store.read_columns(columnar_path, fields)
+
+
+def write_bar_data(batches: List[BarBatch]) -> None:
+    for bar_day, added, closed in batches:
+        if added:
+            # the identifier table is appended before the bars that point into it
+            identifiers_path = strike_writer.register(bar_day.identifiers_path, label=bar_day.symbol)
+            strike_writer.append(identifiers_path, ''.join(x + "\n" for x in added))
+        for resolution, bars in closed.items():
+            if len(bars):
+                records_path = strike_writer.register(bar_day.records_path(resolution), label=bar_day.symbol)
+                strike_writer.append(records_path, bars.tobytes())
+
+
+def close_bars() -> None:
+    # the bars in progress are written as they are, e.g. once the market closed
+    if keep_bars:
+        write_bar_data(bar_aggregator.close())
+
+
+def release_symbols(symbols: Iterable[str]) -> None:
+    # another process writes the symbols' files from now on: their bars in
+    # progress are written and every per-symbol state kept in this process is
+    # dropped, so nothing stale is used if they come back
+    symbols = list(symbols)
+    for symbol in symbols:
+        if keep_bars:
+            write_bar_data(bar_aggregator.close(symbol))
+        change_detector.forget(symbol)
+        depth_recorder.forget(symbol)
+        snapshot_archive.forget(symbol)
+        intraday_store.forget(symbol)
+        analytics.latest_metrics.pop(symbol, None)
+    strike_writer.flush()
+    log.info("symbols released", extra=fields(symbols=len(symbols)))
+
+
+def flush_strike_data() -> int:
+    return strike_writer.flush()
+
+
+def close_strike_data() -> None:
+    close_bars()
+    strike_writer.close()
+    snapshot_archive.close()
 
 
 def get_expiry_path(symbol, optionExpiryDate, expiryIdentifier):
-    if os.path.exists(os.path.abspath(path.join(os.curdir, data_directory,symbol,optionExpiryDate,expiryIdentifier))):
-        datastorepath = os.path.abspath(path.join(os.curdir, data_directory,symbol,optionExpiryDate,expiryIdentifier))
-        return datastorepath
-    datastorepath = os.path.abspath(path.join(os.curdir, data_directory))
-    if not os.path.exists(os.path.join(datastorepath, symbol)):
-        os.mkdir(os.path.join(datastorepath, symbol))
-    datastorepath = os.path.abspath(os.path.join(datastorepath, symbol))
-    if not os.path.exists(os.path.join(datastorepath, optionExpiryDate)):
-        os.mkdir(os.path.join(datastorepath, optionExpiryDate))
-    datastorepath = os.path.abspath(path.join(datastorepath, optionExpiryDate, expiryIdentifier))
-    if not os.path.exists(datastorepath):
-        with open(datastorepath, mode="w") as f:
-            f.write(','.join([ "quote_timestamp", 
-                                "underlyingValue",
-                                "openPrice",
-                                "highPrice",
-                                "lowPrice",
-                                "closePrice",
-                                "lastPrice",
-                                "change",
-                                "pChange",
-                                "numberOfContractsTraded",
-                                "totalBuyQuantity",
-                                "totalSellQuantity",
-                                "tradeInfo.vmap",
-                                "openInterest",
-                                "changeinOpenInterest",
-                                "pchangeinOpenInterest",
-                                "dailyvolatility",
-                                "impliedVolatility",
-                                str("\n")
-                                ]
-                            )
-                        )
-    return datastorepath
+    # path and header creation are cached, the disk is only checked the first time
+    key = (symbol, optionExpiryDate, expiryIdentifier)
+    datastorepath = _expiry_paths.get(key)
+    if datastorepath is None:
+        datastorepath = os.path.abspath(path.join(os.curdir, data_directory, symbol, optionExpiryDate, expiryIdentifier))
+        _expiry_paths[key] = datastorepath
+    return strike_writer.register(datastorepath, strike_data_header, label=symbol)
+
+
+def get_columnar_path(symbol, optionExpiryDate, expiryIdentifier):
+    key = (symbol, optionExpiryDate, expiryIdentifier + columnar_store.columnar_suffix)
+    datastorepath = _expiry_paths.get(key)
+    if datastorepath is None:
+        datastorepath = os.path.abspath(path.join(os.curdir, data_directory, symbol, optionExpiryDate,
+                                                  expiryIdentifier + columnar_store.columnar_suffix))
+        _expiry_paths[key] = datastorepath
+    return strike_writer.register(datastorepath, label=symbol)
 
 
 def get_data_folder(symbol):
-    datastorepath = os.path.abspath(path.join(os.curdir, data_directory))
-    if not os.path.exists(os.path.join(datastorepath, symbol)):
-        os.mkdir(os.path.join(datastorepath, symbol))
-    datastorepath = os.path.abspath(path.join(datastorepath, symbol))
     datepath = datetime.datetime.now(IST).today().date().isoformat()
-    if not os.path.exists(os.path.join(datastorepath, datepath)):
-        os.mkdir(os.path.join(datastorepath, datepath))
-    datastorepath = os.path.abspath(path.join(datastorepath, datepath))
+    datastorepath = strike_writer.ensure_dir(os.path.abspath(path.join(os.curdir, data_directory, symbol, datepath)))
     timepath = datetime.datetime.now(IST).strftime('%H%M%S%f')
     datastorepath =  os.path.abspath(path.join(datastorepath, timepath))
     return datastorepath
@@ -0,0 +1,141 @@
+# Copyright 2022 Rohit Sood
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import datetime
+import os
+import threading
+from typing import Dict, List, Optional, Tuple
+from zoneinfo import ZoneInfo
+import numpy as np
+from chain_parser import Chain, depth_levels
+from columnar_store import parse_quote_timestamp
+
+
+# Order book depth of one symbol for one day: data/<symbol>/depth/<date>.bin
+# holds one fixed-width record per contract per snapshot, <date>.ids the
+# contract identifiers, one per line, that the records point at by position.
+depth_directory_name = "depth"
+records_suffix = ".bin"
+identifiers_suffix = ".ids"
+
+DEPTH_DTYPE = np.dtype([
+    ("quote_timestamp", "<i8"),
+    ("contract", "<i4"),
+    ("bid_price", "<f4", (depth_levels,)),
+    ("bid_quantity", "<i4", (depth_levels,)),
+    ("ask_price", "<f4", (depth_levels,)),
+    ("ask_quantity", "<i4", (depth_levels,)),
+])
+
+_IST = ZoneInfo("Asia/Kolkata")
+
+
+def depth_paths(data_directory: str, symbol: str, day: str) -> Tuple[str, str]:
+    directory = os.path.join(data_directory, symbol, depth_directory_name)
+    return os.path.join(directory, day + records_suffix), os.path.join(directory, day + identifiers_suffix)
+
+
+def read_identifiers(identifiers_path: str) -> List[str]:
+    if not os.path.exists(identifiers_path):
+        return []
+    with open(identifiers_path) as f:
+        # a partially written last line is left out
+        return [line[:-1] for line in f if line.endswith("\n")]
+
+
+class DepthDay:
+    # Identifier table of one symbol-day file, loaded from disk if the
+    # collector restarts during the day
+
+    def __init__(self, data_directory: str, symbol: str, day: str):
+        self.day = day
+        self.records_path, self.identifiers_path = depth_paths(data_directory, symbol, day)
+        self.positions: Dict[str, int] = {x: i for i, x in enumerate(read_identifiers(self.identifiers_path))}
+        self.last_timestamp = 0
+
+    def positions_for(self, identifiers: List[str]) -> Tuple[np.ndarray, List[str]]:
+        # table positions of the identifiers, and the ones that are new to the table
+        added = []
+        for identifier in identifiers:
+            if identifier not in self.positions:
+                self.positions[identifier] = len(self.positions)
+                added.append(identifier)
+        return np.fromiter((self.positions[x] for x in identifiers), dtype=np.int32, count=len(identifiers)), added
+
+
+class DepthRecorder:
+    # Turns parsed chains into depth records, one array per snapshot
+
+    def __init__(self, data_directory: str):
+        self.data_directory = data_directory
+        self._days: Dict[str, DepthDay] = {}
+        self._lock = threading.Lock()
+
+    def records(self, symbol: str, chain: Chain) -> Optional[Tuple[DepthDay, np.ndarray, List[str]]]:
+        # None when the chain has no depth or this quote time is already stored
+        if chain.depth_prices is None or not chain.contracts:
+            return None
+        quote_timestamp = parse_quote_timestamp(chain.opt_timestamp)
+        day = datetime.datetime.fromtimestamp(quote_timestamp, _IST).date().isoformat()
+        with self._lock:
+            depth_day = self._days.get(symbol)
+            if depth_day is None or depth_day.day != day:
+                depth_day = self._days[symbol] = DepthDay(self.data_directory, symbol, day)
+            if quote_timestamp <= depth_day.last_timestamp:
+                return None
+            depth_day.last_timestamp = quote_timestamp
+            positions, added = depth_day.positions_for([x.identifier for x in chain.contracts])
+        records = np.empty(len(chain.contracts), dtype=DEPTH_DTYPE)
+        records["quote_timestamp"] = quote_timestamp
+        records["contract"] = positions
+        records["bid_price"] = chain.depth_prices[:, 0]
+        records["bid_quantity"] = chain.depth_quantities[:, 0]
+        records["ask_price"] = chain.depth_prices[:, 1]
+        records["ask_quantity"] = chain.depth_quantities[:, 1]
+        return depth_day, records, added
+
+    def forget(self, symbol: str) -> None:
+        # the identifier table is loaded from disk again if the symbol comes back
+        with self._lock:
+            self._days.pop(symbol, None)
+
+
+def read_depth(data_directory: str, symbol: str, day: str, identifier: Optional[str] = None,
+               start: Optional[int] = None, end: Optional[int] = None) -> Tuple[np.ndarray, List[str]]:
+    # records of the day (memory mapped), optionally of one contract and
+    # between start and end (epoch seconds), with the identifier table
+    records_path, identifiers_path = depth_paths(data_directory, symbol, day)
+    identifiers = read_identifiers(identifiers_path)
+    if not os.path.exists(records_path) or os.path.getsize(records_path) < DEPTH_DTYPE.itemsize:
+        return np.empty(0, dtype=DEPTH_DTYPE), identifiers
+    count = os.path.getsize(records_path) // DEPTH_DTYPE.itemsize
+    records = np.memmap(records_path, dtype=DEPTH_DTYPE, mode="r", shape=(count,))
+    # records are appended in snapshot order
+    timestamps = records["quote_timestamp"]
+    first = 0 if start is None else int(np.searchsorted(timestamps, start, side="left"))
+    last = count if end is None else int(np.searchsorted(timestamps, end, side="right"))
+    records = records[first:last]
+    # records written before their identifier reached the table are left out
+    records = records[records["contract"] < len(identifiers)]
+    if identifier is not None:
+        position = identifiers.index(identifier) if identifier in identifiers else -1
+        records = records[records["contract"] == position]
+    return records, identifiers
+
+
+def spread(records: np.ndarray) -> np.ndarray:
+    # best ask - best bid, nan where either side is empty
+    bid = records["bid_price"][:, 0].astype(np.float64)
+    ask = records["ask_price"][:, 0].astype(np.float64)
+    return np.where((bid > 0) & (ask > 0), ask - bid, np.nan)
@@ -0,0 +1,258 @@
+# Copyright 2022 Rohit Sood
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import asyncio
+import os
+import random
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional
+import aiohttp
+import metrics
+
+
+# Upper bound for upstream requests in flight, the adaptive limit moves below it
+max_concurrent_fetches = int(os.environ.get("FETCH_CONCURRENCY", "8"))
+min_concurrent_fetches = int(os.environ.get("FETCH_MIN_CONCURRENCY", "1"))
+# Idle keep-alive connections are kept in the pool for this long
+keepalive_timeout_in_seconds = int(os.environ.get("FETCH_KEEPALIVE", "60"))
+# Upper bound for a single request, connect + read
+request_timeout_in_seconds = int(os.environ.get("FETCH_TIMEOUT", "30"))
+# Requests started per second and how many may start at once after a quiet
+# spell, 0 turns the token bucket off
+fetch_rate = float(os.environ.get("FETCH_RATE", "50"))
+fetch_burst = int(os.environ.get("FETCH_BURST", str(max_concurrent_fetches)))
+# Responses slower than this count as upstream pressure, like a 429
+slow_response_in_seconds = float(os.environ.get("FETCH_SLOW_SECONDS", "5"))
+# Retries of one quote, with full jitter backoff between base * 2^n and the cap
+max_fetch_retries = int(os.environ.get("FETCH_RETRIES", "3"))
+retry_base_delay_in_seconds = 0.5
+retry_max_delay_in_seconds = 8.0
+# Consecutive throttled or failed requests that open the circuit, and for how long
+breaker_failure_threshold = int(os.environ.get("FETCH_BREAKER_THRESHOLD", "10"))
+breaker_open_in_seconds = float(os.environ.get("FETCH_BREAKER_SECONDS", "30"))
+
+# Statuses NSE answers with when it wants fewer requests
+throttle_statuses = (403, 429)
+# NSE also answers stale cookies with 403, the engine leaves these to the
+# caller, which reports them with FetchEngine.throttled once fresh cookies
+# didn't help
+ambiguous_statuses = (403,)
+
+
+@dataclass
+class FetchResult:
+    status: int
+    text: str
+    cookies: Dict[str, str]
+    # when the request was let through the concurrency limit
+    started: float = 0.0
+
+
+class CircuitOpenError(ConnectionError):
+    pass
+
+
+def retry_delay(attempt: int) -> float:
+    # full jitter: retries of many symbols don't line up on the same instant
+    return random.uniform(0, min(retry_max_delay_in_seconds, retry_base_delay_in_seconds * 2 ** attempt))
+
+
+def is_upstream_failure(status: int) -> bool:
+    return status in throttle_statuses or status >= 500
+
+
+class TokenBucket:
+    # Spaces request starts out to rate per second. Every caller reserves a
+    # token, going into debt if there is none, and sleeps until it is paid off,
+    # so waiters are served in arrival order.
+
+    def __init__(self, rate: float = fetch_rate, burst: int = fetch_burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+
+    async def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate) - 1
+        self._updated = now
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self.rate)
+
+
+class AdaptiveLimit:
+    # Requests allowed in flight, additive increase / multiplicative decrease:
+    # every uncongested response raises the limit by 1/limit (about one per
+    # round of requests), a throttled, failed or slow one halves it. Responses
+    # to requests started before the last decrease don't decrease it again.
+
+    def __init__(self, maximum: int = max_concurrent_fetches, minimum: int = min_concurrent_fetches):
+        self.maximum = max(maximum, 1)
+        self.minimum = min(max(minimum, 1), self.maximum)
+        self.limit = float(self.maximum)
+        self.in_flight = 0
+        self._decreased_at = 0.0
+        self._condition: Optional[asyncio.Condition] = None
+        metrics.fetch_concurrency_limit.set(self.limit)
+
+    async def acquire(self) -> float:
+        # returns when a request may start, with its start time for release
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        return time.monotonic()
+
+    async def release(self, started: float, congested: Optional[bool]) -> None:
+        # congested None leaves the limit as it is
+        if congested:
+            self.decrease(started)
+        elif congested is not None:
+            self.limit = min(float(self.maximum), self.limit + 1 / self.limit)
+            metrics.fetch_concurrency_limit.set(self.limit)
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def decrease(self, started: float) -> None:
+        if started >= self._decreased_at:
+            self.limit = max(float(self.minimum), self.limit / 2)
+            self._decreased_at = time.monotonic()
+        metrics.fetch_concurrency_limit.set(self.limit)
+
+
+class CircuitBreaker:
+    # Opens after threshold consecutive failures and fails every request fast
+    # until open_seconds have passed. Then one probe goes through: success
+    # closes the circuit, failure opens it again.
+
+    closed, half_open, open = 0, 1, 2
+
+    def __init__(self, threshold: int = breaker_failure_threshold, open_seconds: float = breaker_open_in_seconds):
+        self.threshold = threshold
+        self.open_seconds = open_seconds
+        self.state = CircuitBreaker.closed
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+
+    def check(self) -> None:
+        # raises CircuitOpenError when the request must not be sent
+        if self.state == CircuitBreaker.open:
+            if time.monotonic() - self._opened_at < self.open_seconds:
+                raise CircuitOpenError(f"upstream circuit open for {self.open_seconds}s")
+            self._set_state(CircuitBreaker.half_open)
+        if self.state == CircuitBreaker.half_open:
+            if self._probing:
+                raise CircuitOpenError("upstream circuit half open, probe in flight")
+            self._probing = True
+
+    def abandon(self) -> None:
+        # a request that passed check() but was never sent
+        self._probing = False
+
+    def record(self, success: Optional[bool]) -> None:
+        # success None only ends a probe, the outcome is recorded later or not at all
+        self._probing = False
+        if success is None:
+            return
+        if success:
+            self.failures = 0
+            if self.state != CircuitBreaker.closed:
+                self._set_state(CircuitBreaker.closed)
+            return
+        self.failures += 1
+        if self.state == CircuitBreaker.half_open or self.failures >= self.threshold:
+            self._opened_at = time.monotonic()
+            self._set_state(CircuitBreaker.open)
+
+    def _set_state(self, state: int) -> None:
+        self.state = state
+        metrics.fetch_circuit_state.set(state)
+
+
+class FetchEngine:
+    # One aiohttp session (and connection pool) shared by every fetch on the loop.
+    # Cookies are always passed explicitly, the session itself keeps none.
+    # Every request passes the circuit breaker, the token bucket and the
+    # adaptive concurrency limit, in that order.
+
+    def __init__(self, concurrency: int = max_concurrent_fetches):
+        self.concurrency = concurrency
+        self._session: Optional[aiohttp.ClientSession] = None
+        self.bucket = TokenBucket()
+        self.limit = AdaptiveLimit(concurrency)
+        self.breaker = CircuitBreaker()
+
+    async def start(self) -> None:
+        if self._session is not None and not self._session.closed:
+            return
+        connector = aiohttp.TCPConnector(limit=self.concurrency,
+                                         limit_per_host=self.concurrency,
+                                         keepalive_timeout=keepalive_timeout_in_seconds,
+                                         ttl_dns_cache=300)
+        self._session = aiohttp.ClientSession(connector=connector,
+                                              cookie_jar=aiohttp.DummyCookieJar(),
+                                              timeout=aiohttp.ClientTimeout(total=request_timeout_in_seconds))
+
+    async def get(self, url: str, headers: Optional[Dict[str, str]] = None,
+                  cookies: Optional[Dict[str, str]] = None) -> FetchResult:
+        await self.start()
+        self.breaker.check()
+        try:
+            await self.bucket.acquire()
+            started = await self.limit.acquire()
+        except BaseException:
+            self.breaker.abandon()
+            raise
+        result: Optional[FetchResult] = None
+        try:
+            async with self._session.get(url, headers=headers, cookies=cookies) as response:
+                text = await response.text()
+                result = FetchResult(response.status, text,
+                                     {name: morsel.value for name, morsel in response.cookies.items()}, started)
+                return result
+        finally:
+            if result is not None and result.status in ambiguous_statuses:
+                self.breaker.record(None)
+                await self.limit.release(started, None)
+            else:
+                # connection errors and timeouts count as failures too
+                failed = result is None or is_upstream_failure(result.status)
+                self.breaker.record(not failed)
+                await self.limit.release(started, failed or time.monotonic() - started > slow_response_in_seconds)
+
+    def throttled(self, result: FetchResult) -> None:
+        # the caller's verdict on a response with an ambiguous status: NSE is pushing back
+        self.breaker.record(False)
+        self.limit.decrease(result.started)
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+_engine: Optional[FetchEngine] = None
+
+
+def get_engine() -> FetchEngine:
+    global _engine
+    if _engine is None:
+        _engine = FetchEngine()
+    return _engine
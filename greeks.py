@@ -0,0 +1,192 @@
+# Copyright 2022 Rohit Sood
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import datetime
+import os
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import List
+from zoneinfo import ZoneInfo
+import numpy as np
+from chain_parser import Contract
+from columnar_store import parse_quote_timestamp
+
+
+# Black-Scholes inputs
+risk_free_rate = float(os.environ.get("RISK_FREE_RATE", "0.07"))
+# NSE options expire at the close on the expiry date
+expiry_time = datetime.time(15, 30)
+# Time to expiry never goes below one minute
+min_time_to_expiry = 1.0 / (365 * 24 * 60)
+seconds_per_year = 365 * 24 * 60 * 60
+# Implied volatility search range and tolerance (in price)
+min_volatility = 1e-4
+max_volatility = 5.0
+price_tolerance = 1e-6
+newton_iterations = 8
+bisection_iterations = 60
+
+# Per-expiry Greeks series, one record per contract per snapshot
+greeks_file_name = "greeks.bin"
+
+GREEKS_DTYPE = np.dtype([
+    ("quote_timestamp", "<i8"),
+    ("strikePrice", "<f4"),
+    ("isCall", "<i1"),
+    ("impliedVolatility", "<f4"),
+    ("delta", "<f4"),
+    ("gamma", "<f4"),
+    ("theta", "<f4"),
+    ("vega", "<f4"),
+])
+
+_IST = ZoneInfo("Asia/Kolkata")
+
+
+@dataclass
+class Greeks:
+    impliedVolatility: np.ndarray
+    delta: np.ndarray
+    gamma: np.ndarray
+    theta: np.ndarray
+    vega: np.ndarray
+
+
+def norm_cdf(x: np.ndarray) -> np.ndarray:
+    # 0.5 * erfc(-x / sqrt(2)), erfc from its Chebyshev fit (relative error < 1.2e-7)
+    z = np.abs(x) / np.sqrt(2.0)
+    t = 1.0 / (1.0 + 0.5 * z)
+    erfc = t * np.exp(-z * z - 1.26551223 + t * (1.00002368 + t * (0.37409196 + t * (0.09678418 + t * (
+        -0.18628806 + t * (0.27886807 + t * (-1.13520398 + t * (1.48851587 + t * (-0.82215223 + t * 0.17087277)))))))))
+    return np.where(x >= 0, 1.0 - 0.5 * erfc, 0.5 * erfc)
+
+
+def norm_pdf(x: np.ndarray) -> np.ndarray:
+    return np.exp(-0.5 * x * x) / np.sqrt(2.0 * np.pi)
+
+
+def _d1_d2(spot, strike, t, rate, sigma):
+    sqrt_t = np.sqrt(t)
+    d1 = (np.log(spot / strike) + (rate + 0.5 * sigma * sigma) * t) / (sigma * sqrt_t)
+    return d1, d1 - sigma * sqrt_t
+
+
+def bs_price(spot, strike, t, rate, sigma, is_call):
+    d1, d2 = _d1_d2(spot, strike, t, rate, sigma)
+    discount = np.exp(-rate * t)
+    call = spot * norm_cdf(d1) - strike * discount * norm_cdf(d2)
+    put = strike * discount * norm_cdf(-d2) - spot * norm_cdf(-d1)
+    return np.where(is_call, call, put)
+
+
+def implied_volatility(price, spot, strike, t, is_call, rate: float = risk_free_rate) -> np.ndarray:
+    # batched Newton, contracts that don't converge inside the bounds are
+    # bisected. Prices outside the no-arbitrage range give nan.
+    price, spot, strike, t = (np.asarray(x, dtype=np.float64) for x in (price, spot, strike, t))
+    is_call = np.asarray(is_call, dtype=bool)
+    discount = np.exp(-rate * t)
+    lower = np.where(is_call, np.maximum(spot - strike * discount, 0), np.maximum(strike * discount - spot, 0))
+    upper = np.where(is_call, spot, strike * discount)
+    valid = (price > 0) & (price > lower) & (price < upper) & (spot > 0) & (strike > 0)
+
+    sigma = np.full(price.shape, 0.3)
+    active = valid.copy()
+    converged = np.zeros(price.shape, dtype=bool)
+    with np.errstate(all="ignore"):
+        for _ in range(newton_iterations + 1):
+            d1, _ = _d1_d2(spot, strike, t, rate, sigma)
+            diff = bs_price(spot, strike, t, rate, sigma, is_call) - price
+            vega = spot * norm_pdf(d1) * np.sqrt(t)
+            converged |= active & (np.abs(diff) < price_tolerance)
+            active &= ~converged & (vega > 1e-12)
+            if not active.any():
+                break
+            sigma = np.where(active, sigma - diff / vega, sigma)
+            # Newton left the search range, bisection takes over
+            escaped = active & ((sigma <= min_volatility) | (sigma >= max_volatility) | ~np.isfinite(sigma))
+            sigma = np.where(escaped, 0.3, sigma)
+            active &= ~escaped
+        pending = valid & ~converged
+        if pending.any():
+            low = np.full(int(pending.sum()), min_volatility)
+            high = np.full(low.shape, max_volatility)
+            p_spot, p_strike, p_t, p_call, p_price = spot[pending], strike[pending], t[pending], is_call[pending], price[pending]
+            for _ in range(bisection_iterations):
+                middle = 0.5 * (low + high)
+                above = bs_price(p_spot, p_strike, p_t, rate, middle, p_call) > p_price
+                high = np.where(above, middle, high)
+                low = np.where(above, low, middle)
+            sigma[pending] = 0.5 * (low + high)
+    return np.where(valid, sigma, np.nan)
+
+
+def compute_greeks(price, spot, strike, t, is_call, rate: float = risk_free_rate) -> Greeks:
+    sigma = implied_volatility(price, spot, strike, t, is_call, rate)
+    spot, strike, t = (np.asarray(x, dtype=np.float64) for x in (spot, strike, t))
+    is_call = np.asarray(is_call, dtype=bool)
+    with np.errstate(all="ignore"):
+        d1, d2 = _d1_d2(spot, strike, t, rate, sigma)
+        sqrt_t = np.sqrt(t)
+        pdf = norm_pdf(d1)
+        discount = np.exp(-rate * t)
+        delta = np.where(is_call, norm_cdf(d1), norm_cdf(d1) - 1.0)
+        gamma = pdf / (spot * sigma * sqrt_t)
+        decay = -spot * pdf * sigma / (2.0 * sqrt_t)
+        theta = np.where(is_call, decay - rate * strike * discount * norm_cdf(d2),
+                         decay + rate * strike * discount * norm_cdf(-d2))
+    # volatility in percent, theta per calendar day, vega per 1% volatility
+    return Greeks(sigma * 100.0, delta, gamma, theta / 365.0, spot * pdf * sqrt_t / 100.0)
+
+
+@lru_cache(maxsize=256)
+def _expiry_timestamp(expiryDate: str) -> float:
+    expiry = datetime.datetime.strptime(expiryDate, "%d-%b-%Y").date()
+    return datetime.datetime.combine(expiry, expiry_time, tzinfo=_IST).timestamp()
+
+
+def years_to_expiry(expiryDates: List[str], quote_timestamp: str) -> np.ndarray:
+    now = parse_quote_timestamp(quote_timestamp)
+    seconds = np.fromiter((_expiry_timestamp(x) for x in expiryDates), dtype=np.float64, count=len(expiryDates)) - now
+    return np.maximum(seconds / seconds_per_year, min_time_to_expiry)
+
+
+def chain_greeks(contracts: List[Contract], quote_timestamp: str) -> Greeks:
+    # one call for every contract of the chain, all expiries together
+    count = len(contracts)
+    price = np.fromiter((x.lastPrice for x in contracts), dtype=np.float64, count=count)
+    spot = np.fromiter((x.underlyingValue for x in contracts), dtype=np.float64, count=count)
+    strike = np.fromiter((x.strikePrice for x in contracts), dtype=np.float64, count=count)
+    is_call = np.fromiter((x.optionType == "Call" for x in contracts), dtype=bool, count=count)
+    t = years_to_expiry([x.expiryDate for x in contracts], quote_timestamp)
+    return compute_greeks(price, spot, strike, t, is_call)
+
+
+def build_greeks_records(contracts: List[Contract], greeks: Greeks, quote_timestamp: str) -> np.ndarray:
+    records = np.empty(len(contracts), dtype=GREEKS_DTYPE)
+    records["quote_timestamp"] = parse_quote_timestamp(quote_timestamp)
+    records["strikePrice"] = [x.strikePrice for x in contracts]
+    records["isCall"] = [x.optionType == "Call" for x in contracts]
+    records["impliedVolatility"] = greeks.impliedVolatility
+    records["delta"] = greeks.delta
+    records["gamma"] = greeks.gamma
+    records["theta"] = greeks.theta
+    records["vega"] = greeks.vega
+    return records
+
+
+def read_greeks(path: str) -> np.ndarray:
+    if not os.path.exists(path) or os.path.getsize(path) < GREEKS_DTYPE.itemsize:
+        return np.empty(0, dtype=GREEKS_DTYPE)
+    count = os.path.getsize(path) // GREEKS_DTYPE.itemsize
+    return np.memmap(path, dtype=GREEKS_DTYPE, mode="r", shape=(count,))
@@ -0,0 +1,375 @@
+# Copyright 2022 Rohit Sood
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import bisect
+import datetime
+import os
+import threading
+from array import array
+from collections import OrderedDict
+from os import path
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+from zoneinfo import ZoneInfo
+import numpy as np
+import columnar_store
+from chain_parser import SERIES_FIELDS
+from columnar_store import parse_quote_timestamp
+from data_management import data_directory
+
+
+# Time indexes of this many CSV series are kept in memory, the others are
+# read back from their index files
+max_indexed_series = int(os.environ.get("HISTORY_INDEX_CACHE", "1024"))
+# Rows read from disk per streamed chunk
+rows_per_chunk = 500
+# The time index of a CSV series is kept next to it, e.g. ...CE17850.00.tidx
+index_suffix = ".tidx"
+
+_IST = ZoneInfo("Asia/Kolkata")
+# CSV header names that differ from the series field names
+_field_aliases = {"tradeInfo.vmap": "vmap"}
+
+
+class CsvTimeIndex:
+    # Byte offset of every row of one CSV series, keyed by quote timestamp.
+    # Only the bytes appended since the last refresh are scanned, the index
+    # file carries that over to the next process and past cache evictions.
+    # A series that was replaced (new inode) or truncated is indexed again.
+
+    def __init__(self, csv_path: str):
+        self.path = csv_path
+        self.index_path = csv_path + index_suffix
+        self.timestamps = array('q')
+        self.offsets = array('q')
+        self.indexed_upto = 0
+        self.inode = None
+        # rows already in the index file, -1 when it has to be written afresh
+        self._stored = -1
+        self._lock = threading.Lock()
+
+    def refresh(self) -> None:
+        with self._lock:
+            status = os.stat(self.path)
+            if self.inode is None:
+                self._load(status.st_ino)
+            if status.st_ino != self.inode or status.st_size < self.indexed_upto:
+                self._reset(status.st_ino)
+            if status.st_size <= self.indexed_upto:
+                return
+            with open(self.path, mode="rb") as f:
+                if not self._last_row_matches(f):
+                    # rewritten in place, e.g. a failed batch cut off and written again
+                    self._reset(status.st_ino)
+                f.seek(self.indexed_upto)
+                offset = self.indexed_upto
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        # still being written, picked up on the next refresh
+                        break
+                    if offset > 0 or not line.startswith(b"quote_timestamp"):
+                        self.timestamps.append(parse_quote_timestamp(line[:line.index(b",")].decode()))
+                        self.offsets.append(offset)
+                    offset += len(line)
+                self.indexed_upto = offset
+            self._store()
+
+    def _reset(self, inode: int) -> None:
+        self.timestamps = array('q')
+        self.offsets = array('q')
+        self.indexed_upto = 0
+        self.inode = inode
+        self._stored = -1
+
+    def _last_row_matches(self, f) -> bool:
+        # the last indexed row is still where it was and ends where indexing stopped
+        if not self.offsets:
+            return True
+        f.seek(self.offsets[-1])
+        line = f.readline()
+        if not line.endswith(b"\n") or self.offsets[-1] + len(line) != self.indexed_upto:
+            return False
+        try:
+            return parse_quote_timestamp(line[:line.index(b",")].decode()) == self.timestamps[-1]
+        except ValueError:
+            return False
+
+    def _load(self, inode: int) -> None:
+        # the index file is the inode of the series followed by (timestamp, offset) pairs
+        self._reset(inode)
+        try:
+            stored = np.fromfile(self.index_path, dtype=np.int64)
+        except OSError:
+            return
+        if len(stored) % 2 != 1 or stored[0] != inode:
+            return
+        pairs = stored[1:].reshape(-1, 2)
+        if len(pairs) == 0 or not np.all(np.diff(pairs[:, 1]) > 0):
+            return
+        self.timestamps.frombytes(pairs[:, 0].tobytes())
+        self.offsets.frombytes(pairs[:, 1].tobytes())
+        with open(self.path, mode="rb") as f:
+            f.seek(self.offsets[-1])
+            self.indexed_upto = self.offsets[-1] + len(f.readline())
+            if not self._last_row_matches(f):
+                self._reset(inode)
+                return
+        self._stored = len(self.offsets)
+
+    def _store(self) -> None:
+        if self._stored == len(self.offsets):
+            return
+        first = max(self._stored, 0)
+        pairs = np.empty((len(self.offsets) - first, 2), dtype=np.int64)
+        pairs[:, 0] = np.frombuffer(self.timestamps, dtype=np.int64)[first:]
+        pairs[:, 1] = np.frombuffer(self.offsets, dtype=np.int64)[first:]
+        try:
+            if self._stored < 0:
+                temporary = self.index_path + ".tmp"
+                with open(temporary, mode="wb") as f:
+                    f.write(np.int64(self.inode).tobytes())
+                    f.write(pairs.tobytes())
+                os.replace(temporary, self.index_path)
+            else:
+                with open(self.index_path, mode="ab") as f:
+                    f.write(pairs.tobytes())
+        except OSError:
+            # e.g. a read only data directory, the index stays in memory
+            return
+        self._stored = len(self.offsets)
+
+    def span(self, start: Optional[int], end: Optional[int]) -> Tuple[int, int]:
+        # byte range of the rows with start <= quote timestamp <= end
+        self.refresh()
+        first = 0 if start is None else bisect.bisect_left(self.timestamps, start)
+        last = len(self.timestamps) if end is None else bisect.bisect_right(self.timestamps, end)
+        if first >= last:
+            return 0, 0
+        stop = self.offsets[last] if last < len(self.offsets) else self.indexed_upto
+        return self.offsets[first], stop
+
+    def latest_offset(self, at: Optional[int]) -> Optional[Tuple[int, int]]:
+        # byte range of the last row at or before at
+        self.refresh()
+        position = len(self.timestamps) if at is None else bisect.bisect_right(self.timestamps, at)
+        if position == 0:
+            return None
+        stop = self.offsets[position] if position < len(self.offsets) else self.indexed_upto
+        return self.offsets[position - 1], stop
+
+
+_indexes: 'OrderedDict[str, CsvTimeIndex]' = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def csv_index(csv_path: str) -> CsvTimeIndex:
+    with _indexes_lock:
+        index = _indexes.get(csv_path)
+        if index is None:
+            index = _indexes[csv_path] = CsvTimeIndex(csv_path)
+            while len(_indexes) > max_indexed_series:
+                _indexes.popitem(last=False)
+        else:
+            _indexes.move_to_end(csv_path)
+        return index
+
+
+def parse_time_param(value: Optional[str]) -> Optional[int]:
+    # epoch seconds, ISO 8601 or the NSE format; naive times are IST
+    if value is None or value == "":
+        return None
+    try:
+        return int(float(value))
+    except ValueError:
+        pass
+    try:
+        parsed = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        parsed = datetime.datetime.strptime(value, "%d-%b-%Y %H:%M:%S")
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=_IST)
+    return int(parsed.timestamp())
+
+
+def parse_fields(value: Optional[str]) -> List[str]:
+    if not value:
+        return list(SERIES_FIELDS)
+    fields = [_field_aliases.get(name.strip(), name.strip()) for name in value.split(",") if name.strip()]
+    unknown = [name for name in fields if name not in SERIES_FIELDS]
+    if unknown:
+        raise ValueError(f"unknown fields {','.join(unknown)}")
+    return fields
+
+
+def format_timestamp(timestamp: int) -> str:
+    return datetime.datetime.fromtimestamp(timestamp, _IST).strftime("%d-%b-%Y %H:%M:%S")
+
+
+def series_path(symbol: str, expiry: str, identifier: str) -> Optional[str]:
+    # binary series are preferred, they need no parsing
+    base = os.path.abspath(path.join(os.curdir, data_directory, symbol, expiry, identifier))
+    if os.path.exists(base + columnar_store.columnar_suffix):
+        return base + columnar_store.columnar_suffix
+    if os.path.isfile(base):
+        return base
+    return None
+
+
+def _csv_rows(csv_path: str, start: int, stop: int, fields: Sequence[str]) -> Iterator[List[dict]]:
+    positions = [SERIES_FIELDS.index(name) + 1 for name in fields]
+    # same value types as the binary series
+    casts = [int if columnar_store.RECORD_DTYPE[name].kind == "i" else float for name in fields]
+    with open(csv_path, mode="rb") as f:
+        f.seek(start)
+        chunk = []
+        while f.tell() < stop:
+            values = f.readline().decode().split(",")
+            row = {"quote_timestamp": values[0]}
+            for name, position, cast in zip(fields, positions, casts):
+                row[name] = cast(values[position])
+            chunk.append(row)
+            if len(chunk) >= rows_per_chunk:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def columnar_rows(series: np.ndarray, fields: Sequence[str]) -> Iterator[List[dict]]:
+    for start in range(0, len(series), rows_per_chunk):
+        block = series[start:start + rows_per_chunk]
+        # float32 fields are rounded so 31.81 doesn't come back as 31.809999465942383
+        columns = [(block[name].astype(np.float64).round(4) if block[name].dtype == np.float32 else block[name]).tolist()
+                   for name in fields]
+        chunk = []
+        for i, timestamp in enumerate(block["quote_timestamp"].tolist()):
+            row = {"quote_timestamp": format_timestamp(timestamp)}
+            for name, column in zip(fields, columns):
+                row[name] = column[i]
+            chunk.append(row)
+        yield chunk
+
+
+def query_series(symbol: str, expiry: str, identifier: str, start: Optional[int] = None,
+                 end: Optional[int] = None, fields: Sequence[str] = SERIES_FIELDS,
+                 every: Optional[int] = None) -> Iterator[List[dict]]:
+    # rows of one contract between start and end (epoch seconds), in chunks.
+    # With every (seconds) the rows are forward-filled onto a regular grid,
+    # unchanged contracts only have a row when something changed.
+    source = series_path(symbol, expiry, identifier)
+    if source is None:
+        raise FileNotFoundError(f"{symbol}/{expiry}/{identifier}")
+    if source.endswith(columnar_store.columnar_suffix):
+        series = columnar_store.read_series(source)
+        timestamps = series["quote_timestamp"]
+        if every and len(series):
+            start = int(timestamps[0]) if start is None else start
+            end = int(timestamps[-1]) if end is None else end
+            # the row in force at start is carried into the window
+            first = max(0, int(np.searchsorted(timestamps, start, side="right")) - 1)
+        else:
+            first = 0 if start is None else int(np.searchsorted(timestamps, start, side="left"))
+        last = len(series) if end is None else int(np.searchsorted(timestamps, end, side="right"))
+        chunks = columnar_rows(series[first:last], fields)
+    else:
+        index = csv_index(source)
+        byte_start, byte_stop = index.span(start, end)
+        if every and len(index.timestamps):
+            start = index.timestamps[0] if start is None else start
+            end = index.timestamps[-1] if end is None else end
+            carried = index.latest_offset(start)
+            if carried is not None:
+                byte_start = carried[0]
+                byte_stop = max(byte_stop, carried[1])
+        chunks = _csv_rows(source, byte_start, byte_stop, fields)
+    if every:
+        return _forward_fill(chunks, start, end, every)
+    return chunks
+
+
+def _forward_fill(chunks: Iterator[List[dict]], start: Optional[int], end: Optional[int],
+                  every: int) -> Iterator[List[dict]]:
+    # one row per grid time start, start + every, ... end: the last stored row at or before it
+    if start is None or end is None:
+        return
+    grid = start
+    latest = None
+    filled = []
+    for chunk in chunks:
+        for row in chunk:
+            timestamp = parse_quote_timestamp(row["quote_timestamp"])
+            while grid < timestamp and grid <= end:
+                if latest is not None:
+                    filled.append({**latest, "quote_timestamp": format_timestamp(grid)})
+                grid += every
+            latest = row
+        if len(filled) >= rows_per_chunk:
+            yield filled
+            filled = []
+    while latest is not None and grid <= end:
+        filled.append({**latest, "quote_timestamp": format_timestamp(grid)})
+        grid += every
+        if len(filled) >= rows_per_chunk:
+            yield filled
+            filled = []
+    if filled:
+        yield filled
+
+
+def chain_identifiers(symbol: str, expiry: Optional[str] = None) -> Iterator[Tuple[str, str]]:
+    symbol_path = os.path.abspath(path.join(os.curdir, data_directory, symbol))
+    if not os.path.isdir(symbol_path):
+        return
+    expiries = [expiry] if expiry else sorted(os.listdir(symbol_path))
+    for optionExpiryDate in expiries:
+        try:
+            datetime.datetime.strptime(optionExpiryDate, "%d-%b-%Y")
+        except ValueError:
+            # raw snapshot days and other non expiry entries
+            continue
+        expiry_path = path.join(symbol_path, optionExpiryDate)
+        if not os.path.isdir(expiry_path):
+            continue
+        identifiers: Dict[str, None] = {}
+        for name in sorted(os.listdir(expiry_path)):
+            if name.endswith(columnar_store.columnar_suffix):
+                name = name[:-len(columnar_store.columnar_suffix)]
+            # identifiers end with the strike, e.g. ...CE17850.00
+            if name.rsplit(".", 1)[-1].isdigit():
+                identifiers[name] = None
+        for identifier in identifiers:
+            yield optionExpiryDate, identifier
+
+
+def query_chain(symbol: str, at: Optional[int] = None, expiry: Optional[str] = None,
+                fields: Sequence[str] = SERIES_FIELDS) -> Iterator[List[dict]]:
+    # last stored row at or before at for every contract of the chain, in chunks
+    chunk = []
+    for optionExpiryDate, identifier in chain_identifiers(symbol, expiry):
+        source = series_path(symbol, optionExpiryDate, identifier)
+        if source is None:
+            continue
+        if source.endswith(columnar_store.columnar_suffix):
+            series = columnar_store.read_series(source)
+            position = len(series) if at is None else int(np.searchsorted(series["quote_timestamp"], at, side="right"))
+            rows = next(columnar_rows(series[position - 1:position], fields), []) if position else []
+        else:
+            span = csv_index(source).latest_offset(at)
+            rows = next(_csv_rows(source, span[0], span[1], fields), []) if span else []
+        for row in rows:
+            chunk.append({"expiryDate": optionExpiryDate, "identifier": identifier, **row})
+        if len(chunk) >= rows_per_chunk:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
@@ -0,0 +1,131 @@
+# Copyright 2022 Rohit Sood
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import datetime
+import os
+import threading
+import time
+from typing import Dict, Optional, Set, Tuple
+from zoneinfo import ZoneInfo
+from structured_log import get_logger, fields
+
+
+IST = ZoneInfo("Asia/Kolkata")
+# trading time between 9:15 AM - 3:29 PM (IST)
+session_open_time = datetime.time(hour=9, minute=15)
+session_close_time = datetime.time(hour=15, minute=29)
+# The holiday file is checked for changes at most this often
+reload_interval_in_seconds = 60
+# No market is closed for longer than this, guards next_open against a bad holiday file
+max_days_ahead = 366
+
+log = get_logger("calendar")
+
+
+class MarketCalendar:
+    # Holidays are read once and session bounds are kept per day as epoch
+    # seconds, so is_open() is a couple of comparisons. The holiday file is
+    # re-read when its modification time changes.
+
+    def __init__(self, holiday_file: str = "market_holidays.txt"):
+        self.holiday_file = os.path.abspath(holiday_file)
+        self._holidays: Set[datetime.date] = set()
+        self._sessions: Dict[datetime.date, Optional[Tuple[float, float]]] = {}
+        self._mtime = None
+        self._checked_at = 0.0
+        self._day_bounds = (0.0, 0.0)
+        self._day_session: Optional[Tuple[float, float]] = None
+        self._lock = threading.Lock()
+        self.reload()
+
+    def reload(self) -> None:
+        holidays: Set[datetime.date] = set()
+        mtime = None
+        if os.path.exists(self.holiday_file):
+            mtime = os.path.getmtime(self.holiday_file)
+            with open(self.holiday_file) as f:
+                for index, line in enumerate(f):
+                    if len(str.strip(line)) == 0:
+                        continue
+                    holidays.add(datetime.datetime.strptime(str.strip(line.split('#')[1]), '%d-%b-%Y').date())
+        with self._lock:
+            self._holidays = holidays
+            self._sessions = {}
+            self._day_bounds = (0.0, 0.0)
+            self._mtime = mtime
+            self._checked_at = time.monotonic()
+        log.info("loaded market holidays", extra=fields(holidays=len(holidays), file=self.holiday_file))
+
+    def holidays(self) -> Set[datetime.date]:
+        self._check_reload()
+        return set(self._holidays)
+
+    def session(self, day: datetime.date) -> Optional[Tuple[datetime.datetime, datetime.datetime]]:
+        # open and close instants of the day, None on weekends and holidays
+        self._check_reload()
+        bounds = self._session_bounds(day)
+        if bounds is None:
+            return None
+        return (datetime.datetime.fromtimestamp(bounds[0], IST), datetime.datetime.fromtimestamp(bounds[1], IST))
+
+    def is_open(self, now: Optional[float] = None) -> bool:
+        now = time.time() if now is None else now
+        self._check_reload()
+        if not self._day_bounds[0] <= now < self._day_bounds[1]:
+            self._set_day(datetime.datetime.fromtimestamp(now, IST).date())
+        session = self._day_session
+        return session is not None and session[0] <= now <= session[1]
+
+    def next_open(self, now: Optional[float] = None) -> datetime.datetime:
+        # the current session's open if the market is open right now
+        now = time.time() if now is None else now
+        self._check_reload()
+        day = datetime.datetime.fromtimestamp(now, IST).date()
+        for offset in range(max_days_ahead):
+            bounds = self._session_bounds(day + datetime.timedelta(days=offset))
+            if bounds is not None and now <= bounds[1]:
+                return datetime.datetime.fromtimestamp(bounds[0], IST)
+        raise ValueError(f"no trading session in the next {max_days_ahead} days")
+
+    def next_close(self, now: Optional[float] = None) -> datetime.datetime:
+        now = time.time() if now is None else now
+        opens = self.next_open(now)
+        return datetime.datetime.fromtimestamp(self._session_bounds(opens.date())[1], IST)
+
+    def seconds_until_open(self, now: Optional[float] = None) -> float:
+        now = time.time() if now is None else now
+        return max(0.0, self.next_open(now).timestamp() - now)
+
+    def _set_day(self, day: datetime.date) -> None:
+        start = datetime.datetime.combine(day, datetime.time(), tzinfo=IST).timestamp()
+        self._day_session = self._session_bounds(day)
+        self._day_bounds = (start, start + 24 * 60 * 60)
+
+    def _session_bounds(self, day: datetime.date) -> Optional[Tuple[float, float]]:
+        if day in self._sessions:
+            return self._sessions[day]
+        bounds = None
+        if day.weekday() < 5 and day not in self._holidays:
+            bounds = (datetime.datetime.combine(day, session_open_time, tzinfo=IST).timestamp(),
+                      datetime.datetime.combine(day, session_close_time, tzinfo=IST).timestamp())
+        self._sessions[day] = bounds
+        return bounds
+
+    def _check_reload(self) -> None:
+        if time.monotonic() - self._checked_at < reload_interval_in_seconds:
+            return
+        self._checked_at = time.monotonic()
+        mtime = os.path.getmtime(self.holiday_file) if os.path.exists(self.holiday_file) else None
+        if mtime != self._mtime:
+            self.reload()
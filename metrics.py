@@ -0,0 +1,170 @@
+# Copyright 2022 Rohit Sood
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+
+# Latency buckets in seconds, from sub-millisecond writes to slow upstream fetches
+default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _labels(self, key: Tuple[str, ...], extra: str = "") -> str:
+        pairs = [f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, value: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + value
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def total(self) -> float:
+        # summed over every label set
+        with self._lock:
+            return sum(self._values.values())
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self._lock:
+            items = list(self._values.items())
+        lines.extend(f"{self.name}{self._labels(key)} {value}" for key, value in items)
+        return lines
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = default_buckets):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        # per label set: count per bucket (last one is +Inf), sum
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+            entry[0][position] += 1
+            entry[1][0] += value
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self._lock:
+            items = [(key, list(counts), total[0]) for key, (counts, total) in self._values.items()]
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                upper = "+Inf" if bound == float("inf") else repr(bound)
+                bucket_labels = self._labels(key, 'le="' + upper + '"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{self._labels(key)} {total}")
+            lines.append(f"{self.name}_count{self._labels(key)} {cumulative}")
+        return lines
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+registry: List[_Metric] = []
+
+
+def render_metrics() -> str:
+    # Prometheus text exposition format
+    return "\n".join(line for metric in registry for line in metric.render()) + "\n"
+
+
+# Hot path stages of the collector, tagged by symbol
+stage_seconds = Histogram("datapi_stage_seconds", "Time spent per collector stage", ("stage", "symbol"))
+file_write_seconds = Histogram("datapi_file_write_seconds", "Time spent writing one file's batch", ("symbol",))
+fetch_total = Counter("datapi_fetch_total", "Upstream requests by response status", ("symbol", "status"))
+rows_written_total = Counter("datapi_rows_written_total", "Rows flushed to disk", ("symbol",))
+rows_skipped_total = Counter("datapi_rows_skipped_total", "Contract rows not stored because nothing changed",
+                             ("symbol",))
+cycle_seconds = Histogram("datapi_cycle_seconds", "Duration of a collector cycle", ("tier",))
+tick_lag_seconds = Gauge("datapi_tick_lag_seconds", "How late the last tick started", ("tier",))
+ticks_skipped_total = Counter("datapi_ticks_skipped_total", "Ticks skipped because a cycle overran", ("tier",))
+# Upstream fetch control
+quotes_total = Counter("datapi_quotes_total", "Quotes fetched or given up on after retries", ("symbol", "outcome"))
+fetch_retries_total = Counter("datapi_fetch_retries_total", "Quote requests retried", ("symbol", "reason"))
+fetch_concurrency_limit = Gauge("datapi_fetch_concurrency_limit", "Upstream requests currently allowed in flight")
+fetch_circuit_state = Gauge("datapi_fetch_circuit_state", "Upstream circuit breaker, 0 closed, 1 half open, 2 open")
+# Fetch -> parse -> write pipeline
+pipeline_queue_depth = Gauge("datapi_pipeline_queue_depth", "Snapshots waiting for the next stage", ("stage",))
+pipeline_wait_seconds = Histogram("datapi_pipeline_wait_seconds", "Time spent waiting for room in a full queue",
+                                  ("stage",))
+# In-memory intraday rings
+intraday_contracts = Gauge("datapi_intraday_contracts", "Contracts held in the in-memory intraday store")
+intraday_evictions_total = Counter("datapi_intraday_evictions_total", "Contract rings dropped on expiry or a new day",
+                                   ("symbol",))
+intraday_rejected_total = Counter("datapi_intraday_rejected_total",
+                                  "Contract rows not kept in memory because the store is at its memory cap", ("symbol",))
+# Push stream to API clients
+stream_subscribers = Gauge("datapi_stream_subscribers", "Connected stream clients")
+stream_frames_total = Counter("datapi_stream_frames_total", "Frames serialized for stream clients", ("event",))
+stream_resyncs_total = Counter("datapi_stream_resyncs_total", "Slow stream clients whose backlog was dropped")
@@ -0,0 +1,58 @@
+# Copyright 2022 Rohit Sood
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import asyncio
+import os
+import time
+from typing import Awaitable, Callable, Dict, Optional
+
+
+# NSE cookies are reused for this long before the homepage is hit again
+cookie_ttl_in_seconds = int(os.environ.get("NSE_COOKIE_TTL", "300"))
+
+
+class NseSession:
+    # Process wide cookie cache. bootstrap() fetches a fresh set of cookies,
+    # concurrent callers that need a refresh wait on the same fetch.
+
+    def __init__(self, bootstrap: Callable[[], Awaitable[Dict[str, str]]], ttl: int = cookie_ttl_in_seconds):
+        self.bootstrap = bootstrap
+        self.ttl = ttl
+        self._cookies: Optional[Dict[str, str]] = None
+        self._expires_at = 0.0
+        self._lock: Optional[asyncio.Lock] = None
+
+    def is_fresh(self) -> bool:
+        return self._cookies is not None and time.monotonic() < self._expires_at
+
+    async def get_cookies(self) -> Dict[str, str]:
+        if self.is_fresh():
+            return self._cookies
+        return await self.refresh(self._cookies)
+
+    async def refresh(self, stale: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+        # stale is the cookie set the caller found wanting, if another worker
+        # already replaced it while we waited on the lock there is nothing to do
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._cookies is not stale and self.is_fresh():
+                return self._cookies
+            self._cookies = await self.bootstrap()
+            self._expires_at = time.monotonic() + self.ttl
+            return self._cookies
+
+    def reset(self) -> None:
+        self._cookies = None
+        self._expires_at = 0.0
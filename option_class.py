@@ -268,13 +268,10 @@ class Root:
             _fut_timestamp = str(obj.get("fut_timestamp"))
             _opt_timestamp = str(obj.get("opt_timestamp"))
             _stocks = [Stock.from_dict(y) for y in obj.get("stocks")]
-            noDupes=[]
-            [noDupes.append(i) for i in obj.get("strikePrices") if not noDupes.count(i)]
-            _strikePrices = noDupes
+            # order preserving dedupe
+            _strikePrices = list(dict.fromkeys(obj.get("strikePrices")))
             _strikePrices.remove(0)
-            noDupes=[]
-            [noDupes.append(i) for i in obj.get("expiryDates") if not noDupes.count(i)]
-            _expiryDates = noDupes
+            _expiryDates = list(dict.fromkeys(obj.get("expiryDates")))
             return Root(_info, _underlyingValue, _vfq, _fut_timestamp, _opt_timestamp, _stocks, _strikePrices, _expiryDates)
         except:
             traceback.print_exception(*sys.exc_info())
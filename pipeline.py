@@ -0,0 +1,192 @@
+# Copyright 2022 Rohit Sood
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Fetched snapshots go through three stages, joined by bounded queues:
+#   fetchers --raw--> parse (process pool) --parsed--> writer (one thread)
+# A full queue makes the stage feeding it wait, so a slow disk slows the
+# fetchers down instead of piling snapshots up in memory. Parsing in other
+# processes keeps big chains from holding the GIL against the event loop.
+# The writer stores whatever is queued as one batch and flushes it.
+
+import asyncio
+import concurrent.futures
+import multiprocessing
+import os
+import time
+from dataclasses import dataclass
+from typing import List, Optional, Set
+from chain_parser import Chain, parse_payload
+from metrics import pipeline_queue_depth, pipeline_wait_seconds, stage_seconds
+from structured_log import fields, get_logger
+
+
+# Fetch, parse and store as stages, off means save_data right after each fetch
+pipeline_enabled = os.environ.get("PIPELINE", "True") == "True"
+parse_workers = int(os.environ.get("PARSE_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Snapshots waiting in each queue before the stage feeding it has to wait
+max_queued_snapshots = int(os.environ.get("PIPELINE_QUEUE_SIZE", "32"))
+# Snapshots stored by the writer before each flush
+max_write_batch = int(os.environ.get("PIPELINE_WRITE_BATCH", "64"))
+
+log = get_logger("pipeline")
+
+
+@dataclass
+class _Snapshot:
+    symbol: str
+    raw: str
+    stored: asyncio.Future
+    chain: Optional[Chain] = None
+
+
+class Pipeline:
+
+    def __init__(self, workers: int = parse_workers, max_queued: int = max_queued_snapshots,
+                 max_batch: int = max_write_batch):
+        self.workers = max(workers, 1)
+        self.max_queued = max_queued
+        self.max_batch = max_batch
+        self._raw: Optional[asyncio.Queue] = None
+        self._parsed: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._parse_pool: Optional[concurrent.futures.ProcessPoolExecutor] = None
+        self._writer: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        # every snapshot submitted and not yet stored, including those waiting for room in the raw queue
+        self._pending: Set[asyncio.Future] = set()
+        self._closing = False
+
+    def start(self) -> None:
+        # on the running loop, the first submit does it
+        if self._raw is not None:
+            return
+        self._raw = asyncio.Queue(self.max_queued)
+        self._parsed = asyncio.Queue(self.max_queued)
+        # spawned: forking a process that runs threads and an event loop isn't safe
+        self._parse_pool = concurrent.futures.ProcessPoolExecutor(self.workers,
+                                                                  mp_context=multiprocessing.get_context("spawn"))
+        self._writer = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="writer")
+        self._tasks = [asyncio.ensure_future(self._parse_loop()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.ensure_future(self._write_loop()))
+        log.info("pipeline started", extra=fields(parse_workers=self.workers, queue_size=self.max_queued))
+
+    async def submit(self, symbol: str, raw: str) -> Chain:
+        # returns the parsed chain once the snapshot is stored, waits first if the parse stage is behind
+        if self._closing:
+            raise RuntimeError("pipeline is shutting down")
+        self.start()
+        snapshot = _Snapshot(symbol, raw, asyncio.get_running_loop().create_future())
+        self._pending.add(snapshot.stored)
+        snapshot.stored.add_done_callback(self._stored)
+        try:
+            await self._put(self._raw, snapshot, "raw")
+        except asyncio.CancelledError:
+            # never queued, close() must not wait for it
+            snapshot.stored.cancel()
+            raise
+        # a fetcher that gives up doesn't take its snapshot out of the pipeline
+        return await asyncio.shield(snapshot.stored)
+
+    async def close(self) -> None:
+        # stops taking snapshots and returns once everything queued is stored
+        self._closing = True
+        if self._raw is None:
+            return
+        while self._pending:
+            await asyncio.wait(set(self._pending))
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._parse_pool.shutdown()
+        self._writer.shutdown()
+        log.info("pipeline drained")
+
+    def _stored(self, stored: asyncio.Future) -> None:
+        self._pending.discard(stored)
+        # the outcome is collected even if the fetcher stopped waiting for it
+        if not stored.cancelled():
+            stored.exception()
+
+    async def _put(self, queue: asyncio.Queue, snapshot: _Snapshot, stage: str) -> None:
+        started = time.perf_counter()
+        await queue.put(snapshot)
+        waited = time.perf_counter() - started
+        if waited > 0.001:
+            pipeline_wait_seconds.observe(waited, stage=stage)
+        pipeline_queue_depth.set(queue.qsize(), stage=stage)
+
+    async def _parse_loop(self) -> None:
+        # imported here, data_management picks its configuration at import
+        from data_management import capture_depth
+        loop = asyncio.get_running_loop()
+        while True:
+            snapshot = await self._raw.get()
+            pipeline_queue_depth.set(self._raw.qsize(), stage="raw")
+            try:
+                with stage_seconds.time(stage="parse", symbol=snapshot.symbol):
+                    snapshot.chain = await loop.run_in_executor(self._parse_pool, parse_payload, snapshot.raw,
+                                                                capture_depth)
+            except Exception as e:
+                # e.g. an error page that passed for JSON, nothing is stored
+                _resolve(snapshot, exception=e)
+            else:
+                await self._put(self._parsed, snapshot, "parsed")
+            finally:
+                self._raw.task_done()
+
+    async def _write_loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._parsed.get()]
+            while len(batch) < self.max_batch and not self._parsed.empty():
+                batch.append(self._parsed.get_nowait())
+            pipeline_queue_depth.set(self._parsed.qsize(), stage="parsed")
+            try:
+                errors = await loop.run_in_executor(self._writer, _write_batch, batch)
+            except Exception as e:
+                errors = [e] * len(batch)
+            finally:
+                for _ in batch:
+                    self._parsed.task_done()
+            for snapshot, error in zip(batch, errors):
+                _resolve(snapshot, exception=error)
+
+
+def _write_batch(batch: List[_Snapshot]) -> List[Optional[Exception]]:
+    # on the writer thread: every snapshot of the batch, then one flush
+    from data_management import flush_strike_data, store_chain
+    errors: List[Optional[Exception]] = []
+    for snapshot in batch:
+        try:
+            store_chain(snapshot.symbol, snapshot.raw, snapshot.chain)
+            errors.append(None)
+        except Exception as e:
+            errors.append(e)
+    started = time.time()
+    rows = flush_strike_data()
+    log.info("flushed rows", extra=fields(snapshots=len(batch), rows=rows,
+                                          flush_ms=round((time.time() - started) * 1000, 1)))
+    return errors
+
+
+def _resolve(snapshot: _Snapshot, exception: Optional[Exception] = None) -> None:
+    if snapshot.stored.done():
+        return
+    if exception is None:
+        snapshot.stored.set_result(snapshot.chain)
+    else:
+        snapshot.stored.set_exception(exception)
+
+
+# Shared by every fetcher on the loop
+pipeline = Pipeline()
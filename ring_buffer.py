@@ -0,0 +1,225 @@
+# Copyright 2022 Rohit Sood
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import datetime
+import math
+import os
+import threading
+from functools import lru_cache
+from typing import Dict, List, Optional, Set, Tuple
+from zoneinfo import ZoneInfo
+import numpy as np
+from chain_parser import Chain, Contract
+from columnar_store import RECORD_DTYPE, build_records, parse_quote_timestamp
+from metrics import intraday_contracts, intraday_evictions_total, intraday_rejected_total
+
+
+# Keep the current session of every contract in memory
+keep_intraday = os.environ.get("INTRADAY_RING", "True") == "True"
+# Snapshots per contract of a symbol polled every minute, a session is 375.
+# Symbols on a faster tier (stock_tiers.txt) get proportionally more, e.g.
+# 4800 at 5 seconds. Once a ring is full the oldest rows are overwritten,
+# windows reaching further back are answered with what is left and flagged
+# as truncated.
+ring_capacity = int(os.environ.get("RING_CAPACITY", "400"))
+# Rings are only allocated while the bytes of all of them stay under this
+ring_memory_cap_in_bytes = int(os.environ.get("RING_MEMORY_MB", "512")) * 1024 * 1024
+
+_IST = ZoneInfo("Asia/Kolkata")
+
+
+class ContractRing:
+    # Fixed-capacity ring of RECORD_DTYPE rows, oldest overwritten first.
+    # Rows are appended in quote timestamp order.
+
+    def __init__(self, expiry: datetime.date, capacity: int = ring_capacity):
+        self.expiry = expiry
+        self.records = np.zeros(capacity, dtype=RECORD_DTYPE)
+        self.count = 0
+        # position the next row is written to
+        self.head = 0
+
+    @property
+    def capacity(self) -> int:
+        return len(self.records)
+
+    def last_timestamp(self) -> int:
+        return int(self.records["quote_timestamp"][self.head - 1]) if self.count else 0
+
+    def overwritten_before(self, start: Optional[int]) -> Optional[int]:
+        # the oldest row kept, when rows at or after start have been overwritten
+        if self.count < self.capacity:
+            return None
+        oldest = int(self.records["quote_timestamp"][self.head])
+        return oldest if start is None or start < oldest else None
+
+    def append(self, record: np.void) -> None:
+        self.records[self.head] = record
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def _position(self, i: int) -> int:
+        # physical slot of the i-th oldest row
+        return (self.head - self.count + i) % self.capacity
+
+    def _bisect(self, timestamp: int, right: bool) -> int:
+        timestamps = self.records["quote_timestamp"]
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            value = timestamps[self._position(middle)]
+            if value < timestamp or (right and value == timestamp):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def window(self, start: Optional[int] = None, end: Optional[int] = None) -> np.ndarray:
+        # copy of the rows between start and end (epoch seconds) in time order,
+        # the cost is the size of the window, not of the ring
+        first = 0 if start is None else self._bisect(start, right=False)
+        last = self.count if end is None else self._bisect(end, right=True)
+        if first >= last:
+            return np.empty(0, dtype=RECORD_DTYPE)
+        return self.records.take(np.arange(first, last) + (self.head - self.count), mode="wrap")
+
+
+class IntradayStore:
+    # Every option contract's rows of the current session, filled by the
+    # collector on each snapshot and queried by the API without touching disk.
+    # A symbol's rings are dropped when its first snapshot of a new day
+    # arrives, a contract's once its expiry leaves the chain's expiryDates.
+
+    def __init__(self, capacity: int = ring_capacity, memory_cap: int = ring_memory_cap_in_bytes):
+        self.capacity = capacity
+        self.memory_cap = memory_cap
+        # seconds between snapshots of the symbols not polled every minute
+        self._intervals: Dict[str, float] = {}
+        self._bytes = 0
+        self._rings: Dict[str, ContractRing] = {}
+        self._symbols: Dict[str, Set[str]] = {}
+        self._days: Dict[str, datetime.date] = {}
+        self._lock = threading.Lock()
+
+    def set_intervals(self, intervals: Dict[str, float]) -> None:
+        # symbol to polling interval (seconds), rings allocated from now on are sized by it
+        with self._lock:
+            self._intervals = dict(intervals)
+
+    def capacity_for(self, symbol: str) -> int:
+        interval = self._intervals.get(symbol)
+        if not interval:
+            return self.capacity
+        return max(1, math.ceil(self.capacity * 60 / interval))
+
+    def ring_bytes(self, symbol: str) -> int:
+        return self.capacity_for(symbol) * RECORD_DTYPE.itemsize
+
+    def memory_used(self) -> int:
+        return self._bytes
+
+    def add(self, symbol: str, chain: Chain, contracts: List[Contract]) -> int:
+        # appends one row per contract, returns the number appended
+        if not contracts:
+            return 0
+        quote_timestamp = parse_quote_timestamp(chain.opt_timestamp)
+        day = datetime.datetime.fromtimestamp(quote_timestamp, _IST).date()
+        records = build_records(contracts, chain.opt_timestamp)
+        appended = rejected = 0
+        with self._lock:
+            if self._days.get(symbol) != day:
+                self._days[symbol] = day
+                self._evict(symbol, lambda ring: True)
+            expiries = {_parse_expiry(x) for x in chain.expiryDates}
+            self._evict(symbol, lambda ring: ring.expiry < day or ring.expiry not in expiries)
+            identifiers = self._symbols.setdefault(symbol, set())
+            capacity = self.capacity_for(symbol)
+            ring_bytes = self.ring_bytes(symbol)
+            for contract, record in zip(contracts, records):
+                ring = self._rings.get(contract.identifier)
+                if ring is None:
+                    if self._bytes + ring_bytes > self.memory_cap:
+                        rejected += 1
+                        continue
+                    ring = self._rings[contract.identifier] = ContractRing(_parse_expiry(contract.expiryDate),
+                                                                           capacity)
+                    self._bytes += ring.records.nbytes
+                    identifiers.add(contract.identifier)
+                elif quote_timestamp <= ring.last_timestamp():
+                    # the same snapshot fetched again
+                    continue
+                ring.append(record)
+                appended += 1
+            intraday_contracts.set(len(self._rings))
+        if rejected:
+            intraday_rejected_total.inc(rejected, symbol=symbol)
+        return appended
+
+    def window(self, identifier: str, start: Optional[int] = None,
+               end: Optional[int] = None) -> Tuple[Optional[np.ndarray], Optional[int]]:
+        # rows of one contract between start and end (epoch seconds), None for an
+        # unknown contract, and the oldest row's time when the ring no longer
+        # holds the start of the window
+        with self._lock:
+            ring = self._rings.get(identifier)
+            if ring is None:
+                return None, None
+            return ring.window(start, end), ring.overwritten_before(start)
+
+    def latest(self, identifier: str, seconds: int) -> Tuple[Optional[np.ndarray], Optional[int]]:
+        # the last seconds of one contract, counted back from its newest row, as window
+        with self._lock:
+            ring = self._rings.get(identifier)
+            if ring is None:
+                return None, None
+            start = ring.last_timestamp() - seconds
+            return ring.window(start, None), ring.overwritten_before(start)
+
+    def identifiers(self, symbol: str) -> List[str]:
+        with self._lock:
+            return sorted(self._symbols.get(symbol, ()))
+
+    def forget(self, symbol: str) -> None:
+        with self._lock:
+            self._evict(symbol, lambda ring: True)
+            self._symbols.pop(symbol, None)
+            self._days.pop(symbol, None)
+            intraday_contracts.set(len(self._rings))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._rings = {}
+            self._symbols = {}
+            self._days = {}
+            self._bytes = 0
+            intraday_contracts.set(0)
+
+    def _evict(self, symbol: str, expired) -> None:
+        identifiers = self._symbols.get(symbol, set())
+        evicted = [x for x in identifiers if expired(self._rings[x])]
+        for identifier in evicted:
+            identifiers.discard(identifier)
+            self._bytes -= self._rings.pop(identifier).records.nbytes
+        if evicted:
+            intraday_evictions_total.inc(len(evicted), symbol=symbol)
+
+
+@lru_cache(maxsize=1024)
+def _parse_expiry(expiry: str) -> datetime.date:
+    # 25-Aug-2022
+    return datetime.datetime.strptime(expiry, "%d-%b-%Y").date()
+
+
+# Filled by the collector, read by the API
+intraday_store = IntradayStore()
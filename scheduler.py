@@ -0,0 +1,85 @@
+# Copyright 2022 Rohit Sood
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import asyncio
+import math
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, List
+import metrics
+from structured_log import get_logger, fields
+
+
+log = get_logger("scheduler")
+
+
+@dataclass
+class TierStats:
+    period: float
+    symbols: int
+    ticks: int = 0
+    skipped: int = 0
+    last_lag: float = 0.0
+    max_lag: float = 0.0
+    last_cycle: float = 0.0
+
+
+class TieredScheduler:
+    # Every tier ticks on wall clock multiples of its period, so a 60s tier
+    # fires at :00 of every minute no matter how long the previous cycle took.
+    # A cycle that runs past the next tick skips it instead of queueing it.
+    # run_cycle gets the tier's symbols and the next tick as its deadline.
+
+    def __init__(self, tiers: Dict[float, List[str]], run_cycle: Callable[[List[str], float], Awaitable[None]]):
+        self.tiers = tiers
+        self.run_cycle = run_cycle
+        self.stats = {period: TierStats(period, len(symbols)) for period, symbols in tiers.items()}
+
+    async def run(self, keep_running: Callable[[], bool]) -> None:
+        # returns once keep_running() is False for every tier
+        await asyncio.gather(*(self._run_tier(period, symbols, keep_running)
+                               for period, symbols in self.tiers.items() if symbols))
+
+    async def _run_tier(self, period: float, symbols: List[str], keep_running: Callable[[], bool]) -> None:
+        stats = self.stats[period]
+        next_tick = math.ceil(time.time() / period) * period
+        while True:
+            await asyncio.sleep(max(0.0, next_tick - time.time()))
+            started = time.time()
+            stats.ticks += 1
+            stats.last_lag = started - next_tick
+            stats.max_lag = max(stats.max_lag, stats.last_lag)
+            metrics.tick_lag_seconds.set(stats.last_lag, tier=period)
+            await self.run_cycle(symbols, next_tick + period)
+            finished = time.time()
+            stats.last_cycle = finished - started
+            metrics.cycle_seconds.observe(stats.last_cycle, tier=period)
+            log.info("tier cycle", extra=fields(tier=period, symbols=len(symbols), cycle_s=round(stats.last_cycle, 2),
+                                                 lag_ms=round(stats.last_lag * 1000, 1), skipped=stats.skipped))
+            if not keep_running():
+                return
+            next_tick += period
+            if finished > next_tick:
+                # overran, coalesce into the next tick still ahead of us
+                missed = math.ceil((finished - next_tick) / period)
+                stats.skipped += missed
+                metrics.ticks_skipped_total.inc(missed, tier=period)
+                next_tick += missed * period
+
+
+def group_tiers(stock_list: List[str], intervals: Dict[str, float], default_interval: float) -> Dict[float, List[str]]:
+    tiers: Dict[float, List[str]] = {}
+    for symbol in stock_list:
+        tiers.setdefault(intervals.get(symbol, default_interval), []).append(symbol)
+    return tiers
@@ -0,0 +1,337 @@
+# Copyright 2022 Rohit Sood
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Splits the symbol universe across hosts and, on each host, across worker
+# processes. Both levels use a consistent hash ring, so adding or losing a
+# node only moves the symbols that node owned. Every file under
+# data/<symbol>/ is written by the one process that owns the symbol.
+#
+#   SHARD_NODES=a,b,c SHARD_ID=b  this host polls the symbols ring(a,b,c) gives to b
+#   SHARD_WORKERS=4               this host's symbols are split over 4 collector processes
+#
+# Local workers can also be run without the API, e.g. against the stub server:
+#   DEBUG=True NSE_BASE_URL=http://127.0.0.1:8099 python sharding.py --workers 3
+
+import argparse
+import asyncio
+import bisect
+import hashlib
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional
+from structured_log import configure_logging, fields, get_logger
+
+
+# Hosts sharing the symbol list and the name of this one
+shard_nodes = [x.strip() for x in os.environ.get("SHARD_NODES", "").split(",") if x.strip()]
+shard_id = os.environ.get("SHARD_ID", "")
+# Collector processes on this host, 1 keeps the collector inside the API process
+shard_workers = int(os.environ.get("SHARD_WORKERS", "1"))
+# Points per node on the ring, more points give a more even split
+ring_replicas = 64
+# How often the coordinator checks its workers, and how long it waits before restarting one
+check_interval_in_seconds = 1.0
+restart_delay_in_seconds = 5.0
+max_restart_delay_in_seconds = 300.0
+# How long symbols wait for their old worker to let go before they are handed over anyway
+handover_timeout_in_seconds = 30.0
+
+log = get_logger("sharding")
+
+
+def _ring_hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+
+    def __init__(self, nodes: Iterable[str], replicas: int = ring_replicas):
+        self.nodes = sorted(set(nodes))
+        points = sorted((_ring_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(replicas))
+        self._hashes = [x[0] for x in points]
+        self._owners = [x[1] for x in points]
+
+    def node_for(self, symbol: str) -> str:
+        if not self._owners:
+            raise ValueError("hash ring has no nodes")
+        position = bisect.bisect(self._hashes, _ring_hash(symbol)) % len(self._hashes)
+        return self._owners[position]
+
+    def assign(self, symbols: Iterable[str]) -> Dict[str, List[str]]:
+        assignment: Dict[str, List[str]] = {node: [] for node in self.nodes}
+        for symbol in symbols:
+            assignment[self.node_for(symbol)].append(symbol)
+        return assignment
+
+
+def host_filter() -> Optional[Callable[[str], bool]]:
+    # None when this host owns every symbol
+    if not shard_nodes:
+        return None
+    if shard_id not in shard_nodes:
+        raise ValueError(f"SHARD_ID {shard_id!r} is not one of SHARD_NODES {shard_nodes}")
+    ring = HashRing(shard_nodes)
+    return lambda symbol: ring.node_for(symbol) == shard_id
+
+
+def host_symbols(stock_list: List[str]) -> List[str]:
+    owns = host_filter()
+    return stock_list if owns is None else [x for x in stock_list if owns(x)]
+
+
+def run_worker(worker_id: str, symbols: List[str], connection) -> None:
+    # process entry point: the collector loop over the symbols the coordinator
+    # assigned. New assignments arrive on connection as (generation, symbols),
+    # each is confirmed with (generation, symbols) once released symbols are let go.
+    configure_logging()
+    # imported here, the collector modules read their configuration at import
+    from data_management import close_strike_data, release_symbols
+    from pipeline import pipeline
+    from snapshot_cache import snapshot_cache
+    from utility import quotes_in_flight, start_collector
+
+    owned = set(symbols)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    async def release(released):
+        # quotes of the symbols already under way are stored first
+        while quotes_in_flight & released:
+            await asyncio.sleep(0.05)
+        for symbol in released:
+            snapshot_cache.forget(symbol)
+        await loop.run_in_executor(None, release_symbols, released)
+
+    async def main():
+        collector = asyncio.ensure_future(start_collector(owns=lambda symbol: symbol in owned))
+
+        def receive():
+            nonlocal owned
+            while True:
+                try:
+                    generation, assigned = connection.recv()
+                    assigned = set(assigned)
+                except (EOFError, OSError):
+                    # the coordinator is gone, don't keep polling symbols it may hand to someone else
+                    loop.call_soon_threadsafe(collector.cancel)
+                    return
+                released = owned - assigned
+                owned = assigned
+                log.info("assignment changed", extra=fields(worker=worker_id, symbols=len(owned),
+                                                            released=len(released)))
+                if released:
+                    try:
+                        asyncio.run_coroutine_threadsafe(release(released), loop).result()
+                    except Exception:
+                        log.exception("symbols not released cleanly", extra=fields(worker=worker_id))
+                # the coordinator hands released symbols over once this process let go
+                try:
+                    connection.send((generation, sorted(owned)))
+                except (BrokenPipeError, OSError):
+                    pass
+
+        threading.Thread(target=receive, daemon=True).start()
+        try:
+            await collector
+        except asyncio.CancelledError:
+            pass
+        finally:
+            loop.stop()
+
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    log.info("worker started", extra=fields(worker=worker_id, pid=os.getpid(), symbols=len(owned)))
+    # run like the API process does, the collector stops the loop itself in test mode
+    loop.create_task(main())
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # snapshots already fetched are stored before the files are closed
+        loop.run_until_complete(pipeline.close())
+        close_strike_data()
+
+
+class _Worker:
+
+    def __init__(self, worker_id: str):
+        self.worker_id = worker_id
+        self.process: Optional[multiprocessing.Process] = None
+        self.connection = None
+        self.restarts = 0
+        self.restart_at = 0.0
+        self.finished = False
+        # the last assignment the worker confirmed
+        self.generation = 0
+
+    def alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+
+class Coordinator:
+    # Runs one collector process per worker and keeps the symbol assignment
+    # in line with the workers that are alive: a crashed worker's symbols go
+    # to the others until it has been restarted.
+
+    def __init__(self, symbols: List[str], workers: int = shard_workers):
+        self.symbols = symbols
+        self._context = multiprocessing.get_context("spawn")
+        self._workers = [_Worker(f"worker-{i}") for i in range(workers)]
+        self._assignment: Dict[str, List[str]] = {}
+        # symbols each worker confirmed it polls, behind _assignment while a handover is under way
+        self._confirmed: Dict[str, List[str]] = {}
+        self._generation = 0
+        self._stopping = False
+
+    def assignment(self) -> Dict[str, List[str]]:
+        return dict(self._assignment)
+
+    def confirmed(self) -> Dict[str, List[str]]:
+        return dict(self._confirmed)
+
+    async def run(self) -> None:
+        for worker in self._workers:
+            self._start(worker)
+        await self._reassign()
+        while not self._stopping:
+            await asyncio.sleep(check_interval_in_seconds)
+            await self.check()
+            if all(worker.finished for worker in self._workers):
+                log.info("all workers finished")
+                return
+
+    async def check(self) -> None:
+        changed = False
+        for worker in self._workers:
+            if worker.alive():
+                # confirmations of workers that gained symbols or kept theirs
+                self._receive(worker)
+                continue
+            if worker.finished:
+                continue
+            if worker.process is not None:
+                exitcode = worker.process.exitcode
+                worker.process = None
+                worker.connection.close()
+                self._confirmed.pop(worker.worker_id, None)
+                if exitcode == 0:
+                    # the collector loop returned, e.g. market closed in test mode
+                    worker.finished = True
+                    changed = True
+                    continue
+                delay = min(restart_delay_in_seconds * 2 ** worker.restarts, max_restart_delay_in_seconds)
+                worker.restarts += 1
+                worker.restart_at = time.monotonic() + delay
+                log.warning("worker died", extra=fields(worker=worker.worker_id, exitcode=exitcode,
+                                                        restart_in_s=delay))
+                changed = True
+            elif time.monotonic() >= worker.restart_at:
+                self._start(worker)
+                changed = True
+        if changed:
+            await self._reassign()
+
+    def stop(self) -> None:
+        self._stopping = True
+        for worker in self._workers:
+            if worker.alive():
+                worker.process.terminate()
+        for worker in self._workers:
+            if worker.process is not None:
+                worker.process.join(10)
+
+    def _start(self, worker: _Worker) -> None:
+        # starts with no symbols, the next reassignment hands them over, so a
+        # symbol is never given to the new process before the old owner let go
+        parent, child = self._context.Pipe()
+        worker.connection = parent
+        # not daemonic, the worker runs the pipeline's parse pool. It still
+        # stops with the coordinator, once its end of the pipe is closed.
+        worker.process = self._context.Process(target=run_worker, args=(worker.worker_id, [], child),
+                                               name=worker.worker_id)
+        worker.process.start()
+        child.close()
+
+    async def _reassign(self) -> None:
+        live = [worker for worker in self._workers if worker.alive()]
+        if not live:
+            self._assignment = {}
+            return
+        assignment = HashRing(worker.worker_id for worker in live).assign(self.symbols)
+        # confirmations of an earlier assignment that arrive late are told apart by their generation
+        self._generation += 1
+        # workers losing symbols are told first, and the others only once those
+        # have stored what they fetched and dropped their state of the symbols
+        losing = [worker for worker in live
+                  if set(self._assignment.get(worker.worker_id, [])) - set(assignment[worker.worker_id])]
+        for worker in losing:
+            self._send(worker, assignment[worker.worker_id])
+        await self._released(losing, self._generation)
+        for worker in live:
+            if worker not in losing:
+                self._send(worker, assignment[worker.worker_id])
+        self._assignment = assignment
+        log.info("symbols assigned", extra=fields(**{worker_id: len(x) for worker_id, x in assignment.items()}))
+
+    def _send(self, worker: _Worker, symbols: List[str]) -> None:
+        try:
+            worker.connection.send((self._generation, symbols))
+        except (BrokenPipeError, OSError):
+            pass
+
+    def _receive(self, worker: _Worker) -> None:
+        # reads the worker's pending confirmations, the last one is what it polls now
+        try:
+            while worker.connection.poll():
+                worker.generation, self._confirmed[worker.worker_id] = worker.connection.recv()
+        except (EOFError, OSError):
+            pass
+
+    async def _released(self, workers: List[_Worker], generation: int) -> None:
+        # waits for each worker to confirm this generation, a dead worker lets go by dying
+        waiting = list(workers)
+        deadline = time.monotonic() + handover_timeout_in_seconds
+        while waiting and time.monotonic() < deadline:
+            for worker in list(waiting):
+                if worker.alive():
+                    self._receive(worker)
+                if not worker.alive() or worker.generation == generation:
+                    waiting.remove(worker)
+            if waiting:
+                await asyncio.sleep(0.05)
+        for worker in waiting:
+            log.warning("symbols handed over before their worker let go", extra=fields(worker=worker.worker_id))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the collector as sharded worker processes")
+    parser.add_argument("--workers", type=int, default=max(shard_workers, 2))
+    args = parser.parse_args()
+    configure_logging()
+    from utility import getstocklist
+    coordinator = Coordinator(host_symbols(getstocklist()), args.workers)
+    try:
+        asyncio.run(coordinator.run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        coordinator.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+# Copyright 2022 Rohit Sood
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import bisect
+import datetime
+import hashlib
+import json
+import os
+import struct
+import threading
+import zlib
+from dataclasses import dataclass
+from typing import IO, Dict, Iterable, Iterator, List, Optional, Tuple
+from zoneinfo import ZoneInfo
+
+
+# Raw responses of one symbol for one day are appended, zlib compressed, to
+# <date>.seg. <date>.idx holds one fixed-width entry per snapshot. A snapshot
+# identical to an earlier one of the same day points at the earlier frame
+# instead of being stored again.
+segment_suffix = ".seg"
+index_suffix = ".idx"
+# A compacted day: the frames, then their index entries, then PACK_FOOTER
+pack_suffix = ".pack"
+compression_level = int(os.environ.get("ARCHIVE_COMPRESSION_LEVEL", "6"))
+
+# timestamp (epoch microseconds), frame offset, frame length, sha1 of the raw payload
+INDEX_ENTRY = struct.Struct("<qqI20s")
+# magic, offset of the first index entry, number of index entries
+PACK_FOOTER = struct.Struct("<8sqI")
+pack_magic = b"DATAPIPK"
+
+# per-fetch raw files are data/<symbol>/<date>/<HHMMSSffffff>, IST wall clock
+_IST = ZoneInfo("Asia/Kolkata")
+
+
+@dataclass
+class ArchiveEntry:
+    timestamp: int
+    offset: int
+    length: int
+    digest: bytes
+
+
+class _OpenSegment:
+
+    def __init__(self, segment_path: str, index_path: str):
+        self.segment = open(segment_path, mode="ab")
+        self.index = open(index_path, mode="ab")
+        self.offset = self.segment.seek(0, os.SEEK_END)
+        self.frames: Dict[bytes, Tuple[int, int]] = {}
+        for entry in read_index(index_path):
+            self.frames[entry.digest] = (entry.offset, entry.length)
+
+    def close(self) -> None:
+        self.segment.close()
+        self.index.close()
+
+
+class SnapshotArchive:
+
+    def __init__(self, data_directory: str):
+        self.data_directory = data_directory
+        self._segments: Dict[Tuple[str, str], _OpenSegment] = {}
+        self._lock = threading.Lock()
+
+    def append(self, symbol: str, stock_quote_data: str, when: datetime.datetime) -> bool:
+        # returns False when the snapshot was stored as a reference to an identical one
+        payload = stock_quote_data.encode()
+        digest = hashlib.sha1(payload).digest()
+        timestamp = to_timestamp(when)
+        with self._lock:
+            segment = self._segment(symbol, when.date().isoformat())
+            frame = segment.frames.get(digest)
+            stored = frame is None
+            if stored:
+                compressed = zlib.compress(payload, compression_level)
+                segment.segment.write(compressed)
+                segment.segment.flush()
+                frame = (segment.offset, len(compressed))
+                segment.offset += len(compressed)
+                segment.frames[digest] = frame
+            segment.index.write(INDEX_ENTRY.pack(timestamp, frame[0], frame[1], digest))
+            segment.index.flush()
+        return stored
+
+    def forget(self, symbol: str) -> None:
+        # closes the symbol's segment, its offsets are read again if it comes back
+        with self._lock:
+            for key in [key for key in self._segments if key[0] == symbol]:
+                self._segments.pop(key).close()
+
+    def close(self) -> None:
+        with self._lock:
+            for segment in self._segments.values():
+                segment.close()
+            self._segments.clear()
+
+    def _segment(self, symbol: str, day: str) -> _OpenSegment:
+        segment = self._segments.get((symbol, day))
+        if segment is None:
+            # a new day for this symbol, the previous day's files are done
+            for key in [key for key in self._segments if key[0] == symbol]:
+                self._segments.pop(key).close()
+            symbol_path = os.path.join(self.data_directory, symbol)
+            os.makedirs(symbol_path, exist_ok=True)
+            segment = _OpenSegment(os.path.join(symbol_path, day + segment_suffix),
+                                   os.path.join(symbol_path, day + index_suffix))
+            self._segments[(symbol, day)] = segment
+        return segment
+
+
+def to_timestamp(when: datetime.datetime) -> int:
+    return int(when.timestamp()) * 1000000 + when.microsecond
+
+
+def read_index(index_path: str) -> List[ArchiveEntry]:
+    if not os.path.exists(index_path):
+        return []
+    with open(index_path, mode="rb") as f:
+        data = f.read()
+    # a partially written trailing entry is ignored
+    usable = len(data) - len(data) % INDEX_ENTRY.size
+    return [ArchiveEntry(*fields) for fields in INDEX_ENTRY.iter_unpack(data[:usable])]
+
+
+def read_frame(segment: IO, entry: ArchiveEntry) -> str:
+    segment.seek(entry.offset)
+    return zlib.decompress(segment.read(entry.length)).decode()
+
+
+def archive_paths(data_directory: str, symbol: str, day: str) -> Tuple[str, str]:
+    symbol_path = os.path.join(data_directory, symbol)
+    return os.path.join(symbol_path, day + segment_suffix), os.path.join(symbol_path, day + index_suffix)
+
+
+def read_snapshot(data_directory: str, symbol: str, day: str, when: datetime.datetime) -> Optional[str]:
+    # latest snapshot taken at or before when
+    segment_path, index_path = archive_paths(data_directory, symbol, day)
+    entries = read_index(index_path)
+    position = bisect.bisect_right([entry.timestamp for entry in entries], to_timestamp(when))
+    if position == 0:
+        return None
+    with open(segment_path, mode="rb") as segment:
+        return read_frame(segment, entries[position - 1])
+
+
+def iter_snapshots(data_directory: str, symbol: str, day: str) -> Iterator[Tuple[int, str]]:
+    segment_path, index_path = archive_paths(data_directory, symbol, day)
+    entries = read_index(index_path)
+    if not entries:
+        return
+    with open(segment_path, mode="rb") as segment:
+        for entry in entries:
+            yield entry.timestamp, read_frame(segment, entry)
+
+
+def raw_snapshot_days(data_directory: str, symbol: str) -> List[str]:
+    # days with raw snapshots of the symbol, as per-fetch files or an archive
+    symbol_path = os.path.join(data_directory, symbol)
+    if not os.path.isdir(symbol_path):
+        return []
+    days = set()
+    for name in os.listdir(symbol_path):
+        day = name
+        for suffix in (segment_suffix, pack_suffix):
+            if name.endswith(suffix):
+                day = name[:-len(suffix)]
+        try:
+            datetime.date.fromisoformat(day)
+        except ValueError:
+            continue
+        days.add(day)
+    return sorted(days)
+
+
+def snapshot_files(day_path: str, day: str) -> List[Tuple[int, str]]:
+    # (epoch microseconds, path) of the day's per-fetch files in time order
+    date = datetime.date.fromisoformat(day)
+    files = []
+    for name in os.listdir(day_path):
+        if len(name) != 12 or not name.isdigit():
+            continue
+        when = datetime.datetime.combine(date, datetime.datetime.strptime(name, "%H%M%S%f").time(), tzinfo=_IST)
+        files.append((to_timestamp(when), os.path.join(day_path, name)))
+    files.sort()
+    return files
+
+
+def iter_raw_snapshots(data_directory: str, symbol: str, day: str) -> Iterator[Tuple[int, str]]:
+    # every raw snapshot of the day in time order, (epoch microseconds, payload),
+    # whichever SNAPSHOT_FORMAT they were saved with and whether the day was compacted
+    sources: List[Tuple[int, Optional[str], Optional[ArchiveEntry]]] = []
+    day_path = os.path.join(data_directory, symbol, day)
+    compacted_path = pack_path(data_directory, symbol, day)
+    if os.path.exists(compacted_path):
+        # the pack replaces the per-fetch files, which may not be removed yet
+        for entry in read_pack_index(compacted_path):
+            sources.append((entry.timestamp, compacted_path, entry))
+    elif os.path.isdir(day_path):
+        sources.extend((timestamp, file_path, None) for timestamp, file_path in snapshot_files(day_path, day))
+    segment_path, index_path = archive_paths(data_directory, symbol, day)
+    entries = read_index(index_path)
+    sources.extend((entry.timestamp, None, entry) for entry in entries)
+    sources.sort(key=lambda x: x[0])
+    segment = open(segment_path, mode="rb") if entries else None
+    pack = open(compacted_path, mode="rb") if os.path.exists(compacted_path) else None
+    try:
+        for timestamp, file_path, entry in sources:
+            if entry is not None:
+                yield timestamp, read_frame(pack if file_path == compacted_path else segment, entry)
+            else:
+                with open(file_path) as f:
+                    yield timestamp, f.read()
+    finally:
+        for f in (segment, pack):
+            if f is not None:
+                f.close()
+
+
+def latest_raw_snapshot(data_directory: str, symbol: str, day: str) -> Optional[Tuple[int, str]]:
+    # the day's newest raw snapshot, (epoch microseconds, payload), None when there is none
+    newest: Optional[Tuple[int, str]] = None
+    segment_path, index_path = archive_paths(data_directory, symbol, day)
+    compacted_path = pack_path(data_directory, symbol, day)
+    for path, entries in ((segment_path, read_index(index_path)),
+                          (compacted_path, read_pack_index(compacted_path) if os.path.exists(compacted_path) else [])):
+        if entries and (newest is None or entries[-1].timestamp > newest[0]):
+            with open(path, mode="rb") as f:
+                newest = entries[-1].timestamp, read_frame(f, entries[-1])
+    day_path = os.path.join(data_directory, symbol, day)
+    if os.path.isdir(day_path):
+        for timestamp, file_path in reversed(snapshot_files(day_path, day)[-2:]):
+            if newest is not None and timestamp <= newest[0]:
+                break
+            with open(file_path) as f:
+                payload = f.read()
+            try:
+                json.loads(payload)
+            except ValueError:
+                # still being written, the one before it is taken
+                continue
+            return timestamp, payload
+    return newest
+
+
+def pack_path(data_directory: str, symbol: str, day: str) -> str:
+    return os.path.join(data_directory, symbol, day + pack_suffix)
+
+
+def write_pack(path: str, snapshots: Iterable[Tuple[int, bytes]]) -> List[ArchiveEntry]:
+    # snapshots in the order given, identical payloads share a frame. The
+    # file is synced before returning.
+    entries: List[ArchiveEntry] = []
+    frames: Dict[bytes, Tuple[int, int]] = {}
+    with open(path, mode="wb") as f:
+        offset = 0
+        for timestamp, payload in snapshots:
+            digest = hashlib.sha1(payload).digest()
+            frame = frames.get(digest)
+            if frame is None:
+                compressed = zlib.compress(payload, compression_level)
+                f.write(compressed)
+                frame = frames[digest] = (offset, len(compressed))
+                offset += len(compressed)
+            entries.append(ArchiveEntry(timestamp, frame[0], frame[1], digest))
+        f.write(b''.join(INDEX_ENTRY.pack(x.timestamp, x.offset, x.length, x.digest) for x in entries))
+        f.write(PACK_FOOTER.pack(pack_magic, offset, len(entries)))
+        f.flush()
+        os.fsync(f.fileno())
+    return entries
+
+
+def read_pack_index(path: str) -> List[ArchiveEntry]:
+    with open(path, mode="rb") as f:
+        size = f.seek(0, os.SEEK_END)
+        if size < PACK_FOOTER.size:
+            raise ValueError(f"{path} is too short to be a pack")
+        f.seek(size - PACK_FOOTER.size)
+        magic, index_offset, count = PACK_FOOTER.unpack(f.read(PACK_FOOTER.size))
+        if magic != pack_magic or index_offset + count * INDEX_ENTRY.size + PACK_FOOTER.size != size:
+            raise ValueError(f"{path} has no valid pack footer")
+        f.seek(index_offset)
+        return [ArchiveEntry(*fields) for fields in INDEX_ENTRY.iter_unpack(f.read(count * INDEX_ENTRY.size))]
@@ -0,0 +1,72 @@
+# Copyright 2022 Rohit Sood
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+from chain_parser import Chain
+
+
+@dataclass
+class Snapshot:
+    symbol: str
+    raw: str
+    chain: Optional[Chain]
+    fetched_at: float
+
+    def age(self) -> float:
+        return time.time() - self.fetched_at
+
+
+class SnapshotCache:
+    # Latest raw and parsed snapshot per symbol. The collector fills it every
+    # cycle, API reads only go upstream on a miss or when the entry is too old,
+    # and concurrent misses for the same symbol share one upstream fetch.
+
+    def __init__(self):
+        self._snapshots: Dict[str, Snapshot] = {}
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+    def put(self, symbol: str, raw: str, chain: Optional[Chain] = None,
+            fetched_at: Optional[float] = None) -> Snapshot:
+        snapshot = Snapshot(symbol, raw, chain, fetched_at or time.time())
+        self._snapshots[symbol] = snapshot
+        return snapshot
+
+    def get(self, symbol: str, max_age: Optional[float] = None) -> Optional[Snapshot]:
+        snapshot = self._snapshots.get(symbol)
+        if snapshot is None or (max_age is not None and snapshot.age() > max_age):
+            return None
+        return snapshot
+
+    def forget(self, symbol: str) -> None:
+        self._snapshots.pop(symbol, None)
+
+    async def get_or_fetch(self, symbol: str, fetch: Callable[[str], Awaitable[Snapshot]],
+                           max_age: Optional[float] = None) -> Tuple[Snapshot, bool]:
+        # returns the snapshot and whether it came from the cache
+        snapshot = self.get(symbol, max_age)
+        if snapshot is not None:
+            return snapshot, True
+        inflight = self._inflight.get(symbol)
+        if inflight is None:
+            inflight = asyncio.ensure_future(fetch(symbol))
+            self._inflight[symbol] = inflight
+            inflight.add_done_callback(lambda _: self._inflight.pop(symbol, None))
+        return await asyncio.shield(inflight), False
+
+
+# Shared by the collector and the API
+snapshot_cache = SnapshotCache()
@@ -0,0 +1,170 @@
+# Copyright 2022 Rohit Sood
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import asyncio
+import json
+import os
+from operator import attrgetter
+from typing import Dict, Iterable, List, Optional, Set
+from chain_parser import SERIES_FIELDS, Chain, Contract
+from change_detection import ChangeDetector
+from columnar_store import parse_quote_timestamp
+from data_management import option_instrument_types
+from metrics import stream_frames_total, stream_resyncs_total, stream_subscribers
+
+
+# Frames buffered per client before it is considered too slow and resynced
+max_queued_frames = int(os.environ.get("STREAM_QUEUE_SIZE", "64"))
+# Comment frames keep proxies from closing idle streams
+keepalive_in_seconds = 15
+
+# Columns of every contract row in a frame
+frame_fields = ("identifier", "optionType", "strikePrice") + SERIES_FIELDS
+_row = attrgetter(*frame_fields)
+
+# Put in a client's queue instead of the frames it couldn't keep up with
+RESYNC = b"resync"
+
+
+def encode_frame(event: str, chain: Chain, expiry: str, contracts: Iterable[Contract]) -> bytes:
+    # one server-sent event, compact JSON with the column names once
+    stream_frames_total.inc(event=event)
+    data = {"symbol": chain.symbol, "expiryDate": expiry, "quote_timestamp": chain.opt_timestamp,
+            "underlyingValue": chain.underlyingValue, "fields": frame_fields,
+            "contracts": [_row(x) for x in contracts]}
+    return f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n".encode()
+
+
+class Subscriber:
+
+    def __init__(self, topics: Dict[str, Optional[Set[str]]], max_queued: int = max_queued_frames):
+        # symbol -> expiries, None for every expiry of the symbol
+        self.topics = topics
+        self.queue: asyncio.Queue = asyncio.Queue(max_queued)
+
+    def wants(self, symbol: str, expiry: str) -> bool:
+        expiries = self.topics.get(symbol, ())
+        return expiries is None or expiry in expiries
+
+    def offer(self, frame: bytes) -> None:
+        # never blocks the publisher, a client that fell behind loses its
+        # backlog and gets a fresh snapshot instead
+        try:
+            self.queue.put_nowait(frame)
+        except asyncio.QueueFull:
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(RESYNC)
+            stream_resyncs_total.inc()
+
+
+class _SymbolFeed:
+
+    def __init__(self):
+        self.chain: Optional[Chain] = None
+        # state the last diff was computed against, only kept while someone listens
+        self.detector: Optional[ChangeDetector] = None
+        self.snapshots: Dict[str, bytes] = {}
+        self.subscribers: Set[Subscriber] = set()
+
+
+class StreamHub:
+    # Fans collector cycles out to stream clients. Every cycle is diffed and
+    # serialized once per symbol and expiry, whatever the number of clients.
+
+    def __init__(self):
+        self._feeds: Dict[str, _SymbolFeed] = {}
+
+    def publish(self, symbol: str, chain: Chain) -> None:
+        # called on the event loop after every stored snapshot
+        feed = self._feeds.setdefault(symbol, _SymbolFeed())
+        previous, feed.chain = feed.chain, chain
+        feed.snapshots = {}
+        if not feed.subscribers:
+            feed.detector = None
+            return
+        quote_timestamp = parse_quote_timestamp(chain.opt_timestamp)
+        if feed.detector is None:
+            # clients joined after the last publish and got that chain as their snapshot
+            feed.detector = ChangeDetector(heartbeat=0)
+            if previous is not None:
+                previous_timestamp = parse_quote_timestamp(previous.opt_timestamp)
+                for contract in _options(previous):
+                    feed.detector.changed(contract, previous_timestamp)
+        changed: Dict[str, List[Contract]] = {}
+        for contract in _options(chain):
+            if feed.detector.changed(contract, quote_timestamp):
+                changed.setdefault(contract.expiryDate, []).append(contract)
+        for expiry, contracts in changed.items():
+            frame = encode_frame("diff", chain, expiry, contracts)
+            for subscriber in feed.subscribers:
+                if subscriber.wants(symbol, expiry):
+                    subscriber.offer(frame)
+
+    def subscribe(self, topics: Dict[str, Optional[Set[str]]]) -> Subscriber:
+        subscriber = Subscriber(topics)
+        for symbol in topics:
+            self._feeds.setdefault(symbol, _SymbolFeed()).subscribers.add(subscriber)
+        stream_subscribers.set(self.subscriber_count())
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        for symbol in subscriber.topics:
+            feed = self._feeds.get(symbol)
+            if feed is not None:
+                feed.subscribers.discard(subscriber)
+        stream_subscribers.set(self.subscriber_count())
+
+    def snapshot(self, subscriber: Subscriber) -> List[bytes]:
+        # full state of every subscribed expiry, serialized once per publish
+        frames = []
+        for symbol in subscriber.topics:
+            feed = self._feeds.get(symbol)
+            if feed is None or feed.chain is None:
+                continue
+            if not feed.snapshots:
+                by_expiry: Dict[str, List[Contract]] = {}
+                for contract in _options(feed.chain):
+                    by_expiry.setdefault(contract.expiryDate, []).append(contract)
+                feed.snapshots = {expiry: encode_frame("snapshot", feed.chain, expiry, contracts)
+                                  for expiry, contracts in by_expiry.items()}
+            frames.extend(frame for expiry, frame in feed.snapshots.items() if subscriber.wants(symbol, expiry))
+        return frames
+
+    def subscriber_count(self) -> int:
+        return len({x for feed in self._feeds.values() for x in feed.subscribers})
+
+
+def _options(chain: Chain) -> Iterable[Contract]:
+    return (x for x in chain.contracts if x.instrumentType in option_instrument_types)
+
+
+def parse_topics(value: Optional[str]) -> Dict[str, Optional[Set[str]]]:
+    # NIFTY,BANKNIFTY:25-Aug-2022 -> every NIFTY expiry and one BANKNIFTY expiry
+    topics: Dict[str, Optional[Set[str]]] = {}
+    for item in (value or "").split(","):
+        symbol, _, expiry = item.strip().partition(":")
+        symbol = symbol.strip().upper()
+        if not symbol:
+            continue
+        if not expiry:
+            topics[symbol] = None
+        elif topics.get(symbol, set()) is not None:
+            topics.setdefault(symbol, set()).add(expiry.strip())
+    if not topics:
+        raise ValueError("symbols is required, e.g. symbols=NIFTY,BANKNIFTY:25-Aug-2022")
+    return topics
+
+
+stream_hub = StreamHub()
@@ -0,0 +1,140 @@
+# Copyright 2022 Rohit Sood
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import IO, Dict, List, Optional, Set, Union
+import metrics
+from structured_log import get_logger, fields
+
+
+log = get_logger("writer")
+
+
+# Append handles kept open between cycles, least recently used are closed first
+max_open_files = int(os.environ.get("WRITER_MAX_OPEN_FILES", "256"))
+
+
+class StrikeWriter:
+    # Buffers rows per file and writes them in one batch per cycle. Rows are
+    # text lines or already encoded binary records. Directories and files that
+    # are known to exist are remembered so that every path is checked on disk
+    # only once per process.
+
+    def __init__(self, max_open_files: int = max_open_files):
+        self.max_open_files = max_open_files
+        self._handles: 'OrderedDict[str, IO]' = OrderedDict()
+        self._pending: Dict[str, List[Union[str, bytes]]] = {}
+        self._known_dirs: Set[str] = set()
+        self._known_files: Set[str] = set()
+        # metrics label (the symbol) per registered file
+        self._labels: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def ensure_dir(self, directory: str) -> str:
+        if directory not in self._known_dirs:
+            os.makedirs(directory, exist_ok=True)
+            self._known_dirs.add(directory)
+        return directory
+
+    def register(self, path: str, header: Union[str, bytes] = b'', label: str = '') -> str:
+        # creates the file with its header the first time the path is seen
+        if path in self._known_files:
+            return path
+        with self._lock:
+            if path not in self._known_files:
+                self._labels[path] = label
+                self.ensure_dir(os.path.dirname(path))
+                if not os.path.exists(path):
+                    with open(path, mode="wb") as f:
+                        f.write(_encode(header))
+                self._known_files.add(path)
+        return path
+
+    def append(self, path: str, line: Union[str, bytes]) -> None:
+        with self._lock:
+            self._pending.setdefault(path, []).append(line)
+
+    def flush(self) -> int:
+        # writes everything buffered so far, returns the number of rows written.
+        # A batch that fails is cut back off the file and kept, ahead of any
+        # rows appended since, for the next flush: files whose records point
+        # at lines of another file by position must not lose a line.
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        rows = 0
+        failed: Dict[str, List[Union[str, bytes]]] = {}
+        with self._flush_lock:
+            for path, lines in pending.items():
+                label = self._labels.get(path, '')
+                size = None
+                try:
+                    started = time.perf_counter()
+                    f = self._handle(path)
+                    size = f.tell()
+                    f.write(b''.join(_encode(line) for line in lines))
+                    f.flush()
+                    metrics.file_write_seconds.observe(time.perf_counter() - started, symbol=label)
+                    metrics.rows_written_total.inc(len(lines), symbol=label)
+                    rows += len(lines)
+                except:
+                    log.exception("batch not written, kept for the next flush", extra=fields(path=path, rows=len(lines)))
+                    self._discard(path, size)
+                    failed[path] = lines
+        if failed:
+            with self._lock:
+                for path, lines in failed.items():
+                    self._pending[path] = lines + self._pending.get(path, [])
+        return rows
+
+    def close(self) -> None:
+        self.flush()
+        with self._flush_lock:
+            while self._handles:
+                _, f = self._handles.popitem(last=False)
+                f.close()
+
+    def _handle(self, path: str) -> IO:
+        f = self._handles.get(path)
+        if f is not None:
+            self._handles.move_to_end(path)
+            return f
+        while len(self._handles) >= self.max_open_files:
+            _, evicted = self._handles.popitem(last=False)
+            evicted.close()
+        f = open(path, mode="ab")
+        self._handles[path] = f
+        return f
+
+    def _discard(self, path: str, size: Optional[int] = None) -> None:
+        f = self._handles.pop(path, None)
+        if f is not None:
+            try:
+                f.close()
+            except:
+                pass
+        if size is not None:
+            # a partly written batch would be written again after it
+            try:
+                os.truncate(path, size)
+            except OSError:
+                pass
+        self._known_files.discard(path)
+
+
+def _encode(line: Union[str, bytes]) -> bytes:
+    return line.encode() if isinstance(line, str) else line
@@ -0,0 +1,86 @@
+# Copyright 2022 Rohit Sood
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import atexit
+import datetime
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+from typing import Any, Dict, Optional
+
+
+# Log records go through a queue and are written to stdout by a background
+# thread, so the collector never waits on the terminal.
+log_level = os.environ.get("LOG_LEVEL", "INFO")
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class KeyValueFormatter(logging.Formatter):
+    # ts=... level=INFO logger=datapi.collector msg="..." symbol=NIFTY fetch_ms=12.3
+
+    def format(self, record: logging.LogRecord) -> str:
+        parts = [f"ts={datetime.datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds')}",
+                 f"level={record.levelname}", f"logger={record.name}", f"msg={_quote(record.getMessage())}"]
+        for key, value in getattr(record, "fields", {}).items():
+            parts.append(f"{key}={_quote(value)}")
+        line = " ".join(parts)
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+def _quote(value: Any) -> str:
+    text = str(value)
+    if text == "" or any(c in text for c in ' "='):
+        return '"' + text.replace('"', '\\"') + '"'
+    return text
+
+
+def fields(**kwargs) -> Dict[str, Dict[str, Any]]:
+    # extra= argument carrying structured fields, log.info("saved", extra=fields(symbol=s))
+    return {"fields": kwargs}
+
+
+def configure_logging() -> None:
+    global _listener
+    if _listener is not None:
+        return
+    # records are queued as they are and formatted by the listener's thread,
+    # the logging call only puts them on the queue
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(KeyValueFormatter())
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    enqueue = _UnformattedQueueHandler(records)
+    root = logging.getLogger("datapi")
+    root.setLevel(log_level)
+    root.addHandler(enqueue)
+    root.propagate = False
+    _listener = logging.handlers.QueueListener(records, handler)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+
+class _UnformattedQueueHandler(logging.handlers.QueueHandler):
+    # QueueHandler.prepare formats in the caller's thread, the queue is in
+    # process so the record can be handed over untouched
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def get_logger(name: str) -> logging.Logger:
+    return logging.getLogger(f"datapi.{name}")
@@ -0,0 +1,78 @@
+# Copyright 2022 Rohit Sood
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import datetime
+import os
+from typing import List
+from zoneinfo import ZoneInfo
+from bars import BarAggregator, BarBatch, read_bars
+from benchmarks.synthetic_chain import synthetic_chain
+from chain_parser import parse_chain
+
+_session = datetime.datetime(2022, 8, 18, 10, 0)
+
+
+def _snapshot(minute: int, price: float, traded: int):
+    when = _session + datetime.timedelta(minutes=minute)
+    chain = parse_chain(synthetic_chain("NIFTY", expiries=1, strikes=2, when=when))
+    options = [x for x in chain.contracts if x.instrumentType == "Index Options"][:1]
+    options[0].lastPrice = price
+    options[0].numberOfContractsTraded = traded
+    return chain, options
+
+
+def _write(batches: List[BarBatch]) -> None:
+    # what data_management.write_bar_data does through the StrikeWriter
+    for bar_day, added, closed in batches:
+        os.makedirs(os.path.dirname(bar_day.identifiers_path), exist_ok=True)
+        with open(bar_day.identifiers_path, mode="a") as f:
+            f.write(''.join(x + "\n" for x in added))
+        for resolution, bars in closed.items():
+            with open(bar_day.records_path(resolution), mode="ab") as f:
+                f.write(bars.tobytes())
+
+
+def test_restart_in_the_middle_of_a_bar(tmp_path):
+    data_dir = str(tmp_path)
+    before = BarAggregator(data_dir, ["5m"])
+    for minute, price, traded in ((0, 100.0, 10), (1, 120.0, 15)):
+        chain, options = _snapshot(minute, price, traded)
+        _write(before.update("NIFTY", chain, options))
+    # shutdown: the 10:00 bar is written as it is
+    _write(before.close())
+
+    after = BarAggregator(data_dir, ["5m"])
+    for minute, price, traded in ((2, 90.0, 18), (3, 110.0, 30), (6, 111.0, 31)):
+        chain, options = _snapshot(minute, price, traded)
+        _write(after.update("NIFTY", chain, options))
+
+    bars, _ = read_bars(data_dir, "NIFTY", "2022-08-18", "5m", options[0].identifier)
+    assert len(bars) == 1
+    bar = bars[0]
+    assert bar["bar_start"] == int(_session.replace(tzinfo=ZoneInfo("Asia/Kolkata")).timestamp())
+    assert (bar["open"], bar["high"], bar["low"], bar["close"]) == (100.0, 120.0, 90.0, 110.0)
+    # 15 in the part written before the restart and 15 -> 30 after it, the
+    # 15 -> 18 traded while the collector was down included
+    assert bar["volume"] == 30
+    assert bar["snapshots"] == 4
+
+
+def test_bars_written_once_are_read_as_they_are(tmp_path):
+    data_dir = str(tmp_path)
+    aggregator = BarAggregator(data_dir, ["5m"])
+    for minute, price, traded in ((0, 100.0, 10), (6, 101.0, 12), (11, 102.0, 20)):
+        chain, options = _snapshot(minute, price, traded)
+        _write(aggregator.update("NIFTY", chain, options))
+    bars, _ = read_bars(data_dir, "NIFTY", "2022-08-18", "5m", options[0].identifier)
+    assert list(bars["close"]) == [100.0, 101.0]
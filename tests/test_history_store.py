@@ -0,0 +1,67 @@
+# Copyright 2022 Rohit Sood
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import os
+import history_store
+from columnar_store import parse_quote_timestamp
+from data_management import strike_data_header
+
+
+def _row(minute, price):
+    return f"18-Aug-2022 09:{minute:02d}:00," + ",".join([str(price)] * (strike_data_header.count(",") - 1)) + ",\n"
+
+
+def _rows_at(index, minute):
+    start, stop = index.latest_offset(parse_quote_timestamp(f"18-Aug-2022 09:{minute:02d}:00"))
+    with open(index.path, mode="rb") as f:
+        f.seek(start)
+        return f.read(stop - start).decode()
+
+
+def test_index_is_read_back_and_only_new_rows_are_scanned(tmp_path, monkeypatch):
+    series = tmp_path / "NIFTY25AUG2022CE17850.00"
+    series.write_text(strike_data_header + _row(15, 1) + _row(16, 2))
+    history_store.CsvTimeIndex(str(series)).refresh()
+    with open(series, mode="a") as f:
+        f.write(_row(17, 3))
+
+    parsed = []
+    monkeypatch.setattr(history_store, "parse_quote_timestamp",
+                        lambda value: parsed.append(value) or parse_quote_timestamp(value))
+    index = history_store.CsvTimeIndex(str(series))
+    assert _rows_at(index, 17) == _row(17, 3)
+    assert _rows_at(index, 16) == _row(16, 2)
+    # the first row came from the index file
+    assert "18-Aug-2022 09:15:00" not in parsed
+    assert "18-Aug-2022 09:17:00" in parsed
+
+
+def test_rewritten_series_is_indexed_again(tmp_path):
+    series = tmp_path / "NIFTY25AUG2022CE17850.00"
+    series.write_text(strike_data_header + _row(15, 1) + _row(16, 2) + _row(17, 3))
+    index = history_store.CsvTimeIndex(str(series))
+    assert _rows_at(index, 17) == _row(17, 3)
+
+    # truncated
+    series.write_text(strike_data_header + _row(15, 1))
+    assert _rows_at(index, 17) == _row(15, 1)
+    # cut back and written again past where it was indexed
+    series.write_text(strike_data_header + _row(15, 1) + _row(16, 20) + _row(17, 30) + _row(18, 40))
+    assert _rows_at(index, 16) == _row(16, 20)
+    # replaced by a new file
+    replacement = tmp_path / "replacement"
+    replacement.write_text(strike_data_header + _row(15, 5) + _row(16, 6))
+    os.replace(replacement, series)
+    assert _rows_at(index, 17) == _row(16, 6)
+    assert _rows_at(history_store.CsvTimeIndex(str(series)), 15) == _row(15, 5)
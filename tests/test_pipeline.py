@@ -0,0 +1,52 @@
+# Copyright 2022 Rohit Sood
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import asyncio
+import json
+import pipeline
+from benchmarks.synthetic_chain import synthetic_chain
+
+
+def test_cancelled_submitter_does_not_hold_up_close(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    # nothing reaches the disk
+    monkeypatch.setattr(pipeline, "_write_batch", lambda batch: [None] * len(batch))
+    raw = json.dumps(synthetic_chain("NIFTY", expiries=1, strikes=2))
+
+    async def run():
+        stages = pipeline.Pipeline(workers=1, max_queued=1, max_batch=1)
+        opened = asyncio.Event()
+        parse_loop = stages._parse_loop
+
+        async def gated_parse_loop():
+            # the raw queue stays full until the blocked submitter is cancelled
+            await opened.wait()
+            await parse_loop()
+        stages._parse_loop = gated_parse_loop
+
+        queued = asyncio.ensure_future(stages.submit("NIFTY", raw))
+        await asyncio.sleep(0.1)
+        blocked = asyncio.ensure_future(stages.submit("NIFTY", raw))
+        await asyncio.sleep(0.1)
+        assert not blocked.done()
+        blocked.cancel()
+        await asyncio.gather(blocked, return_exceptions=True)
+        assert len(stages._pending) == 1
+
+        opened.set()
+        await asyncio.wait_for(stages.close(), 60)
+        assert not stages._pending
+        assert (await queued).opt_timestamp
+
+    asyncio.run(run())
@@ -0,0 +1,46 @@
+# Copyright 2022 Rohit Sood
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import datetime
+from benchmarks.synthetic_chain import synthetic_chain
+from chain_parser import parse_chain
+from columnar_store import RECORD_DTYPE
+from ring_buffer import IntradayStore
+
+
+def _chain(symbol: str, strikes: int):
+    chain = parse_chain(synthetic_chain(symbol, expiries=1, strikes=strikes, when=datetime.datetime(2022, 8, 18, 10, 0)))
+    return chain, [x for x in chain.contracts if x.instrumentType in ("Index Options", "Stock Options")]
+
+
+def test_rings_are_sized_by_tier_and_counted_at_their_size():
+    nifty, nifty_options = _chain("NIFTY", 30)
+    infy, infy_options = _chain("INFY", 2)
+    ring_bytes = 400 * RECORD_DTYPE.itemsize
+    # room for the rings of both chains at one snapshot a minute, not at 5 seconds
+    store = IntradayStore(capacity=400, memory_cap=ring_bytes * (len(nifty_options) + len(infy_options)))
+    store.set_intervals({"NIFTY": 5})
+    assert store.capacity_for("NIFTY") == 4800
+    assert store.capacity_for("INFY") == 400
+
+    assert store.add("INFY", infy, infy_options) == len(infy_options)
+    assert store.memory_used() == len(infy_options) * ring_bytes
+    # every 5 second ring is 12 minute rings, only as many as fit are allocated
+    appended = store.add("NIFTY", nifty, nifty_options)
+    assert appended == len(nifty_options) // 12 > 0
+    assert store.memory_used() == len(infy_options) * ring_bytes + appended * 12 * ring_bytes
+    assert store.memory_used() <= store.memory_cap
+
+    store.forget("NIFTY")
+    assert store.memory_used() == len(infy_options) * ring_bytes
@@ -0,0 +1,112 @@
+# Copyright 2022 Rohit Sood
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import asyncio
+import glob
+import multiprocessing
+import os
+import shutil
+import socket
+import time
+import sharding
+from benchmarks.stub_server import StubConfig, serve
+
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _owners(confirmed):
+    owners = {}
+    for worker_id, symbols in confirmed.items():
+        for symbol in symbols:
+            owners.setdefault(symbol, []).append(worker_id)
+    return owners
+
+
+class _Running:
+
+    def is_alive(self):
+        return True
+
+
+def test_late_confirmation_is_not_taken_for_the_next_one(monkeypatch):
+    monkeypatch.setattr(sharding, "handover_timeout_in_seconds", 0.2)
+    coordinator = sharding.Coordinator(["NIFTY"], workers=1)
+    worker = coordinator._workers[0]
+    worker.process = _Running()
+    worker.connection, child = multiprocessing.Pipe()
+    # the worker confirms the first handover after the coordinator gave up on it
+    child.send((1, ["NIFTY"]))
+    asyncio.run(coordinator._released([worker], 2))
+    assert worker.generation == 1
+    child.send((2, []))
+    asyncio.run(coordinator._released([worker], 2))
+    assert worker.generation == 2
+    assert coordinator.confirmed() == {"worker-0": []}
+
+
+def test_each_symbol_has_one_owner_after_a_worker_dies(tmp_path, monkeypatch):
+    # the workers read their configuration files from the working directory
+    for name in glob.glob(os.path.join(repo_root, "*.txt")):
+        shutil.copy(name, tmp_path)
+    monkeypatch.chdir(tmp_path)
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    # the workers are spawned with this environment, they only poll while the market is open
+    monkeypatch.setenv("DEBUG", "False")
+    monkeypatch.setenv("PIPELINE", "False")
+    monkeypatch.setenv("NSE_BASE_URL", f"http://127.0.0.1:{port}")
+    monkeypatch.setattr(sharding, "restart_delay_in_seconds", 1.0)
+    context = multiprocessing.get_context("spawn")
+    stub = context.Process(target=serve, args=(StubConfig(latency_ms=5, jitter_ms=0), {}, "127.0.0.1", port),
+                           daemon=True)
+    stub.start()
+    symbols = [f"STOCK{i:03d}" for i in range(60)]
+    shared = set()
+
+    async def settled(workers):
+        # every symbol confirmed by exactly one of workers live processes
+        deadline = time.monotonic() + 60
+        while time.monotonic() < deadline:
+            # confirmations are read as they arrive, not once per check
+            for worker in coordinator._workers:
+                if worker.alive():
+                    coordinator._receive(worker)
+            owners = _owners(coordinator.confirmed())
+            shared.update(symbol for symbol, x in owners.items() if len(x) > 1)
+            if sorted(owners) == symbols and len({x[0] for x in owners.values()}) == workers:
+                return owners
+            await asyncio.sleep(0.02)
+        raise AssertionError(f"symbols not settled on {workers} workers: {coordinator.confirmed()}")
+
+    async def run():
+        running = asyncio.ensure_future(coordinator.run())
+        try:
+            await settled(3)
+            coordinator._workers[0].process.kill()
+            # its symbols go to the other two, until it is restarted
+            assert "worker-0" not in set(sum((await settled(2)).values(), []))
+            assert "worker-0" in set(sum((await settled(3)).values(), []))
+        finally:
+            running.cancel()
+
+    coordinator = sharding.Coordinator(symbols, workers=3)
+    try:
+        asyncio.run(run())
+    finally:
+        coordinator.stop()
+        stub.kill()
+    # no symbol was ever polled by two workers at once
+    assert not shared
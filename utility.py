@@ -13,119 +13,154 @@
 #    limitations under the License.
 
 import asyncio
-import datetime
 import os
 import urllib
-from datetime import date
 from os import path, symlink
-from typing import Dict, Any, List
+from typing import Callable, Dict, Any, List, Set
 from flask import request_started
 import requests
-from zoneinfo import ZoneInfo
-from data_management import save_data, get_data_folder
+from data_management import save_data, get_data_folder, flush_strike_data, change_detector, data_directory, close_bars
+from compaction import compact_after_close, compact_after_market_close
+from pipeline import pipeline, pipeline_enabled
+from fetch_engine import (CircuitOpenError, FetchEngine, ambiguous_statuses, get_engine, is_upstream_failure,
+                          max_fetch_retries, retry_delay)
+from nse_session import NseSession
+from scheduler import TieredScheduler, group_tiers
+from market_calendar import MarketCalendar
+from sharding import host_filter
+from structured_log import get_logger, fields
+import metrics
+from snapshot_cache import Snapshot, snapshot_cache
+from ring_buffer import intraday_store
+from stream_hub import stream_hub
+from chain_parser import parse_chain
+import json
 import pytz
 import threading
-import concurrent.futures
 import sys
 import time
 
 
 next_job_interval_in_seconds = 60
+# Upstream host, pointed at benchmarks/stub_server.py for offline runs
+nse_base_url = os.environ.get("NSE_BASE_URL", "https://www.nseindia.com").rstrip("/")
 # Current time in IST
 IST = pytz.timezone('Asia/Kolkata')
+# Trading sessions and holidays, loaded once
+market_calendar = MarketCalendar("market_holidays.txt")
+# Symbols with a quote being fetched or stored
+quotes_in_flight: Set[str] = set()
+log = get_logger("collector")
 
 
-async def start_collector():
+async def start_collector(*, owns: Callable[[str], bool] = None):
+    # owns picks the symbols this process polls, by default the ones
+    # SHARD_NODES/SHARD_ID give to this host (all of them when unset)
+    owns = owns or host_filter() or (lambda symbol: True)
     is_market_open = get_market_open_state()
-    headers: dict[str, str] = {}
-    cookies: dict[str, str] = {}
     stock_list = getstocklist()
     test_mode = False
     # Debug Option
     if os.environ["DEBUG"]=="True":
         is_market_open = True
         test_mode = True
-        print("starting quote crawler in test mode...")
+        log.info("starting quote crawler in test mode...")
     else:
-        print("starting quote crawler...")
-    while is_market_open:
-        # loop through the stock list in groups of 8 threads
-        start = time.time()
-        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
-            # Start the load operations and mark each future with its stock symbol
-            # fetch_quote_symbols = { executor.map(fetch_quote, stock): stock for stock in stock_list }
-            fetch_quote_symbols = {executor.submit(fetch_quote, stock): stock for stock in stock_list}
-        for quote_symbol in concurrent.futures.as_completed(fetch_quote_symbols):
-            symbol = fetch_quote_symbols[quote_symbol]
-            print("thread done for ", symbol)
-        
-        # threads = list()
-        # for index in range(len(stock_list)):
-        #     symbol=stock_list[index]
-        #     print("Create and start thread ", symbol)
-        #     x = threading.Thread(target=fetch_quote, args=(symbol,))
-        #     threads.append(x)
-        #     x.start()
-        # for index, thread in enumerate(threads):
-        #     symbol=stock_list[index]
-        #     thread.join()
-        #     print("thread done for ", symbol)
-        print(f"Total time {round(time.time() - start, 2)}s")
+        log.info("starting quote crawler...")
+    engine = get_engine()
+    stock_tiers = getstocktiers()
+    # faster tiers keep more rows per contract in memory
+    intraday_store.set_intervals(stock_tiers)
+    scheduler = TieredScheduler(group_tiers(stock_list, stock_tiers, next_job_interval_in_seconds),
+                                lambda symbols, deadline: run_collector_cycle([x for x in symbols if owns(x)], engine,
+                                                                              deadline))
+    while True:
+        if is_market_open:
+            # runs every tier on its wall clock aligned ticks until the market closes
+            await scheduler.run(get_market_open_state)
+        # the next session starts with fresh cookies
+        nse_session.reset()
+        # the first snapshot of the next session is stored in full
+        change_detector.reset()
+        # the session's last bars end here
+        close_bars()
+        await asyncio.get_running_loop().run_in_executor(None, flush_strike_data)
+        log.info("Market closed!")
+        if test_mode:
+            # exits the program
+            asyncio.get_running_loop().stop()
+            return
+        if compact_after_close:
+            # the day's snapshot files become one pack per symbol
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, compact_after_market_close,
+                                                                 os.path.abspath(data_directory), owns)
+            except Exception:
+                log.exception("compaction failed")
         is_market_open = get_market_open_state()
-        if is_market_open is not True:
-            # reset the headers, cookies
-            headers = {}
-            cookies = {}
-            print("Market closed!")
-            if test_mode:
-                # exits the program
-                asyncio.get_running_loop().stop()
-            while is_market_open is not True:
-                await asyncio.sleep(next_job_interval_in_seconds)
-                is_market_open = get_market_open_state()
-        await asyncio.sleep(next_job_interval_in_seconds)
-        print("starting next cycle of quote crawler...")
-
-
-def fetch_quote(symbol):
-    pTimer = time.time()
-    headers: dict[str, str] = {}
-    cookies: dict[str, str] = {}
-    if cookies == {}:
-        headers = getstaticheader(urllib.parse.quote(symbol))
-        cookies = getfreshcookie()
-    else:
+        while is_market_open is not True:
+            # sleep straight to the next session, waking hourly in case the holiday file changed
+            log.info("waiting for market open", extra=fields(next_open=market_calendar.next_open().isoformat()))
+            await asyncio.sleep(min(market_calendar.seconds_until_open(), 3600))
+            is_market_open = get_market_open_state()
+        log.info("starting next cycle of quote crawler...")
+
+
+async def run_collector_cycle(stock_list, engine: FetchEngine = None, deadline: float = None):
+    # fetch the given symbols on the shared connection pool, the engine
+    # paces the requests, retries stop at deadline (epoch seconds)
+    fetch_quote_results = await asyncio.gather(*(fetch_quote(stock, engine, deadline) for stock in stock_list),
+                                               return_exceptions=True)
+    for symbol, result in zip(stock_list, fetch_quote_results):
+        if isinstance(result, Exception):
+            log.error("quote failed", exc_info=result, extra=fields(symbol=symbol))
+    if pipeline_enabled:
+        # the pipeline's writer flushes every batch it stores
+        return
+    # one batched write of every contract row fetched in this cycle
+    flushStart = time.time()
+    rows_written = await asyncio.get_running_loop().run_in_executor(None, flush_strike_data)
+    log.info("flushed rows", extra=fields(rows=rows_written, flush_ms=round((time.time() - flushStart) * 1000, 1)))
+
+
+async def fetch_quote(symbol, engine: FetchEngine = None, deadline: float = None):
+    # the stored chain, None when no quote could be fetched this cycle
+    # a symbol handed to another process is only let go once this is done
+    quotes_in_flight.add(symbol)
+    try:
+        engine = engine or get_engine()
+        pTimer = time.time()
         headers = getstaticheader(urllib.parse.quote(symbol))
-    print(f"Getting quote for {symbol} ...")
-    stock_quote = get_stock_data(symbol, headers, cookies)
-    quoteFetched = time.time()
-    save_data(symbol, stock_quote)
-    print(f"{symbol} \n\tQuote Response in {round(quoteFetched - pTimer, 2)}s \n\tQuote Saved to disk in {round(time.time() - quoteFetched, 2)}s")
+        log.debug("getting quote", extra=fields(symbol=symbol))
+        stock_quote = await fetch_stock_data(symbol, headers, engine=engine, deadline=deadline)
+        if stock_quote is None:
+            return None
+        quoteFetched = time.time()
+        if pipeline_enabled:
+            # parsed in the pipeline's process pool, stored by its writer
+            chain = await pipeline.submit(symbol, stock_quote)
+        else:
+            # disk writes stay off the event loop
+            chain = await asyncio.get_running_loop().run_in_executor(None, save_data, symbol, stock_quote)
+        snapshot_cache.put(symbol, stock_quote, chain, quoteFetched)
+        # changed contracts go out to stream clients, serialized once for all of them
+        stream_hub.publish(symbol, chain)
+        log.info("quote saved", extra=fields(symbol=symbol, fetch_ms=round((quoteFetched - pTimer) * 1000, 1),
+                                             save_ms=round((time.time() - quoteFetched) * 1000, 1)))
+        return chain
+    finally:
+        quotes_in_flight.discard(symbol)
+
 
 def get_market_open_state():
-    # trading time between 9:15 AM - 3:30 PM (IST)
+    # trading time between 9:15 AM - 3:29 PM (IST)
     # not a weekend
     # not a declared holiday
-    now_india = datetime.datetime.now(IST)
-
-    open_time = datetime.time(hour=9, minute=15, second=0, microsecond=0, tzinfo=ZoneInfo("Asia/Calcutta"))
-    close_time = datetime.time(hour=15, minute=29, second=0, microsecond=0, tzinfo=ZoneInfo("Asia/Calcutta"))
-    if now_india.weekday() == 5 or now_india.weekday() == 6:
-        return False
-    if not open_time <= now_india.time() <= close_time:
-        return False
-    market_holiday_list = get_market_holidays()
-    if now_india.date() in market_holiday_list:
-        return False
-    return True
+    return market_calendar.is_open()
 
 
 def get_market_holidays():
-    holiday_list: list[date] = []
-    with open(os.path.abspath("market_holidays.txt")) as f:
-        for index, line in enumerate(f):
-            holiday_list.append(datetime.datetime.strptime(str.strip(line.split('#')[1]), '%d-%b-%Y').date())
-    return holiday_list
+    return sorted(market_calendar.holidays())
 
 
 def getcustomcookie(symbol, headers):
@@ -170,13 +205,88 @@ def getstaticheader(symbol=''):
 
 
 def get_stock_data(symbol, headers, cookies):
-    url = f"https://www.nseindia.com/api/quote-derivative?symbol={urllib.parse.quote(symbol)}"
+    url = f"{nse_base_url}/api/quote-derivative?symbol={urllib.parse.quote(symbol)}"
     try:
         response = requests.request("GET", url, headers=headers, cookies=cookies)
         stock_quote_data = response.text
         return stock_quote_data
     except Exception as e:
-        print("Oops!", e.__class__, "occurred.")
+        log.warning("quote request failed", extra=fields(symbol=symbol, error=e.__class__.__name__))
+
+
+async def fetch_stock_data(symbol, headers, cookies=None, engine: FetchEngine = None, deadline: float = None):
+    # the quote's JSON, None once every attempt failed. Throttling, server
+    # errors, error pages and connection errors are retried with jittered
+    # exponential backoff, as long as a retry starts before deadline (epoch
+    # seconds). Cookies default to the shared session, which is re-bootstrapped
+    # once if NSE rejects them.
+    engine = engine or get_engine()
+    url = f"{nse_base_url}/api/quote-derivative?symbol={urllib.parse.quote(symbol)}"
+    shared_cookies = cookies is None
+    refreshed = False
+    reason = None
+    attempt = 0
+    while True:
+        try:
+            if shared_cookies:
+                cookies = await nse_session.get_cookies()
+            with metrics.stage_seconds.time(stage="http_fetch", symbol=symbol):
+                response = await engine.get(url, headers=headers, cookies=cookies)
+        except CircuitOpenError:
+            # NSE is pushing back, retrying only prolongs it
+            metrics.fetch_total.inc(symbol=symbol, status="circuit_open")
+            reason = "circuit_open"
+            break
+        except Exception as e:
+            metrics.fetch_total.inc(symbol=symbol, status=e.__class__.__name__)
+            log.warning("quote request failed", extra=fields(symbol=symbol, error=e.__class__.__name__))
+            reason = e.__class__.__name__
+        else:
+            metrics.fetch_total.inc(symbol=symbol, status=response.status)
+            if response.status == 200 and is_quote_payload(response.text):
+                metrics.quotes_total.inc(symbol=symbol, outcome="ok")
+                return response.text
+            reason = "invalid_payload" if response.status == 200 else str(response.status)
+            if shared_cookies and response.status in (401, 403) and not refreshed:
+                # stale cookies are retried straight away with fresh ones
+                cookies = await nse_session.refresh(cookies)
+                refreshed = True
+                metrics.fetch_retries_total.inc(symbol=symbol, reason=reason)
+                continue
+            if response.status in ambiguous_statuses:
+                # not the cookies, or there were none to refresh
+                engine.throttled(response)
+            if not (response.status == 200 or is_upstream_failure(response.status)):
+                # e.g. 404 for an unknown symbol, asking again won't help
+                break
+        if attempt >= max_fetch_retries:
+            break
+        delay = retry_delay(attempt)
+        if deadline is not None and time.time() + delay >= deadline:
+            reason += ", out of time"
+            break
+        attempt += 1
+        metrics.fetch_retries_total.inc(symbol=symbol, reason=reason)
+        await asyncio.sleep(delay)
+    metrics.quotes_total.inc(symbol=symbol, outcome="failed")
+    log.warning("quote unavailable", extra=fields(symbol=symbol, retries=attempt, reason=reason))
+    return None
+
+
+def is_quote_payload(text: str) -> bool:
+    # NSE answers some failures with 200 and an HTML page
+    return text.lstrip()[:1] == "{"
+
+
+async def fetch_snapshot(symbol, engine: FetchEngine = None) -> Snapshot:
+    # upstream fetch for the API, parsed off the loop and cached but not written to disk
+    headers = getstaticheader(urllib.parse.quote(symbol))
+    stock_quote = await fetch_stock_data(symbol, headers, engine=engine)
+    if stock_quote is None:
+        raise ConnectionError(f"no quote received for {symbol}")
+    fetched_at = time.time()
+    chain = await asyncio.get_running_loop().run_in_executor(None, lambda: parse_chain(json.loads(stock_quote)))
+    return snapshot_cache.put(symbol, stock_quote, chain, fetched_at)
 
 
 def getcookie(symbol):
@@ -197,10 +307,21 @@ def getheaders():
 
 
 def getfreshcookie():
-    response = requests.request("GET", "https://www.nseindia.com/", headers=getstaticheader())
+    response = requests.request("GET", f"{nse_base_url}/", headers=getstaticheader())
+    return response.cookies
+
+
+async def fetch_fresh_cookie(engine: FetchEngine = None):
+    with metrics.stage_seconds.time(stage="cookie_refresh", symbol=""):
+        response = await (engine or get_engine()).get(f"{nse_base_url}/", headers=getstaticheader())
+    log.info("refreshed NSE cookies", extra=fields(status=response.status))
     return response.cookies
 
 
+# Cookies shared by every fetch in the process
+nse_session = NseSession(fetch_fresh_cookie)
+
+
 def getstocklist():
     stock_list = []
     stock_list_file = "stock_list.txt"
@@ -209,4 +330,18 @@ def getstocklist():
     with open(os.path.abspath(stock_list_file)) as f:
         for index, line in enumerate(f):
             stock_list.append(str.strip(line))
-    return stock_list
\ No newline at end of file
+    return stock_list
+
+
+def getstocktiers():
+    # SYMBOL#seconds per line, symbols not listed are polled every next_job_interval_in_seconds
+    stock_tiers = {}
+    if not os.path.exists(os.path.abspath("stock_tiers.txt")):
+        return stock_tiers
+    with open(os.path.abspath("stock_tiers.txt")) as f:
+        for index, line in enumerate(f):
+            # blank lines and commented out examples
+            if len(str.strip(line)) == 0 or str.strip(line).startswith('#'):
+                continue
+            stock_tiers[str.strip(line.split('#')[0])] = float(str.strip(line.split('#')[1]))
+    return stock_tiers